@@ -133,7 +133,6 @@ setup(cmdclass={'test': test_cmd,
       ],
 
       install_requires = [
-          'TcpProxyReflector >=0.1.3',
           'path.py >=3.0.1',
           'pefile >= 1.2.10',
       ],
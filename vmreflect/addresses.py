@@ -0,0 +1,101 @@
+"""
+Guest IP addresses, remembered between tunnels so that a repeat tunnel
+to the same VM doesn't have to ask the guest again.
+
+An address is kept for max_age seconds, and only until the VM is powered
+on again: VMware starts a new vmware.log next to the .vmx file every time
+a VM starts, so the log's inode tells one boot from the next. Without a
+vmware.log there is no telling, and nothing is remembered.
+"""
+
+import json
+import os
+import sys
+import time
+
+from .cache import default_cache_dir, write_json
+
+DEFAULT_MAX_AGE = 30 * 60
+
+_FIELDS = set(['address', 'boot', 'time'])
+
+def default_addresses_path():
+    return default_cache_dir().joinpath('addresses.json')
+
+def boot_id(vmx):
+    """Return something that changes every time the VM vmx starts, or None."""
+    try:
+        return os.stat(os.path.join(os.path.dirname(vmx),
+                                    'vmware.log')).st_ino
+    except OSError:
+        return None
+
+class AddressCache(object):
+    """
+    Guest addresses by .vmx path, saved in filename, or only in memory if
+    filename is None.
+    """
+
+    def __init__(self, filename=None, max_age=DEFAULT_MAX_AGE,
+                 clock=time.time):
+        self.filename = filename
+        self.max_age = max_age
+        self.clock = clock
+        self._memory = {}
+
+    def get(self, vmx):
+        """Return the address remembered for vmx, or None."""
+        entry = self._read().get(vmx)
+        if entry is None:
+            return None
+        if (entry['boot'] != boot_id(vmx)
+            or not 0 <= self.clock() - entry['time'] < self.max_age):
+            return None
+        return entry['address']
+
+    def set(self, vmx, address):
+        boot = boot_id(vmx)
+        if boot is None:
+            return
+        self._update(vmx, {'address': address, 'boot': boot,
+                           'time': self.clock()})
+
+    def forget(self, vmx):
+        """Forget vmx's address, for example when it didn't work."""
+        self._update(vmx, None)
+
+    def _read(self):
+        if self.filename is None:
+            return self._memory
+        try:
+            with open(self.filename, 'rb') as f:
+                entries = json.load(f)
+        except (IOError, ValueError):
+            return {}
+        if not isinstance(entries, dict):
+            return {}
+        return dict((vmx, entry) for (vmx, entry) in entries.items()
+                    if isinstance(entry, dict) and _FIELDS <= set(entry))
+
+    def _update(self, vmx, entry):
+        entries = self._read()
+        if entry is None:
+            if vmx not in entries:
+                return
+            del entries[vmx]
+        else:
+            entries[vmx] = entry
+        # Addresses that have expired anyway
+        now = self.clock()
+        for (key, value) in entries.items():
+            if not 0 <= now - value['time'] < self.max_age:
+                del entries[key]
+        if self.filename is None:
+            self._memory = entries
+            return
+        try:
+            write_json(self.filename, entries)
+        except (IOError, OSError), e:
+            # Remembering addresses only saves time.
+            print >>sys.stderr, 'Could not save guest addresses %s: %s' % (
+                self.filename, e)
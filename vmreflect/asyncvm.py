@@ -0,0 +1,287 @@
+"""
+Asynchronous calls to a VM, with a limit on how many of its backend
+operations are in flight, per VM and across all of them.
+
+There is no asyncio in Python 2, so AsyncVM runs the blocking VM methods
+on a small pool of worker threads instead: calling any VM method on an
+AsyncVM returns a Call straight away, whose result() waits for it.
+
+The limits are enforced by Limiters, which the VM consults around every
+backend operation, whatever thread it comes from. A Tunnel given an
+AsyncVM runs its setup steps on its own pipeline threads, but they still
+count against the same limits.
+
+Cancelling a Call that hasn't started means it never runs. Cancelling one
+that is running raises Cancelled in it at its next backend operation,
+once, so that the VM method's own cleanup, such as deleting its guest
+directory, still gets to run.
+"""
+
+import Queue
+import sys
+import threading
+from contextlib import contextmanager
+
+class Cancelled(Exception):
+    """The result of a Call that was cancelled."""
+    pass
+
+_current = threading.local()
+
+class Limiter(object):
+    """
+    Allows at most limit operations at once, and, if parent is a Limiter,
+    no more than parent allows either.
+    """
+
+    def __init__(self, limit, parent=None):
+        self.limit = limit
+        self.parent = parent
+        self.in_flight = 0
+        self._condition = threading.Condition()
+
+    def _chain(self):
+        limiter = self
+        while limiter is not None:
+            yield limiter
+            limiter = limiter.parent
+
+    @contextmanager
+    def slot(self):
+        """
+        Hold a slot in this limiter and its parents while the block runs.
+        Raises Cancelled instead if the Call running on this thread is
+        cancelled before or while it waits.
+        """
+        call = getattr(_current, 'call', None)
+        acquired = []
+        try:
+            for limiter in self._chain():
+                limiter._acquire(call)
+                acquired.append(limiter)
+            yield
+        finally:
+            for limiter in reversed(acquired):
+                limiter._release()
+
+    def _acquire(self, call):
+        with self._condition:
+            while True:
+                if call is not None and call._take_cancel():
+                    raise Cancelled()
+                if self.in_flight < self.limit:
+                    break
+                self._condition.wait()
+            self.in_flight += 1
+
+    def _release(self):
+        with self._condition:
+            self.in_flight -= 1
+            self._condition.notify_all()
+
+    def wake(self):
+        """Have waiting operations check whether they were cancelled."""
+        for limiter in self._chain():
+            with limiter._condition:
+                limiter._condition.notify_all()
+
+# Shared by every AsyncVM that isn't given another one
+default_limiter = Limiter(8)
+
+PENDING = 'pending'
+RUNNING = 'running'
+FINISHED = 'finished'
+
+class Call(object):
+    """The eventual result of a function run by an AsyncVM."""
+
+    def __init__(self, limiter, func, args, kwargs):
+        self.state = PENDING
+        self._limiter = limiter
+        self._func = func
+        self._args = args
+        self._kwargs = kwargs
+        self._result = None
+        self._exc_info = None
+        self._cancel_requested = False
+        self._cancel_raised = False
+        self._callbacks = []
+        self._lock = threading.Lock()
+        self._done = threading.Event()
+
+    def done(self):
+        return self._done.is_set()
+
+    def cancelled(self):
+        return (self.done() and self._exc_info is not None
+                and isinstance(self._exc_info[1], Cancelled))
+
+    def cancel(self):
+        """
+        Stop the call, or make it stop at its next backend operation.
+        Returns False if it had already finished.
+        """
+        with self._lock:
+            if self.state == FINISHED:
+                return False
+            self._cancel_requested = True
+            if self.state == PENDING:
+                self._cancel_raised = True
+                pending = True
+            else:
+                pending = False
+        if pending:
+            self._finish(None, (Cancelled, Cancelled(), None))
+        else:
+            self._limiter.wake()
+        return True
+
+    def result(self, timeout=None):
+        """
+        Wait for the call and return what it returned, or raise what it
+        raised. Raises Queue.Empty if it is still running after timeout
+        seconds.
+        """
+        if timeout is None:
+            # Short finite waits keep it interruptible by ^C.
+            while not self._done.wait(3600):
+                pass
+        else:
+            self._done.wait(timeout)
+        if not self.done():
+            raise Queue.Empty('call still running after %s seconds'
+                              % timeout)
+        if self._exc_info is not None:
+            raise self._exc_info[0], self._exc_info[1], self._exc_info[2]
+        return self._result
+
+    def exception(self, timeout=None):
+        """Wait for the call and return what it raised, or None."""
+        try:
+            self.result(timeout)
+        except Queue.Empty:
+            raise
+        except Exception, e:
+            return e
+        return None
+
+    def add_done_callback(self, func):
+        """Call func(call) when the call finishes, on the thread it ran on."""
+        with self._lock:
+            if self.state != FINISHED:
+                self._callbacks.append(func)
+                return
+        func(self)
+
+    def _take_cancel(self):
+        with self._lock:
+            if self._cancel_requested and not self._cancel_raised:
+                self._cancel_raised = True
+                return True
+            return False
+
+    def _run(self):
+        with self._lock:
+            if self.state != PENDING:
+                return
+            self.state = RUNNING
+        _current.call = self
+        try:
+            result = (self._func(*self._args, **self._kwargs), None)
+        except:
+            result = (None, sys.exc_info())
+        finally:
+            _current.call = None
+        self._finish(*result)
+
+    def _finish(self, result, exc_info):
+        with self._lock:
+            if self.state == FINISHED:
+                return
+            self.state = FINISHED
+            self._result = result
+            self._exc_info = exc_info
+            callbacks = self._callbacks
+            self._callbacks = []
+        self._done.set()
+        for func in callbacks:
+            func(self)
+
+class AsyncVM(object):
+    """
+    Runs the methods of vm, a vmapi.VM, asynchronously: asyncvm.name(...)
+    calls vm.name(...) on a worker thread and returns a Call.
+
+    At most limit backend operations for vm are in flight at once, and
+    no more than global_limiter, by default default_limiter, allows
+    across every VM. Attributes that aren't methods are vm's own.
+    """
+
+    def __init__(self, vm, limit=4, global_limiter=None):
+        self.vm = vm
+        self.limiter = Limiter(limit, global_limiter or default_limiter)
+        vm.limiter = self.limiter
+        self._queue = Queue.Queue()
+        self._workers = [threading.Thread(target=self._work)
+                         for i in range(limit)]
+        self._calls = set()
+        self._lock = threading.Lock()
+        self._closed = False
+        for worker in self._workers:
+            worker.daemon = True
+            worker.start()
+
+    def __getattr__(self, name):
+        attr = getattr(self.vm, name)
+        if name.startswith('__') or not callable(attr):
+            return attr
+        def method(*args, **kwargs):
+            return self.submit(attr, *args, **kwargs)
+        method.__name__ = name
+        method.__doc__ = attr.__doc__
+        return method
+
+    def submit(self, func, *args, **kwargs):
+        """
+        Call func(*args, **kwargs) on a worker thread and return a Call.
+        func would normally be a few VM methods that need to run in order.
+        """
+        call = Call(self.limiter, func, args, kwargs)
+        with self._lock:
+            if self._closed:
+                raise Exception('AsyncVM is closed')
+            self._calls.add(call)
+        call.add_done_callback(self._forget)
+        self._queue.put(call)
+        return call
+
+    def _forget(self, call):
+        with self._lock:
+            self._calls.discard(call)
+
+    def _work(self):
+        while True:
+            call = self._queue.get()
+            if call is None:
+                return
+            call._run()
+
+    def close(self, cancel=False):
+        """
+        Wait for the calls made so far, or cancel them if cancel is true,
+        and then close the VM's backend.
+        """
+        with self._lock:
+            self._closed = True
+            calls = list(self._calls)
+        if cancel:
+            for call in calls:
+                call.cancel()
+        for worker in self._workers:
+            self._queue.put(None)
+        for worker in self._workers:
+            # With a timeout, so that ^C still works
+            while worker.is_alive():
+                worker.join(1)
+        self.vm.limiter = None
+        self.vm.close()
@@ -0,0 +1,206 @@
+"""
+Reading and writing Microsoft cabinet (.cab) files.
+
+A stock Windows guest can unpack cabinets with expand.exe and create them
+with makecab.exe, so they are how many files are moved to or from a guest
+in one copy. Only what that needs is supported: a single cabinet with one
+folder, either stored or MSZIP-compressed.
+
+MSZIP compresses each block of up to 32KB as its own deflate stream, but
+one that may refer back to the block before it. zlib in Python 2 can't be
+given that history directly, so it is fed to the compressor and thrown
+away, and fed to the decompressor as a stored deflate block.
+"""
+
+import struct
+import time
+import zlib
+
+_SIGNATURE = 'MSCF'
+
+# Flags in the header
+_PREV_CABINET = 0x0001
+_NEXT_CABINET = 0x0002
+_RESERVE_PRESENT = 0x0004
+
+COMPRESS_NONE = 0
+COMPRESS_MSZIP = 1
+
+_ATTRIB_ARCHIVE = 0x20
+_ATTRIB_NAME_IS_UTF = 0x80
+
+_BLOCK_SIZE = 32768
+
+_HEADER = struct.Struct('<4sIIIIIBBHHHHH')
+_FOLDER = struct.Struct('<IHH')
+_FILE = struct.Struct('<IIHHHH')
+_DATA = struct.Struct('<IHH')
+
+class CabError(Exception):
+    """Raised for cabinets that are corrupt or can't be read."""
+    pass
+
+def _checksum(data, seed=0):
+    # The cabinet checksum: the data XORed together as little-endian
+    # 32-bit words, with the bytes left over at the end taken big-endian.
+    count = len(data) // 4
+    csum = seed
+    for word in struct.unpack_from('<%dI' % count, data):
+        csum ^= word
+    extra = 0
+    for c in data[count * 4:]:
+        extra = (extra << 8) | ord(c)
+    return csum ^ extra
+
+def _dos_date_time(timestamp):
+    t = time.localtime(timestamp)
+    return ((max(t.tm_year - 1980, 0) << 9) | (t.tm_mon << 5) | t.tm_mday,
+            (t.tm_hour << 11) | (t.tm_min << 5) | (t.tm_sec // 2))
+
+def _mszip_block(history, block):
+    compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED,
+                                  -zlib.MAX_WBITS)
+    if history:
+        compressor.compress(history)
+        compressor.flush(zlib.Z_SYNC_FLUSH)
+    return 'CK' + compressor.compress(block) + compressor.flush()
+
+def _unmszip_block(history, data):
+    if not data.startswith('CK'):
+        raise CabError('bad MSZIP block signature')
+    decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+    try:
+        if history:
+            # A stored block that isn't the last one
+            decompressor.decompress('\0' + struct.pack(
+                '<HH', len(history), len(history) ^ 0xffff) + history)
+        return decompressor.decompress(data[2:]) + decompressor.flush()
+    except zlib.error, e:
+        raise CabError('bad MSZIP block: %s' % e)
+
+def pack(files, compression=COMPRESS_MSZIP, timestamp=None):
+    """
+    Return a cabinet holding files, a list of (name, data) pairs, dated
+    timestamp, by default now.
+    """
+    files = list(files)
+    if len(files) > 0xffff:
+        raise ValueError('too many files for one cabinet')
+    (date, time_) = _dos_date_time(timestamp or time.time())
+
+    entries = []
+    offset = 0
+    for (name, data) in files:
+        attribs = _ATTRIB_ARCHIVE
+        if isinstance(name, unicode):
+            name = name.encode('utf-8')
+            attribs |= _ATTRIB_NAME_IS_UTF
+        entries.append(_FILE.pack(len(data), offset, 0, date, time_,
+                                  attribs) + name + '\0')
+        offset += len(data)
+    if offset > 0x7fffffff:
+        raise ValueError('too much data for one cabinet')
+
+    contents = ''.join(data for (_, data) in files)
+    blocks = []
+    history = ''
+    for start in range(0, len(contents), _BLOCK_SIZE):
+        block = contents[start:start + _BLOCK_SIZE]
+        if compression == COMPRESS_MSZIP:
+            packed = _mszip_block(history, block)
+        else:
+            packed = block
+        sizes = struct.pack('<HH', len(packed), len(block))
+        blocks.append(struct.pack('<I', _checksum(sizes, _checksum(packed)))
+                      + sizes + packed)
+        history = block
+    if len(blocks) > 0xffff:
+        raise ValueError('too much data for one cabinet')
+
+    files_offset = _HEADER.size + _FOLDER.size
+    data_offset = files_offset + sum(len(e) for e in entries)
+    size = data_offset + sum(len(b) for b in blocks)
+    header = _HEADER.pack(_SIGNATURE, 0, size, 0, files_offset, 0, 3, 1,
+                          1, len(files), 0, 0, 0)
+    folder = _FOLDER.pack(data_offset, len(blocks), compression)
+    return ''.join([header, folder] + entries + blocks)
+
+def _string(cabinet, offset):
+    end = cabinet.find('\0', offset)
+    if end < 0:
+        raise CabError('unterminated string')
+    return (cabinet[offset:end], end + 1)
+
+def unpack(cabinet):
+    """Return the files in cabinet as a list of (name, data) pairs."""
+    try:
+        return _unpack(cabinet)
+    except struct.error, e:
+        raise CabError('truncated cabinet: %s' % e)
+
+def _unpack(cabinet):
+    (signature, _, _, _, files_offset, _, minor, major, folder_count,
+     file_count, flags, _, _) = _HEADER.unpack_from(cabinet)
+    if signature != _SIGNATURE:
+        raise CabError('not a cabinet')
+    if (major, minor) != (1, 3):
+        raise CabError('unsupported cabinet version %d.%d' % (major, minor))
+    if flags & (_PREV_CABINET | _NEXT_CABINET):
+        raise CabError('cabinets that span several files are unsupported')
+    offset = _HEADER.size
+    (folder_reserve, data_reserve) = (0, 0)
+    if flags & _RESERVE_PRESENT:
+        (header_reserve, folder_reserve, data_reserve) = struct.unpack_from(
+            '<HBB', cabinet, offset)
+        offset += 4 + header_reserve
+
+    folders = []
+    for i in range(folder_count):
+        folders.append(_FOLDER.unpack_from(cabinet, offset))
+        offset += _FOLDER.size + folder_reserve
+
+    contents = []
+    for (data_offset, block_count, compression) in folders:
+        compression &= 0x000f
+        if compression not in (COMPRESS_NONE, COMPRESS_MSZIP):
+            raise CabError('unsupported compression type %d' % compression)
+        blocks = []
+        history = ''
+        for i in range(block_count):
+            (csum, packed_size, size) = _DATA.unpack_from(cabinet,
+                                                          data_offset)
+            start = data_offset + _DATA.size + data_reserve
+            packed = cabinet[start:start + packed_size]
+            if len(packed) != packed_size:
+                raise CabError('truncated cabinet')
+            if csum and csum != _checksum(
+                    cabinet[data_offset + 4:data_offset + 8],
+                    _checksum(packed)):
+                raise CabError('bad checksum in data block')
+            if compression == COMPRESS_MSZIP:
+                block = _unmszip_block(history, packed)
+            else:
+                block = packed
+            if len(block) != size:
+                raise CabError('data block is the wrong size')
+            blocks.append(block)
+            history = (history + block)[-_BLOCK_SIZE:]
+            data_offset = start + packed_size
+        contents.append(''.join(blocks))
+
+    files = []
+    offset = files_offset
+    for i in range(file_count):
+        (file_size, folder_offset, folder, _, _, attribs) = \
+            _FILE.unpack_from(cabinet, offset)
+        (name, offset) = _string(cabinet, offset + _FILE.size)
+        if attribs & _ATTRIB_NAME_IS_UTF:
+            name = name.decode('utf-8')
+        if folder >= len(contents):
+            raise CabError('%s is in a folder that is not in this cabinet'
+                           % name)
+        data = contents[folder][folder_offset:folder_offset + file_size]
+        if len(data) != file_size:
+            raise CabError('%s is truncated' % name)
+        files.append((name, data))
+    return files
@@ -0,0 +1,135 @@
+"""
+A cache on the host of files extracted from the bundled archives, so that
+tcpr.exe is unzipped once rather than for every tunnel.
+
+Each archive gets a directory named after the SHA-1 of its contents, so an
+upgraded archive never reuses stale files. The cache lives in
+$VMREFLECT_CACHE_DIR, or ~/.cache/vmreflect if that isn't set. When it
+grows past max_size bytes, the least recently used archives' directories
+are removed.
+"""
+
+import errno
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import zipfile
+
+from path import path
+
+DEFAULT_MAX_SIZE = 64 * 1024 * 1024
+
+_CHUNK_SIZE = 64 * 1024
+
+def default_cache_dir():
+    return path(os.environ.get('VMREFLECT_CACHE_DIR')
+                or os.path.expanduser('~/.cache/vmreflect'))
+
+def file_sha1(filename):
+    digest = hashlib.sha1()
+    with open(filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(_CHUNK_SIZE), ''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def link_or_copy(src, dst):
+    """Hard-link src to dst, falling back to copying it."""
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copy(src, dst)
+
+def _tree_size(directory):
+    size = 0
+    for f in directory.walkfiles():
+        try:
+            size += f.size
+        except OSError:
+            # Removed by another process since it was listed
+            pass
+    return size
+
+def _make_dirs(directory):
+    try:
+        os.makedirs(directory, 0700)
+    except OSError, e:
+        if e.errno != errno.EEXIST:
+            raise
+
+def write_json(filename, obj):
+    """
+    Save obj to filename as JSON, replacing the file in one step so that
+    other processes never see it half written.
+    """
+    directory = path(filename).parent
+    _make_dirs(directory)
+    (fd, temp_name) = tempfile.mkstemp(dir=directory, prefix='.json')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            json.dump(obj, f)
+        os.rename(temp_name, filename)
+    except:
+        os.unlink(temp_name)
+        raise
+
+class Cache(object):
+
+    def __init__(self, directory=None, max_size=DEFAULT_MAX_SIZE):
+        self.directory = path(directory or default_cache_dir())
+        self.max_size = max_size
+
+    def extract(self, archive, member):
+        """
+        Return the path of a cached copy of member from the zip file
+        archive, extracting it first if it isn't cached yet.
+        """
+        entry = self.directory.joinpath(file_sha1(archive))
+        cached = entry.joinpath(os.path.basename(member))
+        if cached.isfile():
+            # The entry's mtime is its last use, for eviction.
+            os.utime(entry, None)
+            return cached
+
+        _make_dirs(entry)
+        # Extract under a temporary name and rename, so that the cached
+        # name only ever refers to a complete file, even with several
+        # processes extracting at once.
+        (fd, temp_name) = tempfile.mkstemp(dir=entry, prefix='.extract')
+        try:
+            with os.fdopen(fd, 'wb') as out:
+                with zipfile.ZipFile(archive) as zf:
+                    src = zf.open(member)
+                    try:
+                        shutil.copyfileobj(src, out, _CHUNK_SIZE)
+                    finally:
+                        src.close()
+            os.chmod(temp_name, 0600)
+            os.rename(temp_name, cached)
+        except:
+            os.unlink(temp_name)
+            raise
+
+        self.evict(keep=entry)
+        return cached
+
+    def evict(self, keep=None):
+        """
+        Remove the least recently used entries, other than keep, until the
+        cache is no larger than max_size.
+        """
+        entries = []
+        total = 0
+        for entry in self.directory.dirs():
+            size = _tree_size(entry)
+            entries.append((entry.mtime, size, entry))
+            total += size
+
+        for (mtime, size, entry) in sorted(entries):
+            if total <= self.max_size:
+                break
+            if entry == keep:
+                continue
+            shutil.rmtree(entry, ignore_errors=True)
+            total -= size
@@ -0,0 +1,210 @@
+"""
+The vmreflect command. Modules that take a while to import are only
+imported once the arguments have been parsed, and only by the subcommands
+that use them, so that --help and mistakes in the arguments are answered
+right away.
+"""
+
+import argparse
+import sys
+
+from .utils import format_ports, parse_ports
+
+# The ports a daemon's tunnel can forward
+DAEMON_PORT_RANGE = (1024, 65535)
+
+def _port_list(spec):
+    try:
+        return parse_ports(spec)
+    except ValueError, e:
+        raise argparse.ArgumentTypeError(str(e))
+
+def _merge_ports(port_lists):
+    ports = []
+    for port in sum(port_lists, []):
+        if port not in ports:
+            ports.append(port)
+    return ports
+
+_CONTROL_COMMANDS = ['add-port', 'remove-port', 'status', 'shutdown']
+
+def control_main(args):
+    """Send a command to a running vmreflect --daemon."""
+    parser = argparse.ArgumentParser(prog='vmreflect')
+    parser.add_argument('command', choices=_CONTROL_COMMANDS)
+    parser.add_argument('ports', type=_port_list, nargs='*',
+                        help="""For add-port and remove-port, the ports as
+                        for --port.""")
+    parser.add_argument('--control', metavar='PATH',
+                        help='The daemon\'s control socket')
+    args = parser.parse_args(args=args)
+    kwargs = {}
+    if args.command in ('add-port', 'remove-port'):
+        if not args.ports:
+            parser.error('%s needs a port' % args.command)
+        kwargs['ports'] = _merge_ports(args.ports)
+    elif args.ports:
+        parser.error('%s takes no ports' % args.command)
+    from .daemon import DaemonError, default_control_path, send_command
+    try:
+        reply = send_command(args.control or default_control_path(),
+                             args.command, **kwargs)
+    except DaemonError, e:
+        print >>sys.stderr, 'vmreflect: %s' % e
+        return 1
+    if args.command == 'status':
+        print 'Server %s, up %ds, %d connections so far.' % (
+            reply['server'], reply['uptime'], reply['connections'])
+        if reply.get('probe_latency') is not None:
+            print 'Probes take %.0fms on average; %d repairs so far.' % (
+                reply['probe_latency'] * 1000, reply['repairs'])
+    if args.command != 'shutdown':
+        if reply['ports']:
+            print 'Forwarding %s.' % format_ports(reply['ports'])
+        else:
+            print 'Not forwarding any ports.'
+    return 0
+
+def list_vms_main(args):
+    """List the VMs that can be given by name."""
+    parser = argparse.ArgumentParser(prog='vmreflect list-vms')
+    parser.add_argument('--refresh', action='store_true',
+                        help="""Search the VM folders again instead of
+                        trusting the saved index.""")
+    args = parser.parse_args(args=args)
+    from .library import default_library
+    library = default_library()
+    if args.refresh:
+        library.refresh()
+    entries = library.entries()
+    if not entries:
+        print >>sys.stderr, 'vmreflect: no VMs found in %s' % ', '.join(
+            library.dirs)
+        return 1
+    names = [e.display_name or e.vmx.namebase for e in entries]
+    width = max(len(name) for name in names)
+    for (name, entry) in zip(names, entries):
+        print '%-*s  %s' % (width, name, entry.vmx)
+    return 0
+
+def gc_main(args):
+    """Remove what earlier tunnels left behind in a guest."""
+    parser = argparse.ArgumentParser(prog='vmreflect gc')
+    parser.add_argument('vm_name', help='The virtual machine to clean up.')
+    parser.add_argument('--vm-username', '-u', default='Administrator')
+    parser.add_argument('--vm-password', '-p', default='test')
+    parser.add_argument('--dry-run', '-n', action='store_true',
+                        help="""Only list what would be removed.""")
+    args = parser.parse_args(args=args)
+    from .janitor import find_leftovers, remove_leftovers
+    from .vmapi import VM
+    vm = VM(vm_name=args.vm_name, username=args.vm_username,
+            password=args.vm_password)
+    try:
+        leftovers = find_leftovers(vm)
+        for process in leftovers.processes:
+            print 'Server %d: %s' % (process.pid, process.cmd)
+        for guest_path in leftovers.paths:
+            print guest_path
+        if not (leftovers.processes or leftovers.paths):
+            print 'Nothing to remove.'
+        elif not args.dry_run:
+            remove_leftovers(vm, leftovers)
+            print 'Removed %d servers and %d files and directories.' % (
+                len(leftovers.processes), len(leftovers.paths))
+    finally:
+        vm.close()
+    return 0
+
+def main(args=None):
+    if args is None:
+        args = sys.argv[1:]
+    if args and args[0] in _CONTROL_COMMANDS:
+        return control_main(args)
+    if args and args[0] == 'list-vms':
+        return list_vms_main(args[1:])
+    if args and args[0] == 'gc':
+        return gc_main(args[1:])
+
+    parser = argparse.ArgumentParser(
+        epilog="""With --daemon, the ports forwarded can be changed while
+        the tunnel is open with vmreflect add-port PORTS, vmreflect
+        remove-port PORTS, vmreflect status and vmreflect shutdown.
+        vmreflect list-vms shows the VMs that can be given by name, and
+        vmreflect gc NAME removes what interrupted tunnels left behind in
+        a VM.""")
+    parser.add_argument('vm_name', action='store',
+                       help="""The name of the virtual machine in which to
+                        set up the tunnel, as VMware shows it or as its
+                        folder is named. Can also be the absolute path
+                        to a .vmwarevm directory or .vmx file.""")
+    parser.add_argument('--port', '-P', type=_port_list, action='append',
+                       help="""The port numbers to forward, as a
+                        comma-separated list of ports and ranges such as
+                        3000,8000-8002. Can be given more than once.
+                        Defaults to 8000.""")
+    parser.add_argument('--vm-username', '-u', default='Administrator')
+    parser.add_argument('--vm-password', '-p', default='test',
+                       help="""The Windows username and password of the guest
+                        virtual machine. These are needed to access files
+                        and run programs inside the virtual machine.""")
+    parser.add_argument('--guest-install-dir', metavar='DIR',
+                       help="""A directory in the guest, such as
+                        C:\\vmreflect, in which to keep tcpr.exe so that it
+                        doesn't need to be copied over for every
+                        tunnel.""")
+    parser.add_argument('--verbose', '-v', action='store_true',
+                       help="""Print how long each step of setting up the
+                        tunnel took.""")
+    parser.add_argument('--ready-timeout', type=float, default=60,
+                       metavar='SECONDS',
+                       help="""How long to wait for the server in the
+                        guest to accept connections and forwards, once it
+                        has been started. Defaults to %(default)s.""")
+    parser.add_argument('--health-interval', type=float, metavar='SECONDS',
+                       help="""Once the tunnel is open, probe it every
+                        SECONDS seconds, and set up again whatever part of
+                        it has broken instead of closing it.""")
+    parser.add_argument('--daemon', '-d', action='store_true',
+                       help="""Keep the tunnel open, and accept commands
+                        to forward more ports or stop forwarding them.""")
+    parser.add_argument('--control', metavar='PATH',
+                       help="""Where the daemon listens for commands.
+                        Defaults to control.sock in the cache directory,
+                        ~/.cache/vmreflect or $VMREFLECT_CACHE_DIR.""")
+    parser.add_argument('--trace', metavar='FILE',
+                       help="""Record how long each vmrun operation, console
+                        command and setup step took, and write them to
+                        FILE when the tunnel closes: as JSON lines if FILE
+                        ends in .jsonl, and otherwise in the Chrome
+                        trace-event format, for chrome://tracing.""")
+    args = parser.parse_args(args=args)
+    # Only now that the arguments are known to be good
+    from . import trace
+    from .daemon import Daemon
+    from .tunnel import Tunnel
+    if args.trace:
+        trace.start()
+    port_range = None
+    if args.daemon:
+        port_range = DAEMON_PORT_RANGE
+    tunnel = Tunnel(vm_name=args.vm_name,
+                    port=_merge_ports(args.port or [[8000]]),
+                    username=args.vm_username,
+                    password=args.vm_password,
+                    verbose=args.verbose,
+                    guest_install_dir=args.guest_install_dir,
+                    port_range=port_range,
+                    ready_timeout=args.ready_timeout,
+                    health_interval=args.health_interval)
+    try:
+        if args.daemon:
+            Daemon(tunnel, args.control).serve()
+        else:
+            # The guest is cleaned up in the background, so that ^C
+            # returns straight away.
+            tunnel.start(detach=True)
+    finally:
+        if args.trace:
+            trace.stop().save(args.trace)
+            print 'Trace written to %s' % args.trace
@@ -0,0 +1,179 @@
+"""
+A client for the tcpr server's admin console, which stays logged in so
+that any number of commands can be sent over one connection.
+
+Commands are lines ending in \\r\\n. The server answers each one, in order,
+with zero or more lines followed by an empty line, so several commands can
+be sent before reading any of the replies. Most replies end with a line
+starting with a three-digit status code, 250 for success.
+"""
+
+import re
+import socket
+import threading
+import time
+from collections import namedtuple
+
+from . import tcpr, trace
+
+ConsoleReply = namedtuple('ConsoleReply', 'code lines')
+ListedReflector = namedtuple('ListedReflector',
+                             'class_name hostname node_id name forwards')
+ListedForward = namedtuple('ListedForward', 'id protocol name port')
+
+_LISTENING = re.compile(r'250 forwarder listening on [\d.]+:(\d+)$')
+_LIST_FORWARD = re.compile(
+    r'\s+#(\d+) (\S+) (\S+)(?: listening on port (\d+))?$')
+
+class ConsoleError(Exception):
+
+    def __init__(self, message, reply=None):
+        Exception.__init__(self, message)
+        self.reply = reply
+
+def parse_reply(lines):
+    """Return a ConsoleReply for the lines of one reply."""
+    code = None
+    if lines and re.match(r'\d{3}( |$)', lines[-1]):
+        code = int(lines[-1][:3])
+    return ConsoleReply(code, lines)
+
+def listening_port(reply):
+    """Return the port a successful start reply says it is listening on."""
+    match = _LISTENING.match(reply.lines[-1] if reply.lines else '')
+    if match is None:
+        return None
+    return int(match.group(1))
+
+def parse_list(reply):
+    """Return the reflectors in a reply to list, with their forwards."""
+    reflectors = []
+    for line in reply.lines:
+        match = _LIST_FORWARD.match(line)
+        if match:
+            (forward_id, protocol, name, port) = match.groups()
+            reflectors[-1].forwards.append(ListedForward(
+                int(forward_id), protocol, name, port and int(port)))
+        elif line[:1].isdigit():
+            # The status line at the end
+            pass
+        else:
+            (class_name, hostname, node_id, name) = line.split()
+            reflectors.append(ListedReflector(class_name, hostname, node_id,
+                                              name, []))
+    return reflectors
+
+class Console(object):
+    """
+    Logged in as user.<username> to the console at address once connect()
+    is called. Safe to use from several threads.
+    """
+
+    def __init__(self, address, username, password, timeout=30):
+        self.address = address
+        self.username = username
+        self.password = password
+        self.timeout = timeout
+        self.sock = None
+        self.welcome = None
+        self.commands_sent = 0
+        self._lock = threading.Lock()
+
+    def connect(self):
+        sock = socket.create_connection(self.address, self.timeout)
+        try:
+            (_, self._reader) = tcpr.authenticate(sock, 'user.'
+                                                  + self.username,
+                                                  self.password)
+            self.sock = sock
+            self.welcome = self._read_reply().lines
+        except:
+            self.sock = None
+            sock.close()
+            raise
+
+    def close(self):
+        with self._lock:
+            if self.sock is None:
+                return
+            try:
+                self.sock.sendall('quit\r\n')
+            except socket.error:
+                pass
+            self.sock.close()
+            self.sock = None
+
+    def run(self, commands):
+        """
+        Send all of commands at once, and return a ConsoleReply for each
+        of them.
+        """
+        with self._lock:
+            if self.sock is None:
+                raise ConsoleError('not connected to the console')
+            for command in commands:
+                if '\n' in command or '\r' in command:
+                    raise ValueError('bad console command %r' % command)
+            tracer = trace.tracer
+            start = time.time()
+            try:
+                self.sock.sendall(''.join(c + '\r\n' for c in commands))
+                self.commands_sent += len(commands)
+                replies = [self._read_reply() for c in commands]
+                if tracer is not None:
+                    tracer.add(commands[0].split(' ', 1)[0], 'console',
+                               start, time.time() - start, commands,
+                               replies[-1].code)
+                return replies
+            except:
+                # Replies to the rest of the commands would be taken as
+                # replies to later ones.
+                self.sock.close()
+                self.sock = None
+                raise
+
+    def command(self, command):
+        [reply] = self.run([command])
+        return reply
+
+    def add_client(self, name, password, groups=('clients',)):
+        reply = self.command('client add %s %s %s'
+                             % (name, password, ' '.join(groups)))
+        if reply.lines != ['client %s added' % name]:
+            raise ConsoleError('could not add client %s: %s'
+                               % (name, ' '.join(reply.lines)), reply)
+
+    def list(self):
+        return parse_list(self.command('list'))
+
+    def start(self, forward_id, port):
+        """Start forward_id listening on port for any host."""
+        [reply] = self.start_many([(forward_id, port)])
+        if listening_port(reply) is None:
+            raise ConsoleError('could not start forward %d: %s'
+                               % (forward_id, ' '.join(reply.lines)), reply)
+        return listening_port(reply)
+
+    def start_many(self, forwards):
+        """
+        Start each (forward_id, port) in forwards, returning the replies.
+        """
+        return self.run(['start %d * p=%d' % (forward_id, port)
+                         for (forward_id, port) in forwards])
+
+    def stop(self, forward_id):
+        reply = self.command('stop %d' % forward_id)
+        if reply.code != 250:
+            raise ConsoleError('could not stop forward %d: %s'
+                               % (forward_id, ' '.join(reply.lines)), reply)
+
+    def _read_reply(self):
+        lines = []
+        while True:
+            line = self._reader.read_until('\r\n')[:-2]
+            if not line:
+                # The welcome message starts with an empty line.
+                if lines or self.welcome is not None:
+                    return parse_reply(lines)
+                continue
+            lines.append(line)
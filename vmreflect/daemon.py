@@ -0,0 +1,181 @@
+"""
+Keeps a tunnel open in the background and lets other vmreflect commands
+change which ports it forwards, through a Unix socket on the host.
+
+Each request on the control socket is one line of JSON with a command and
+its arguments, and gets one line of JSON back, with ok set to true or
+false and error holding the message if it failed.
+"""
+
+import errno
+import json
+import os
+import socket
+import threading
+import time
+
+from path import path
+
+from .cache import _make_dirs, default_cache_dir
+
+class DaemonError(Exception):
+    pass
+
+def default_control_path():
+    return default_cache_dir().joinpath('control.sock')
+
+def send_command(control_path, command, **kwargs):
+    """
+    Send command to the daemon listening on control_path, returning its
+    reply. Raise DaemonError if no daemon is running or the command fails.
+    """
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        try:
+            sock.connect(control_path)
+        except socket.error, e:
+            raise DaemonError('no daemon running at %s: %s'
+                              % (control_path, e.strerror or e))
+        kwargs['command'] = command
+        sock.sendall(json.dumps(kwargs) + '\n')
+        reply = sock.makefile('rb').readline()
+    finally:
+        sock.close()
+    if not reply:
+        raise DaemonError('daemon closed the connection')
+    reply = json.loads(reply)
+    if not reply.get('ok'):
+        raise DaemonError(reply.get('error', 'unknown error'))
+    return reply
+
+class Daemon(object):
+    """
+    Runs tunnel, a Tunnel, until it is shut down, answering commands on a
+    Unix socket at control_path.
+    """
+
+    def __init__(self, tunnel, control_path=None):
+        self.tunnel = tunnel
+        self.control_path = path(control_path or default_control_path())
+        self.start_time = None
+        self._error = []
+
+    def serve(self):
+        listener = self._listen()
+        started = threading.Event()
+        thread = threading.Thread(target=self._run_tunnel, args=(started,))
+        thread.daemon = True
+        try:
+            thread.start()
+            while not started.is_set() and thread.is_alive():
+                started.wait(1)
+            if started.is_set():
+                self.start_time = time.time()
+                print 'Listening for commands on %s.' % self.control_path
+                self._accept_commands(listener, thread)
+        finally:
+            # Let the tunnel clean up, even after ^C
+            self.tunnel.stop()
+            listener.close()
+            try:
+                self.control_path.remove()
+            except OSError:
+                pass
+            # With a timeout, so that ^C still works
+            while thread.is_alive():
+                thread.join(1)
+        if self._error:
+            raise self._error[0]
+
+    def _run_tunnel(self, started):
+        try:
+            self.tunnel.start(started_event=started)
+        except Exception, e:
+            self._error.append(e)
+
+    def _listen(self):
+        _make_dirs(self.control_path.parent)
+        if self.control_path.exists():
+            # Left behind by a daemon that didn't exit cleanly?
+            try:
+                send_command(self.control_path, 'status')
+            except DaemonError:
+                self.control_path.remove()
+            else:
+                raise DaemonError('a daemon is already running at %s'
+                                  % self.control_path)
+        # The socket only appears at control_path once it is listening, so
+        # that another daemon checking for it never takes it to be stale.
+        temp_path = '%s.%d' % (self.control_path, os.getpid())
+        listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            listener.bind(temp_path)
+            listener.listen(5)
+            os.rename(temp_path, self.control_path)
+        except:
+            listener.close()
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+        listener.settimeout(1)
+        return listener
+
+    def _accept_commands(self, listener, thread):
+        while thread.is_alive():
+            try:
+                (sock, _) = listener.accept()
+            except socket.timeout:
+                continue
+            except socket.error, e:
+                if e.errno == errno.EINTR:
+                    continue
+                raise
+            try:
+                sock.settimeout(10)
+                request = sock.makefile('rb').readline()
+                sock.sendall(json.dumps(self.handle(request)) + '\n')
+            except socket.error:
+                pass
+            finally:
+                sock.close()
+
+    def handle(self, request):
+        """Return the reply to request, a line of JSON."""
+        try:
+            request = json.loads(request)
+            command = request.pop('command')
+            handler = getattr(self, '_cmd_' + command.replace('-', '_'),
+                              None)
+            if handler is None:
+                raise DaemonError('unknown command %r' % command)
+            reply = handler(**request)
+        except Exception, e:
+            return {'ok': False, 'error': str(e)}
+        reply['ok'] = True
+        return reply
+
+    def _cmd_status(self):
+        tunnel = self.tunnel
+        reply = {
+            'server': '%s:%d' % (tunnel.server_ip, tunnel.server_port),
+            'ports': tunnel.open_ports,
+            'port_range': list(tunnel.port_range),
+            'uptime': time.time() - self.start_time,
+            'connections': sum(r.tunnels_opened for r in tunnel.relays),
+        }
+        if tunnel.health is not None:
+            reply['probe_latency'] = tunnel.health.latency()
+            reply['repairs'] = tunnel.health.repairs
+        return reply
+
+    def _cmd_add_port(self, ports):
+        return {'added': self.tunnel.add_ports(ports),
+                'ports': self.tunnel.open_ports}
+
+    def _cmd_remove_port(self, ports):
+        self.tunnel.remove_ports(ports)
+        return {'ports': self.tunnel.open_ports}
+
+    def _cmd_shutdown(self):
+        self.tunnel.stop()
+        return {}
@@ -0,0 +1,131 @@
+"""
+Watching an open tunnel, and repairing whichever part of it breaks.
+
+Every interval seconds the monitor probes the tunnel end to end: it checks
+that every relay is still connected to the server in the guest, lists the
+forwards on the server's admin console, and connects to each forwarded
+port in the guest from the host. How long each probe took is kept in
+history.
+
+When a probe fails, only the part that broke is set up again, by
+Tunnel._repair(): a relay whose connection was lost is reconnected and its
+ports forwarded again, forwards that stopped listening are started again
+on the console, a lost console connection is reconnected, and a server
+that is no longer running is started again from the files already in the
+guest. None of these copy anything to the guest, and only the
+last runs a guest command, so repairs take a fraction of the time that
+opening the tunnel did.
+"""
+
+import socket
+import sys
+import threading
+import time
+from collections import deque, namedtuple
+
+from .console import ConsoleError
+
+DEFAULT_INTERVAL = 10
+
+# error is why the probe failed, or None if it didn't, and repaired the
+# parts of the tunnel that were set up again because of it.
+Probe = namedtuple('Probe', 'time latency error repaired')
+
+class ProbeFailed(Exception):
+    pass
+
+_PROBE_ERRORS = (ProbeFailed, ConsoleError, EOFError, socket.error)
+
+class HealthMonitor(object):
+    """
+    Probes tunnel, an open Tunnel, every interval seconds once start() is
+    called, or as soon as wake() is. Each forwarded port is probed at
+    guest_address(port), by default the port on the guest's address.
+    The last history probes are kept.
+    """
+
+    def __init__(self, tunnel, interval=DEFAULT_INTERVAL, timeout=5,
+                 history=100, guest_address=None):
+        self.tunnel = tunnel
+        self.interval = interval
+        self.timeout = timeout
+        self.history = deque(maxlen=history)
+        self.repairs = 0
+        self.guest_address = guest_address or (
+            lambda port: (tunnel.server_ip, port))
+        self._wakeup = threading.Event()
+        self._stopping = False
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """Stop probing, waiting for a repair in progress to finish."""
+        self._stopping = True
+        self._wakeup.set()
+        if (self._thread is not None
+            and self._thread is not threading.current_thread()):
+            self._thread.join()
+
+    def wake(self):
+        """Probe now, for example because a relay has lost its connection."""
+        self._wakeup.set()
+
+    def check(self):
+        """Probe the tunnel once, repair it if need be, and return a Probe."""
+        start = time.time()
+        error = None
+        repaired = ()
+        try:
+            self._probe()
+        except _PROBE_ERRORS, e:
+            error = str(e) or e.__class__.__name__
+        latency = time.time() - start
+        if error is not None:
+            print >>sys.stderr, 'Tunnel probe failed: %s' % error
+            try:
+                repaired = tuple(self.tunnel._repair())
+            except Exception, e:
+                print >>sys.stderr, 'Could not repair the tunnel: %s' % e
+            if repaired:
+                self.repairs += 1
+                print 'Repaired the tunnel (%s) in %.3fs.' % (
+                    ', '.join(repaired), time.time() - start - latency)
+        probe = Probe(start, latency, error, repaired)
+        self.history.append(probe)
+        return probe
+
+    def latency(self):
+        """
+        Return the average latency of the successful probes in history, or
+        None if there aren't any.
+        """
+        latencies = [p.latency for p in self.history if p.error is None]
+        if not latencies:
+            return None
+        return sum(latencies) / len(latencies)
+
+    def _probe(self):
+        tunnel = self.tunnel
+        if tunnel._dead_relays():
+            raise ProbeFailed('a relay lost its connection to the server')
+        tunnel.console.list()
+        for port in list(tunnel.open_ports):
+            try:
+                sock = socket.create_connection(self.guest_address(port),
+                                                self.timeout)
+            except socket.error, e:
+                raise ProbeFailed('could not connect to port %d in the'
+                                  ' guest: %s' % (port, e))
+            sock.close()
+
+    def _run(self):
+        while True:
+            self._wakeup.wait(self.interval)
+            self._wakeup.clear()
+            if self._stopping:
+                return
+            self.check()
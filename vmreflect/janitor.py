@@ -0,0 +1,167 @@
+"""
+Finding and removing what tunnels left behind in a guest.
+
+A tunnel that is killed, or whose cleanup fails or is interrupted, can
+leave its vmwareNNN temporary file and vmwareNNN.d directory in the
+guest's temporary directory, and its tcpr.exe server running. So can a
+batch of commands whose vmreflect-XXXXXXXX.d directory was never removed.
+
+While a tunnel is open, the process that opened it holds leases:
+lease-*.json files in the cache directory naming the guest paths and the
+guest ports it uses. So does a process while a batch, copy or command
+stream of its is using a vmreflect-XXXXXXXX.d directory.
+Leftovers are the vmreflect files and servers in the guest that no living
+process holds a lease on. Finding them takes one listing of the guest's
+processes and one of its temporary directory, and removing them one kill
+per server and then a single guest script that deletes everything
+else.
+"""
+
+import errno
+import json
+import os
+import re
+from collections import namedtuple
+
+from path import path
+
+from .cache import default_cache_dir, write_json
+from .utils import get_random_string
+
+Leftovers = namedtuple('Leftovers', 'processes paths')
+
+# The directories a tunnel and run_batch make in the guest's temporary
+# directory
+_re_leftover_dir = re.compile(r'^(vmware\d+)\.d$|^vmreflect-\w+\.d$', re.I)
+
+# A tcpr server started from a tunnel's directory
+_re_server_ini = re.compile(r'\\(vmware\d+\.d)\\tcpr\.ini\b', re.I)
+
+def _guest_basename(guest_path):
+    return guest_path.rstrip('\\').rpartition('\\')[2].lower()
+
+def _is_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError, e:
+        return e.errno == errno.EPERM
+    return True
+
+def _vmx_key(vmx):
+    # The same VM, however its path is written
+    return os.path.realpath(vmx)
+
+def take_lease(vmx, guest_paths, directory=None, ports=()):
+    """
+    Record, in directory or else the cache directory, that this process
+    is using guest_paths and ports in the VM vmx, and return the lease's
+    filename, for release_lease().
+    """
+    directory = path(directory or default_cache_dir())
+    filename = directory.joinpath('lease-%d-%s.json'
+                                  % (os.getpid(), get_random_string(8)))
+    write_json(filename, {'pid': os.getpid(), 'vmx': _vmx_key(vmx),
+                          'paths': list(guest_paths), 'ports': list(ports)})
+    return filename
+
+def take_over_lease(filename):
+    """
+    Make filename, a lease taken by another process, this process's, for
+    example in a child that the other process leaves its cleanup to.
+    """
+    with open(filename, 'rb') as f:
+        lease = json.load(f)
+    lease['pid'] = os.getpid()
+    write_json(filename, lease)
+
+def release_lease(filename):
+    try:
+        os.unlink(filename)
+    except OSError, e:
+        if e.errno != errno.ENOENT:
+            raise
+
+def _leases(vmx, directory):
+    """
+    Yield the leases that living processes hold in the VM vmx, removing
+    those whose processes have died.
+    """
+    directory = path(directory or default_cache_dir())
+    if not directory.isdir():
+        return
+    for filename in directory.files('lease-*.json'):
+        try:
+            with open(filename, 'rb') as f:
+                lease = json.load(f)
+            (pid, lease_vmx, _) = (lease['pid'], lease['vmx'],
+                                   lease['paths'])
+        except (IOError, ValueError, KeyError, TypeError):
+            # Being written, or removed since the directory was listed
+            continue
+        if not _is_alive(pid):
+            release_lease(filename)
+        elif _vmx_key(lease_vmx) == _vmx_key(vmx):
+            yield lease
+
+def leased_names(vmx, directory=None):
+    """
+    Return the lowercase basenames of the guest paths that living
+    processes hold leases on in the VM vmx.
+    """
+    names = set()
+    for lease in _leases(vmx, directory):
+        names.update(_guest_basename(p) for p in lease['paths'])
+    return names
+
+def leased_ports(vmx, directory=None):
+    """Return the guest ports that living processes hold leases on in vmx."""
+    ports = set()
+    for lease in _leases(vmx, directory):
+        ports.update(lease.get('ports', ()))
+    return ports
+
+def find_leftovers(vm, directory=None):
+    """
+    Return the Leftovers of earlier tunnels in vm, a vmapi.VM, going by the
+    leases in directory or else the cache directory.
+    """
+    temp_dir = vm._temp_dir()
+    names = vm.list_directory(temp_dir)
+    processes = vm.list_processes()
+    # Leases are taken before what they name is made in the guest, so they
+    # are read after the guest is looked at.
+    leased = leased_names(vm.vmx, directory)
+    lowercase_names = set(name.lower() for name in names)
+    paths = []
+    for name in names:
+        match = _re_leftover_dir.match(name)
+        if not match or name.lower() in leased:
+            continue
+        paths.append('%s\\%s' % (temp_dir, name))
+        # The temporary file a tunnel's directory is named after
+        base = match.group(1)
+        if base and base.lower() in lowercase_names:
+            paths.append('%s\\%s' % (temp_dir, base))
+
+    servers = []
+    for process in processes:
+        match = _re_server_ini.search(process.cmd)
+        if match and match.group(1).lower() not in leased:
+            servers.append(process)
+    return Leftovers(servers, paths)
+
+def remove_leftovers(vm, leftovers):
+    """
+    Kill the leftover servers, then delete the leftover files and
+    directories in one guest script.
+    """
+    for process in leftovers.processes:
+        vm.kill_process(process.pid)
+    if leftovers.paths:
+        script = []
+        for guest_path in leftovers.paths:
+            if _re_leftover_dir.match(_guest_basename(guest_path)):
+                script.append('rmdir /s /q "%s"' % guest_path)
+            else:
+                script.append('del /f /q "%s"' % guest_path)
+        vm._run_command_no_output('\r\n'.join(script))
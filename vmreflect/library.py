@@ -0,0 +1,218 @@
+"""
+An index of the virtual machines in the folders VMware keeps them in, so
+that a VM can be found by name without searching the disk every time.
+
+Each .vmx file's displayName is read, so a VM is found by the name VMware
+shows for it even if it was copied and its .vmx file's basename no longer
+matches its folder. A VM can also be found by its folder's name, with or
+without .vmwarevm, its .vmx file's basename, or either path.
+
+The index is saved in the cache directory, and kept in memory once
+loaded, so that finding a VM costs a dictionary lookup and checking the
+mtime of its .vmx file. The index is rebuilt if that .vmx file has
+changed, and, when it is loaded or a name isn't found, if any of the
+folders or .vmx files has changed since it was made.
+
+The folders searched are those in $VMREFLECT_VM_DIRS, separated by
+os.pathsep, or else DEFAULT_DIRS.
+"""
+
+import json
+import os
+import re
+import sys
+from collections import namedtuple
+
+from path import path
+
+from .cache import default_cache_dir, write_json
+
+DEFAULT_DIRS = [
+    '~/Virtual Machines.localized',
+    '~/Documents/Virtual Machines.localized',
+    '~/Documents/Virtual Machines',
+    '~/vmware',
+]
+
+LibraryEntry = namedtuple('LibraryEntry', 'display_name vmx')
+
+_re_display_name = re.compile(r'^\s*displayName\s*=\s*"(.*)"\s*$',
+                              re.M | re.I)
+
+def default_dirs():
+    dirs = os.environ.get('VMREFLECT_VM_DIRS')
+    if dirs:
+        return [path(d).expanduser() for d in dirs.split(os.pathsep) if d]
+    return [path(d).expanduser() for d in DEFAULT_DIRS]
+
+def default_index_path():
+    return default_cache_dir().joinpath('library.json')
+
+def read_display_name(vmx):
+    """Return the displayName from the .vmx file vmx, or None."""
+    try:
+        with open(vmx, 'rb') as f:
+            match = _re_display_name.search(f.read())
+    except IOError:
+        return None
+    return match.group(1) if match else None
+
+def _mtime(filename):
+    try:
+        return os.stat(filename).st_mtime
+    except OSError:
+        return None
+
+def _keys(entry):
+    """
+    The names under which entry can be found, in lowercase, as a list of
+    lists: its display name, then its paths and folder names, then its
+    .vmx file's basename.
+    """
+    vmx = path(entry.vmx)
+    folder = vmx.parent
+    paths = [vmx, folder, folder.basename()]
+    if folder.ext.lower() == '.vmwarevm':
+        paths.extend([folder.stripext(), folder.namebase])
+    return [[entry.display_name.lower()] if entry.display_name else [],
+            [p.lower() for p in paths],
+            [vmx.namebase.lower()]]
+
+class Library(object):
+    """
+    The VMs in dirs, a list of folders, indexed in the file index_path.
+    index_path None keeps the index only in memory.
+    """
+
+    def __init__(self, dirs=None, index_path=None):
+        self.dirs = [path(d) for d in (dirs or default_dirs())]
+        self.index_path = index_path
+        self._entries = None
+        self._by_key = {}
+        # mtime of each scanned folder, when it was scanned
+        self._folders = {}
+        # mtime of each .vmx file, when it was read
+        self._vmx_mtimes = {}
+        self._scanned_dirs = []
+
+    def entries(self):
+        """Return a LibraryEntry for every VM, sorted by display name."""
+        self._load()
+        return sorted(self._entries,
+                      key=lambda e: ((e.display_name or '').lower(), e.vmx))
+
+    def find(self, name):
+        """
+        Return the path of the .vmx file for name, a VM's display name,
+        folder, .vmx basename or path, or None if there is no such VM. If
+        several VMs share a name, see _keys for which one wins.
+        """
+        self._load()
+        key = path(name).expanduser()
+        if os.path.isabs(key):
+            key = path(os.path.normpath(key))
+        key = key.lower()
+        vmx = self._by_key.get(key)
+        if vmx is None:
+            changed = self._stale()
+        else:
+            changed = _mtime(vmx) != self._vmx_mtimes.get(vmx)
+        if changed:
+            self.refresh()
+            vmx = self._by_key.get(key)
+        return path(vmx) if vmx is not None else None
+
+    def refresh(self):
+        """Scan every folder again and save the index."""
+        self._scan()
+        self._save()
+
+    def _load(self):
+        if self._entries is not None:
+            return
+        if self._read_index() and not self._stale():
+            return
+        self.refresh()
+
+    def _stale(self):
+        """Whether anything has changed since the index was made."""
+        if sorted(self._scanned_dirs) != sorted(self.dirs):
+            return True
+        for mtimes in [self._folders, self._vmx_mtimes]:
+            for (filename, mtime) in mtimes.items():
+                if _mtime(filename) != mtime:
+                    return True
+        return False
+
+    def _scan(self):
+        entries = []
+        folders = {}
+        for directory in self.dirs:
+            folders[directory] = _mtime(directory)
+            if folders[directory] is None:
+                continue
+            for child in sorted(directory.listdir()):
+                if child.ext.lower() == '.vmx' and child.isfile():
+                    entries.append(child)
+                elif child.isdir():
+                    folders[child] = _mtime(child)
+                    entries.extend(sorted(child.files('*.vmx')))
+        self._set([LibraryEntry(read_display_name(vmx), vmx)
+                   for vmx in entries], folders,
+                  dict((vmx, _mtime(vmx)) for vmx in entries))
+
+    def _set(self, entries, folders, vmx_mtimes):
+        self._entries = entries
+        self._folders = folders
+        self._vmx_mtimes = vmx_mtimes
+        self._scanned_dirs = list(self.dirs)
+        self._by_key = {}
+        # A display name wins over another VM's folder name, which wins
+        # over another VM's .vmx basename; otherwise the first VM found.
+        keys = [_keys(entry) for entry in entries]
+        for rank in range(3):
+            for (entry, entry_keys) in zip(entries, keys):
+                for key in entry_keys[rank]:
+                    self._by_key.setdefault(key, entry.vmx)
+
+    def _read_index(self):
+        if self.index_path is None:
+            return False
+        try:
+            with open(self.index_path, 'rb') as f:
+                index = json.load(f)
+            self._set([LibraryEntry(e['display_name'], path(e['vmx']))
+                       for e in index['vms']],
+                      dict((path(d), m) for (d, m) in index['folders']),
+                      dict((path(v), m) for (v, m) in index['vmx_mtimes']))
+            self._scanned_dirs = [path(d) for d in index['dirs']]
+        except (IOError, ValueError, KeyError, TypeError):
+            return False
+        return True
+
+    def _save(self):
+        if self.index_path is None:
+            return
+        index = {
+            'dirs': self._scanned_dirs,
+            'folders': sorted(self._folders.items()),
+            'vmx_mtimes': sorted(self._vmx_mtimes.items()),
+            # In the order found, which decides between clashing names
+            'vms': [{'display_name': e.display_name, 'vmx': e.vmx}
+                    for e in self._entries],
+        }
+        try:
+            write_json(self.index_path, index)
+        except (IOError, OSError), e:
+            # The index only saves time.
+            print >>sys.stderr, 'Could not save VM index %s: %s' % (
+                self.index_path, e)
+
+_libraries = {}
+
+def default_library():
+    """The Library for default_dirs(), indexed in the cache directory."""
+    dirs = tuple(default_dirs())
+    if dirs not in _libraries:
+        _libraries[dirs] = Library(list(dirs), default_index_path())
+    return _libraries[dirs]
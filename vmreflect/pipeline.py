@@ -0,0 +1,115 @@
+"""
+A small dependency-graph runner, used to overlap the independent steps of
+setting up a tunnel.
+"""
+
+import Queue
+import sys
+import threading
+import time
+from collections import namedtuple
+
+from . import trace
+
+StageTiming = namedtuple('StageTiming', 'name start duration')
+
+class Pipeline(object):
+    """
+    Stages are added with add(name, func, requires) and run() calls each
+    func, with no arguments, on its own thread as soon as every stage named
+    in requires has finished, with at most max_workers running at once.
+
+    After run(), results maps stage names to the values their funcs
+    returned, and timings has a StageTiming for every stage that ran, with
+    start in seconds since run() was called.
+
+    If a stage raises an exception, no more stages are started; run()
+    waits for the running ones to finish and then re-raises it. With
+    keep_going, every stage runs anyway, once the stages it requires have
+    finished or failed, and errors has a (name, exc_info) pair for each
+    one that failed instead.
+    """
+
+    def __init__(self, max_workers=4, keep_going=False):
+        self.max_workers = max_workers
+        self.keep_going = keep_going
+        self.stages = []
+        self.results = {}
+        self.timings = []
+        self.errors = []
+
+    def add(self, name, func, requires=()):
+        self.stages.append((name, func, tuple(requires)))
+
+    def run(self):
+        names = set(name for (name, _, _) in self.stages)
+        for (name, _, requires) in self.stages:
+            for required in requires:
+                if required not in names:
+                    raise Exception('stage %s requires unknown stage %s'
+                                    % (name, required))
+
+        pipeline_start = time.time()
+        finished = Queue.Queue()
+
+        def run_stage(name, func):
+            stage_start = time.time()
+            try:
+                result = (func(), None)
+            except:
+                result = (None, sys.exc_info())
+            tracer = trace.tracer
+            if tracer is not None:
+                tracer.add(name, 'stage', stage_start,
+                           time.time() - stage_start,
+                           error=result[1] and str(result[1][1]))
+            finished.put((name, stage_start, time.time()) + result)
+
+        pending = list(self.stages)
+        running = set()
+        finished_names = set()
+        error = None
+        while True:
+            if error is None:
+                for stage in list(pending):
+                    (name, func, requires) = stage
+                    if len(running) >= self.max_workers:
+                        break
+                    if all(r in finished_names for r in requires):
+                        pending.remove(stage)
+                        running.add(name)
+                        thread = threading.Thread(target=run_stage,
+                                                  args=(name, func))
+                        thread.daemon = True
+                        thread.start()
+            if not running:
+                break
+
+            # A timeout keeps the wait interruptible by ^C, so wait in a
+            # loop for stages that take longer.
+            while True:
+                try:
+                    (name, stage_start, stage_end, result,
+                     exc_info) = finished.get(True, 3600)
+                    break
+                except Queue.Empty:
+                    pass
+            running.remove(name)
+            self.timings.append(StageTiming(name,
+                                            stage_start - pipeline_start,
+                                            stage_end - stage_start))
+            if exc_info and self.keep_going:
+                self.errors.append((name, exc_info))
+                finished_names.add(name)
+            elif exc_info:
+                error = error or exc_info
+            else:
+                self.results[name] = result
+                finished_names.add(name)
+
+        if error:
+            raise error[0], error[1], error[2]
+        if pending:
+            raise Exception('circular dependency between stages %s'
+                            % ', '.join(name for (name, _, _) in pending))
+        return self.results
@@ -0,0 +1,87 @@
+"""
+Choosing ports in the guest for a tunnel's server, which needs two
+adjacent ones: one for the relay and, after it, one for the console.
+
+Ports that another tunnel on the host is using in the same VM are never
+chosen. Each tunnel holds a lease on its ports, one of janitor's lease
+files, and ports are chosen and leased while holding a lock, so that
+tunnels opened at the same time never choose the same ones.
+
+What is already listening in the guest is learned from netstat, which the
+tunnel runs in the same guest script that starts the server, so asking
+costs no extra backend calls. Ports are chosen to avoid whatever netstat
+last showed in the VM, and only if the server's netstat shows that they
+were taken after all are they chosen again and the server restarted.
+"""
+
+import fcntl
+import random
+import re
+from contextlib import contextmanager
+
+from path import path
+
+from .cache import _make_dirs, default_cache_dir
+from .janitor import leased_ports, take_lease
+
+SERVER_PORT_RANGE = (4000, 65000)
+
+NETSTAT_COMMAND = 'netstat -an -p TCP'
+
+# A listening socket's foreign address is all zeroes, whatever language
+# netstat describes its state in.
+_re_listening = re.compile(r'^\s*TCP\s+[\d.]+:(\d+)\s+0\.0\.0\.0:0\b',
+                           re.M | re.I)
+
+# Random ports tried before looking through the whole range
+_ATTEMPTS = 100
+
+_random = random.SystemRandom()
+
+class NoFreePorts(Exception):
+    pass
+
+def parse_netstat(text):
+    """Return the set of TCP ports listening in netstat -an output."""
+    return set(int(port) for port in _re_listening.findall(text))
+
+@contextmanager
+def _locked(directory):
+    _make_dirs(directory)
+    with open(directory.joinpath('ports.lock'), 'a') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+def _is_free(start, count, taken):
+    return not any(port in taken for port in xrange(start, start + count))
+
+def allocate_ports(vmx, count=2, exclude=(), port_range=SERVER_PORT_RANGE,
+                   directory=None):
+    """
+    Choose count adjacent ports in port_range, a (first, last) pair, in
+    the VM vmx, leaving out exclude and the ports that living processes
+    hold leases on in it, however they named its .vmx file, and lease
+    them. Returns the ports and the lease's
+    filename, for janitor.release_lease().
+    """
+    directory = path(directory or default_cache_dir())
+    (first, last) = (port_range[0], port_range[1] - count + 1)
+    with _locked(directory):
+        taken = set(exclude) | leased_ports(vmx, directory)
+        for i in range(_ATTEMPTS):
+            start = _random.randint(first, max(first, last))
+            if start <= last and _is_free(start, count, taken):
+                break
+        else:
+            # Nearly all of them are taken.
+            starts = [s for s in xrange(first, last + 1)
+                      if _is_free(s, count, taken)]
+            if not starts:
+                raise NoFreePorts('no %d adjacent free ports in %d-%d'
+                                  % ((count,) + tuple(port_range)))
+            start = _random.choice(starts)
+        ports = range(start, start + count)
+        return (ports, take_lease(vmx, [], directory, ports=ports))
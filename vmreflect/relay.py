@@ -0,0 +1,507 @@
+"""
+The host side of the reflector protocol, replacing tcpr's own client.
+
+The reflector server in the guest multiplexes every connection to a
+forwarded port over one connection to the host. For each one it sends a T
+packet; the relay connects to the forward's address on the host,
+acknowledges the T, and copies data both ways until both ends are done.
+
+Unlike tcpr's client, which dies when a connection is half-closed, when
+one end stops sending the relay keeps carrying data in the other
+direction as long as the protocol allows:
+
+- When the host end stops sending, the relay sends C, then a ping for the
+  same tunnel. The server answers pings in order, so once the answer
+  arrives, all data the guest sent before the server closed its end has
+  been passed on, and the host connection is shut down.
+
+- When the server sends C, buffered data is written out and then the
+  host connection is shut down for writing. Whatever the host end still
+  sends is read and thrown away, since the server has already forgotten
+  the tunnel; sending data for it would corrupt the server's stream.
+  The same goes for a C that arrives while the host connection is still
+  being made, except that the tunnel is then never acknowledged: the
+  real server treats an acknowledgement for a tunnel it doesn't know as
+  fatal, and drops every tunnel. Nothing can be done about an
+  acknowledgement that was already sent when the C arrives.
+
+Every connection is handled on one thread by one poll loop. Each
+direction is bounded by buffer_size: host connections aren't read while
+that much data is waiting to go to the server, and the server isn't read
+while any host connection has that much data waiting to be written to it.
+"""
+
+import errno
+import os
+import random
+import select
+import socket
+import threading
+import time
+import uuid
+from collections import deque, namedtuple
+
+from . import tcpr
+
+Forward = namedtuple('Forward', 'protocol name host port')
+
+DEFAULT_BUFFER_SIZE = 256 * 1024
+
+_READ_SIZE = 16 * 1024
+
+_CONNECT_IN_PROGRESS = (errno.EINPROGRESS, errno.EWOULDBLOCK, errno.EALREADY)
+
+class RelayError(Exception):
+    pass
+
+class _Channel(object):
+    """One forwarded connection, as seen from the host."""
+
+    def __init__(self, tunnel, sock):
+        self.tunnel = tunnel
+        self.sock = sock
+        self.connecting = True
+        # Data from the guest waiting to be written to the host connection
+        self.to_local = deque()
+        self.to_local_size = 0
+        # The host end has stopped sending
+        self.local_eof = False
+        # No more data will arrive from the guest
+        self.remote_closed = False
+        self.shut_down = False
+
+    def done(self):
+        return self.local_eof and self.remote_closed and not self.to_local
+
+class _Poller(object):
+    """Waits for readable or writable sockets with poll, if available,
+    since select can't handle high-numbered file descriptors."""
+
+    def wait(self, readers, writers, timeout):
+        if not hasattr(select, 'poll'):
+            (r, w, _) = select.select(readers, writers, [], timeout)
+            return (set(r), set(w))
+
+        poll = select.poll()
+        by_fd = {}
+        events = {}
+        for s in readers:
+            by_fd[s.fileno()] = s
+            events[s.fileno()] = select.POLLIN
+        for s in writers:
+            by_fd[s.fileno()] = s
+            events[s.fileno()] = events.get(s.fileno(), 0) | select.POLLOUT
+        for (fd, mask) in events.items():
+            poll.register(fd, mask)
+
+        readable = set()
+        writable = set()
+        for (fd, event) in poll.poll(None if timeout is None
+                                     else int(timeout * 1000)):
+            s = by_fd[fd]
+            # Errors and hangups are reported to whichever handler is
+            # waiting, which finds them when it tries the socket.
+            problem = event & (select.POLLERR | select.POLLHUP
+                               | select.POLLNVAL)
+            if event & select.POLLIN or (problem and s in readers):
+                readable.add(s)
+            if event & select.POLLOUT or (problem and s in writers):
+                writable.add(s)
+        return (readable, writable)
+
+class Relay(object):
+    """
+    Connects to the reflector server at server_address as client_name and
+    relays connections for forwards, a list of Forward tuples, which the
+    server numbers in order.
+
+    Call connect(), which raises an exception if the server can't be
+    reached or refuses the client, and then run(), which relays until
+    close() is called from another thread or the connection to the server
+    is lost. registered is set once the server has accepted the forwards.
+    """
+
+    def __init__(self, server_address, client_name, password, forwards,
+                 class_name='workstation', hostname=None, node_id=None,
+                 buffer_size=DEFAULT_BUFFER_SIZE,
+                 alive_interval=120, alive_timeout=300, connect_timeout=30):
+        self.server_address = server_address
+        self.client_name = client_name
+        self.password = password
+        self.forwards = list(forwards)
+        self.class_name = class_name
+        self.hostname = hostname or socket.gethostname()
+        self.node_id = node_id or '%012X' % uuid.getnode()
+        self.buffer_size = buffer_size
+        self.alive_interval = alive_interval
+        self.alive_timeout = alive_timeout
+        self.connect_timeout = connect_timeout
+
+        self.registered = threading.Event()
+        self.channels = {}
+        # Counters, for statistics and benchmarks
+        self.tunnels_opened = 0
+        self.bytes_to_server = 0
+        self.bytes_from_server = 0
+
+        self._sock = None
+        self._in = ''
+        # The D packet being received, as (tunnel, bytes remaining)
+        self._packet = None
+        # Packets for the server, as (tunnel, data) for D packets and
+        # (None, data) for the rest
+        self._out = deque()
+        self._out_offset = 0
+        self._out_size = 0
+        self._poller = _Poller()
+        self._stopping = False
+        # Made by run(), so that a relay that is never run holds no files
+        self._wakeup_r = self._wakeup_w = None
+        self._wakeup_lock = threading.Lock()
+
+    # Setup and teardown
+
+    def connect(self):
+        sock = socket.create_connection(self.server_address,
+                                        self.connect_timeout)
+        try:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            (_, reader) = tcpr.authenticate(sock, 'client.' + self.client_name,
+                                            self.password)
+            sock.sendall('%s %s %s\r\n' % (self.class_name, self.node_id,
+                                           self.hostname))
+            status = reader.read_until('\r\n').strip()
+            if not status.startswith('4'):
+                raise RelayError('reflector server refused client: %s'
+                                 % status)
+            sock.sendall(''.join('%s %s\r\n' % (f.protocol, f.name)
+                                 for f in self.forwards) + '\r\n')
+        except:
+            sock.close()
+            raise
+        sock.setblocking(False)
+        self._sock = sock
+        self._in = reader.buffer
+        self._last_received = time.time()
+        self._next_ping = self._last_received + self.alive_interval
+        self.registered.set()
+
+    def close(self):
+        """Make run() return. Safe to call from any thread."""
+        with self._wakeup_lock:
+            self._stopping = True
+            if self._wakeup_w is not None:
+                os.write(self._wakeup_w, 'x')
+
+    def _close_all(self):
+        for channel in self.channels.values():
+            channel.sock.close()
+        self.channels.clear()
+        if self._sock is not None:
+            self._sock.close()
+            self._sock = None
+        with self._wakeup_lock:
+            if self._wakeup_r is not None:
+                os.close(self._wakeup_r)
+                os.close(self._wakeup_w)
+                self._wakeup_r = self._wakeup_w = None
+
+    # The loop
+
+    def run(self):
+        if self._sock is None:
+            self.connect()
+        try:
+            with self._wakeup_lock:
+                (self._wakeup_r, self._wakeup_w) = os.pipe()
+            self._parse()
+            while not self._stopping:
+                self._step()
+        finally:
+            self._close_all()
+
+    def _step(self):
+        wakeup = _Wakeup(self._wakeup_r)
+        readers = [wakeup]
+        writers = []
+        server_blocked = False
+        for channel in self.channels.values():
+            if channel.connecting:
+                writers.append(channel.sock)
+                continue
+            if channel.to_local:
+                writers.append(channel.sock)
+                if channel.to_local_size >= self.buffer_size:
+                    server_blocked = True
+            if not channel.local_eof and (channel.remote_closed
+                                          or self._out_room() > 0):
+                readers.append(channel.sock)
+        if not server_blocked:
+            readers.append(self._sock)
+        if self._out:
+            writers.append(self._sock)
+
+        timeout = None
+        if self.alive_interval:
+            timeout = max(0, self._next_ping - time.time())
+        (readable, writable) = self._poller.wait(readers, writers, timeout)
+        if wakeup in readable:
+            return
+
+        if self._sock in writable:
+            self._write_server()
+        if self._sock in readable:
+            self._read_server()
+        for channel in self.channels.values():
+            if channel.sock in writable and self._is_open(channel):
+                if channel.connecting:
+                    self._finish_connect(channel)
+                else:
+                    self._write_local(channel)
+            if channel.sock in readable and self._is_open(channel):
+                self._read_local(channel)
+        self._keep_alive()
+
+    def _is_open(self, channel):
+        return self.channels.get(channel.tunnel) is channel
+
+    def _keep_alive(self):
+        now = time.time()
+        if self.alive_timeout and now - self._last_received > self.alive_timeout:
+            raise RelayError('no packets received from server for %d seconds'
+                             % (now - self._last_received))
+        if self.alive_interval and now >= self._next_ping:
+            # The answer must not be mistaken for one to a closing
+            # channel's ping.
+            tunnel = random.randint(0, 0xffff)
+            while tunnel in self.channels:
+                tunnel = random.randint(0, 0xffff)
+            self._send(tcpr.pack('P', tunnel, 1))
+            self._next_ping = now + self.alive_interval
+
+    # The server connection
+
+    def _out_room(self):
+        return self.buffer_size - self._out_size
+
+    def _send(self, data, tunnel=None):
+        self._out.append((tunnel, data))
+        self._out_size += len(data)
+
+    def _write_server(self):
+        while self._out:
+            (tunnel, data) = self._out[0]
+            try:
+                sent = self._sock.send(data[self._out_offset:]
+                                       if self._out_offset else data)
+            except socket.error, e:
+                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return
+                raise RelayError('connection to server lost: %s' % e)
+            self._out_size -= sent
+            self.bytes_to_server += sent
+            self._out_offset += sent
+            if self._out_offset < len(data):
+                return
+            self._out.popleft()
+            self._out_offset = 0
+
+    def _read_server(self):
+        try:
+            data = self._sock.recv(_READ_SIZE)
+        except socket.error, e:
+            if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return
+            raise RelayError('connection to server lost: %s' % e)
+        if not data:
+            raise RelayError('connection closed by server')
+        self.bytes_from_server += len(data)
+        self._last_received = time.time()
+        self._next_ping = self._last_received + self.alive_interval
+        self._in += data
+        self._parse()
+
+    def _parse(self):
+        while True:
+            if self._packet is not None:
+                (tunnel, remaining) = self._packet
+                if remaining and not self._in:
+                    return
+                chunk = self._in[:remaining]
+                self._in = self._in[len(chunk):]
+                remaining -= len(chunk)
+                self._packet = (tunnel, remaining) if remaining else None
+                self._deliver(tunnel, chunk)
+                continue
+
+            if len(self._in) < tcpr.HEADER_SIZE:
+                return
+            (packet_type, tunnel, arg) = tcpr.unpack(
+                self._in[:tcpr.HEADER_SIZE])
+            self._in = self._in[tcpr.HEADER_SIZE:]
+            if packet_type == 'D':
+                self._packet = (tunnel, arg)
+            elif packet_type == 'T':
+                self._open_channel(tunnel, arg)
+            elif packet_type == 'C':
+                self._remote_close(tunnel)
+            elif packet_type == 'P':
+                if arg > 0:
+                    self._send(tcpr.pack('P', tunnel, arg - 1))
+                else:
+                    self._ping_answered(tunnel)
+            else:
+                raise tcpr.ProtocolError('unknown packet type %r'
+                                         % packet_type)
+
+    # Channels
+
+    def _open_channel(self, tunnel, forward_index):
+        if tunnel in self.channels:
+            self._drop(self.channels[tunnel])
+        if forward_index >= len(self.forwards):
+            self._send(tcpr.pack('T', tunnel, 1))
+            return
+        forward = self.forwards[forward_index]
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setblocking(False)
+        err = sock.connect_ex((forward.host, forward.port))
+        if err and err not in _CONNECT_IN_PROGRESS:
+            sock.close()
+            self._send(tcpr.pack('T', tunnel, 1))
+            return
+        channel = _Channel(tunnel, sock)
+        self.channels[tunnel] = channel
+        self.tunnels_opened += 1
+        if not err:
+            self._connected(channel)
+
+    def _finish_connect(self, channel):
+        err = channel.sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+        if err:
+            del self.channels[channel.tunnel]
+            channel.sock.close()
+            if not channel.remote_closed:
+                self._send(tcpr.pack('T', channel.tunnel, 1))
+        else:
+            self._connected(channel)
+
+    def _connected(self, channel):
+        channel.connecting = False
+        channel.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        if channel.remote_closed:
+            self._check_done(channel)
+            return
+        # Only now may data be sent for this tunnel.
+        self._send(tcpr.pack('T', channel.tunnel, 0))
+
+    def _deliver(self, tunnel, data):
+        channel = self.channels.get(tunnel)
+        if channel is None or channel.shut_down or not data:
+            return
+        channel.to_local.append(data)
+        channel.to_local_size += len(data)
+
+    def _write_local(self, channel):
+        while channel.to_local:
+            data = channel.to_local[0]
+            try:
+                sent = channel.sock.send(data)
+            except socket.error, e:
+                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return
+                self._local_failed(channel)
+                return
+            channel.to_local_size -= sent
+            if sent < len(data):
+                channel.to_local[0] = data[sent:]
+                return
+            channel.to_local.popleft()
+        self._check_done(channel)
+
+    def _read_local(self, channel):
+        size = _READ_SIZE
+        if not channel.remote_closed:
+            size = min(size, self._out_room(), tcpr.MAX_DATA_SIZE)
+            if size <= 0:
+                return
+        try:
+            data = channel.sock.recv(size)
+        except socket.error, e:
+            if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return
+            self._local_failed(channel)
+            return
+        if data:
+            if not channel.remote_closed:
+                self._send(tcpr.pack_data(channel.tunnel, data),
+                           tunnel=channel.tunnel)
+            return
+
+        channel.local_eof = True
+        if not channel.remote_closed:
+            self._send(tcpr.pack('C', channel.tunnel, 0))
+            self._send(tcpr.pack('P', channel.tunnel, 1))
+        self._check_done(channel)
+
+    def _local_failed(self, channel):
+        """The host connection is gone in both directions."""
+        if not channel.remote_closed and not channel.local_eof:
+            self._send(tcpr.pack('C', channel.tunnel, 0))
+        self._drop(channel)
+
+    def _remote_close(self, tunnel):
+        channel = self.channels.get(tunnel)
+        if channel is None:
+            return
+        channel.remote_closed = True
+        # The server no longer knows this tunnel, so data for it that
+        # hasn't started going out yet must not be sent.
+        head = self._out.popleft() if self._out_offset else None
+        kept = deque(p for p in self._out if p[0] != tunnel)
+        self._out_size = sum(len(d) for (_, d) in kept) + (
+            len(head[1]) - self._out_offset if head else 0)
+        if head:
+            kept.appendleft(head)
+        self._out = kept
+        if not channel.connecting:
+            self._check_done(channel)
+
+    def _ping_answered(self, tunnel):
+        channel = self.channels.get(tunnel)
+        if channel is not None and channel.local_eof:
+            channel.remote_closed = True
+            self._check_done(channel)
+
+    def _check_done(self, channel):
+        if channel.to_local:
+            return
+        if channel.remote_closed and not channel.shut_down:
+            channel.shut_down = True
+            try:
+                channel.sock.shutdown(socket.SHUT_WR)
+            except socket.error:
+                pass
+        if channel.done():
+            self._drop(channel)
+
+    def _drop(self, channel):
+        channel.sock.close()
+        if self.channels.get(channel.tunnel) is channel:
+            del self.channels[channel.tunnel]
+
+class _Wakeup(object):
+    """The read end of the pipe that close() writes to, as a pollable
+    object."""
+
+    def __init__(self, fd):
+        self.fd = fd
+
+    def fileno(self):
+        return self.fd
+
+    def __eq__(self, other):
+        return isinstance(other, _Wakeup) and other.fd == self.fd
+
+    def __hash__(self):
+        return hash(self.fd)
@@ -0,0 +1,48 @@
+"""
+Retrying steps that are expected to fail for a little while, such as
+connecting to a server in the guest that is still starting, with
+exponential backoff under an overall deadline.
+"""
+
+import time
+
+class NotReady(Exception):
+    """Raised by a step to say that it should be retried."""
+    pass
+
+class DeadlineExceeded(Exception):
+    pass
+
+class Backoff(object):
+    """
+    Waits start out at initial seconds and are multiplied by factor after
+    every attempt, up to maximum.
+    """
+
+    def __init__(self, initial=0.02, factor=2, maximum=1.0):
+        self.initial = initial
+        self.factor = factor
+        self.maximum = maximum
+
+    def delays(self):
+        delay = self.initial
+        while True:
+            yield delay
+            delay = min(delay * self.factor, self.maximum)
+
+def retry(func, deadline, retry_on=(), backoff=None, clock=time.time,
+          sleep=time.sleep):
+    """
+    Call func until it returns without raising NotReady or one of the
+    exceptions in retry_on, and return what it returned. If it is still
+    failing at deadline, a clock() time, raise DeadlineExceeded.
+    """
+    retry_on = (NotReady,) + tuple(retry_on)
+    for delay in (backoff or Backoff()).delays():
+        try:
+            return func()
+        except retry_on, e:
+            remaining = deadline - clock()
+            if remaining <= 0:
+                raise DeadlineExceeded(str(e) or e.__class__.__name__)
+            sleep(min(delay, remaining))
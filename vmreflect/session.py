@@ -0,0 +1,191 @@
+# coding: UTF-8
+
+"""
+Persistent sessions for controlling virtual machines.
+
+Forking vmrun for every guest operation means reconnecting and
+reauthenticating every time. Instead, a session daemon can be started once:
+
+    python -m vmreflect.session --listen 127.0.0.1:7301
+
+and then, with VMREFLECT_SESSION=127.0.0.1:7301 in the environment, every
+VM object opens one connection to the daemon, logs in once, and sends all
+of its operations over that connection.
+
+The protocol is one JSON object per line. The client first sends
+
+    {"op": "login", "username": ..., "password": ...}
+
+and then any number of
+
+    {"op": "run", "args": ["deleteFileInGuest", vmx, filename]}
+
+each of which gets a reply of
+
+    {"ok": true, "returncode": 0, "stdout": ..., "stderr": ...}
+
+or {"ok": false, "error": ...}. Since vmrun output is bytes, strings are
+sent as latin-1 decoded unicode so that any byte survives the round trip.
+
+The daemon hands the operations to a backend created once per connection
+by backend_factory(username, password). By default that is a VmrunBackend;
+the tests use a simulated guest instead.
+
+With the default backend the daemon still forks vmrun for every operation,
+so it saves nothing: each operation costs the same vmrun process plus a
+round trip to the daemon. Only a backend that keeps its own connection to
+VMware open, such as one using VIX, would make sessions faster.
+python -m vmreflect.tests.benchmark compares the two.
+"""
+
+import argparse
+import json
+import socket
+import SocketServer
+import sys
+import threading
+
+from .vmapi import VmException, VmrunBackend
+
+DEFAULT_ADDRESS = ('127.0.0.1', 7301)
+
+def parse_address(address):
+    """Parse 'host:port' or 'port' into a (host, port) tuple."""
+    host, _, port = address.rpartition(':')
+    return (host or DEFAULT_ADDRESS[0], int(port))
+
+def _encode(s):
+    return s.decode('latin-1')
+
+def _decode(u):
+    return u.encode('latin-1')
+
+class SessionBackend(object):
+    """
+    Backend that sends every operation over one connection to a session
+    daemon.
+
+    The connection is opened and authenticated in the constructor, so
+    socket.error or VmException is raised right away if the daemon is
+    unreachable or rejects the credentials. If the connection is lost
+    later, the operation in progress fails and the next one reconnects.
+    """
+
+    def __init__(self, address, username, password):
+        self.address = address
+        self.username = username
+        self.password = password
+        self._lock = threading.Lock()
+        self._sock = None
+        self._connect()
+
+    def _connect(self):
+        self._sock = socket.create_connection(self.address)
+        self._rfile = self._sock.makefile('rb')
+        reply = self._request({'op': 'login',
+                               'username': _encode(self.username),
+                               'password': _encode(self.password)})
+        if not reply['ok']:
+            self._disconnect()
+            raise VmException(-1, 'session login failed: %s'
+                              % _decode(reply['error']))
+
+    def _disconnect(self):
+        if self._sock is not None:
+            self._rfile.close()
+            self._sock.close()
+            self._sock = None
+
+    def _request(self, message):
+        self._sock.sendall(json.dumps(message) + '\n')
+        line = self._rfile.readline()
+        if not line:
+            raise socket.error('session closed by daemon')
+        return json.loads(line)
+
+    def run(self, cmd_args):
+        with self._lock:
+            if self._sock is None:
+                self._connect()
+            try:
+                reply = self._request({'op': 'run',
+                                       'args': [_encode(a) for a in cmd_args]})
+            except socket.error, e:
+                self._disconnect()
+                raise VmException(-1, 'session connection lost: %s' % e)
+        if not reply['ok']:
+            return (-1, '', _decode(reply['error']))
+        return (reply['returncode'], _decode(reply['stdout']),
+                _decode(reply['stderr']))
+
+    def close(self):
+        with self._lock:
+            self._disconnect()
+
+class _SessionRequestHandler(SocketServer.StreamRequestHandler):
+
+    def handle(self):
+        backend = None
+        try:
+            for line in iter(self.rfile.readline, ''):
+                request = json.loads(line)
+                try:
+                    if request['op'] == 'login':
+                        if backend is not None:
+                            backend.close()
+                        backend = self.server.backend_factory(
+                            _decode(request['username']),
+                            _decode(request['password']))
+                        self._reply(ok=True)
+                    elif request['op'] == 'run':
+                        if backend is None:
+                            raise Exception('not logged in')
+                        (returncode, stdout, stderr) = backend.run(
+                            [_decode(a) for a in request['args']])
+                        self._reply(ok=True, returncode=returncode,
+                                    stdout=_encode(stdout or ''),
+                                    stderr=_encode(stderr or ''))
+                    else:
+                        raise Exception('unknown op %r' % request['op'])
+                except Exception, e:
+                    self._reply(ok=False, error=_encode(str(e)))
+        finally:
+            if backend is not None:
+                backend.close()
+
+    def _reply(self, **kwargs):
+        self.wfile.write(json.dumps(kwargs) + '\n')
+        self.wfile.flush()
+
+class SessionServer(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+    """
+    The session daemon. Each connection gets its own backend, created by
+    backend_factory(username, password) when the client logs in.
+    """
+
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, address, backend_factory=VmrunBackend):
+        SocketServer.TCPServer.__init__(self, address, _SessionRequestHandler)
+        self.backend_factory = backend_factory
+
+def main(args=None):
+    parser = argparse.ArgumentParser(
+        description='Run a session daemon for controlling virtual machines.')
+    parser.add_argument('--listen', default='%s:%d' % DEFAULT_ADDRESS,
+                        help="""host:port to listen on. Set
+                        VMREFLECT_SESSION to the same value to use it.""")
+    args = parser.parse_args(args=args)
+    server = SessionServer(parse_address(args.listen))
+    print 'Session daemon listening on %s:%d' % server.server_address
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+
+if __name__ == '__main__':
+    try:
+        sys.exit(main())
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,200 @@
+"""
+The parts of the TCP Proxy Reflector wire protocol that vmreflect speaks
+itself: SRP authentication, and the packets multiplexing forwarded
+connections over the connection between a reflector client and the
+server.
+
+Authentication is SRP with tcpr's parameters. The client sends
+
+    USER <username>\\n
+    <base64 of A>\\n\\n
+
+and the server replies with KEY\\n and then the salt, B and u, each base64
+encoded and followed by a blank line. The client sends its proof the same
+way, and the server replies with AOK\\n and its own proof. Anything else is
+an error message. Reflector clients log in as client.<clientname> and
+console users as user.<username>.
+
+After that, reflector packets are a six-byte header of a magic byte, a
+one-character type, a tunnel id and an argument. D packets carry
+argument-many bytes of data for the tunnel. T opens a tunnel to the
+argument-th forward, and is acknowledged with a T whose argument is 0 for
+success or 1 for failure. C closes a tunnel, and P is a ping that is
+answered by a P with the argument decremented, unless it is already zero.
+"""
+
+import base64
+import hashlib
+import hmac
+import random
+import struct
+
+# tcpr's SRP prime field and generator
+N = 137656596376486790043182744734961384933899167257744121335064027192370741112305920493080254690601316526576747330553110881621319493425219214435734356437905637147670206858858966652975541347966997276817657605917471296442404150473520316654025988200256062845025470327802138620845134916799507318209468806715548156999L
+G = 8623462398472349872L
+
+SALT_LENGTH = 16
+_RANDOM_BITS = 128
+
+_sysrandom = random.SystemRandom()
+
+class AuthenticationError(Exception):
+    pass
+
+def long_to_string(i):
+    s = ''
+    while i > 0:
+        s = chr(i & 255) + s
+        i >>= 8
+    return s
+
+def string_to_long(s):
+    i = 0L
+    for c in s:
+        i = (i << 8) + ord(c)
+    return i
+
+def _hash(value):
+    if not isinstance(value, str):
+        value = long_to_string(value)
+    return hashlib.sha1(value).digest()
+
+def _repr_long(i):
+    # tcpr hashes the Python 2 repr of longs, with its trailing L.
+    return '%dL' % i
+
+def private_key(username, salt, password):
+    return string_to_long(_hash(salt + _hash(username + password)))
+
+def create_verifier(username, password):
+    """Return a new (salt, verifier) pair for the user database."""
+    salt = ''.join(chr(_sysrandom.getrandbits(8)) for i in range(SALT_LENGTH))
+    return (salt, pow(G, private_key(username, salt, password), N))
+
+def client_proof(key, username, salt, A, B, u):
+    return hmac.new(key, _hash(N) + _hash(G) + _hash(username) + salt
+                    + _repr_long(A) + _repr_long(B) + _repr_long(u),
+                    hashlib.sha1).digest()
+
+def host_proof(key, A, m):
+    return hmac.new(key, _repr_long(A) + m, hashlib.sha1).digest()
+
+def encode_chunk(value):
+    if not isinstance(value, str):
+        value = long_to_string(value)
+    return base64.encodestring(value) + '\n'
+
+def decode_chunk(chunk):
+    return base64.decodestring(chunk)
+
+class SrpClient(object):
+
+    def __init__(self, username, password):
+        self.username = username
+        self.password = password
+        self.a = long(_sysrandom.getrandbits(_RANDOM_BITS))
+        self.A = pow(G, self.a, N)
+        self.key = None
+        self.proof = None
+
+    def compute_key(self, salt, B, u):
+        x = private_key(self.username, salt, self.password)
+        v = pow(G, x, N)
+        t = B
+        if t < v:
+            t += N
+        self.key = _hash(pow(t - v, self.a + u * x, N))
+        self.proof = client_proof(self.key, self.username, salt, self.A, B, u)
+
+    def host_proof(self):
+        return host_proof(self.key, self.A, self.proof)
+
+class SrpServerSession(object):
+    """The server's half of one authentication, given the user's salt and
+    verifier and the client's A."""
+
+    def __init__(self, username, salt, verifier, A):
+        self.username = username
+        self.salt = salt
+        self.A = A
+        while True:
+            b = long(_sysrandom.getrandbits(_RANDOM_BITS))
+            self.B = (verifier + pow(G, b, N)) % N
+            if self.B != 0:
+                break
+        self.u = pow(G, long(_sysrandom.getrandbits(_RANDOM_BITS)), N)
+        t = A * pow(verifier, self.u, N) % N
+        if t <= 1 or t + 1 == N:
+            raise AuthenticationError('bad client value')
+        self.key = _hash(pow(t, b, N))
+        self.proof = client_proof(self.key, username, salt, A, self.B, self.u)
+
+    def host_proof(self):
+        return host_proof(self.key, self.A, self.proof)
+
+class LineReader(object):
+    """Reads delimited messages from a blocking socket, keeping whatever
+    was received past the last one in buffer."""
+
+    def __init__(self, sock, buffer=''):
+        self.sock = sock
+        self.buffer = buffer
+
+    def read_until(self, terminator):
+        """Return everything up to and including terminator."""
+        while terminator not in self.buffer:
+            data = self.sock.recv(4096)
+            if not data:
+                raise EOFError('connection closed')
+            self.buffer += data
+        (message, _, self.buffer) = self.buffer.partition(terminator)
+        return message + terminator
+
+def authenticate(sock, username, password):
+    """
+    Log in to a tcpr server on sock. Return (key, reader), where reader
+    holds anything the server sent after authenticating. Raise
+    AuthenticationError if the server rejects the login.
+    """
+    srp = SrpClient(username, password)
+    reader = LineReader(sock)
+    sock.sendall('USER %s\n' % username + encode_chunk(srp.A))
+
+    line = reader.read_until('\n')
+    if not line.startswith('KEY'):
+        raise AuthenticationError(line.strip())
+    salt = decode_chunk(reader.read_until('\n\n'))
+    B = string_to_long(decode_chunk(reader.read_until('\n\n')))
+    u = string_to_long(decode_chunk(reader.read_until('\n\n')))
+    srp.compute_key(salt, B, u)
+    sock.sendall(encode_chunk(srp.proof))
+
+    line = reader.read_until('\n')
+    if not line.startswith('AOK'):
+        raise AuthenticationError(line.strip())
+    if decode_chunk(reader.read_until('\n\n')) != srp.host_proof():
+        raise AuthenticationError('host authentication failed')
+    return (srp.key, reader)
+
+# Reflector packets
+
+MAGIC = 123
+_HEADER = struct.Struct('!BcHH')
+HEADER_SIZE = _HEADER.size
+MAX_DATA_SIZE = 0xffff
+
+class ProtocolError(Exception):
+    pass
+
+def pack(packet_type, tunnel, arg):
+    return _HEADER.pack(MAGIC, packet_type, tunnel, arg)
+
+def pack_data(tunnel, data):
+    return _HEADER.pack(MAGIC, 'D', tunnel, len(data)) + data
+
+def unpack(header):
+    """Return the (type, tunnel, arg) of a packet header."""
+    (magic, packet_type, tunnel, arg) = _HEADER.unpack(header)
+    if magic != MAGIC:
+        raise ProtocolError('bad packet header %r' % header)
+    return (packet_type, tunnel, arg)
@@ -12,11 +12,48 @@ you can customize it by setting these environment variables:
     VMREFLECT_TEST_VM_DIR
 
 Note that VM_NAME can also be the absolute path to a .vmx file.
+
+Most tests use a simulated guest instead, and need no VM. To time the VM
+API and tunnel setup with a simulated guest behind a stand-in vmrun, run
+
+    python -m vmreflect.tests.benchmark
+
+and to put the relay under load from many connections at once, run
+
+    python -m vmreflect.tests.loadgen
+
+Tests that look VMs up by name call use_temp_cache_dir() in setUp, so
+that the VM library index and guest addresses go in a temporary cache
+directory, never in ~/.cache/vmreflect or $VMREFLECT_CACHE_DIR.
 """
 
 import os
+import shutil
+import tempfile
+
+from vmreflect import library
+
+__all__ = ['test_config', 'use_temp_cache_dir']
+
+def use_temp_cache_dir(test_case):
+    """
+    Point VMREFLECT_CACHE_DIR at a new temporary directory until test_case
+    finishes, with no VM libraries loaded from the old one.
+    """
+    cache_dir = tempfile.mkdtemp(prefix='vmreflect-cache')
+    saved_cache_dir = os.environ.get('VMREFLECT_CACHE_DIR')
+    saved_libraries = library._libraries
+    os.environ['VMREFLECT_CACHE_DIR'] = cache_dir
+    library._libraries = {}
 
-__all__ = ['test_config']
+    def restore():
+        library._libraries = saved_libraries
+        if saved_cache_dir is None:
+            del os.environ['VMREFLECT_CACHE_DIR']
+        else:
+            os.environ['VMREFLECT_CACHE_DIR'] = saved_cache_dir
+        shutil.rmtree(cache_dir, True)
+    test_case.addCleanup(restore)
 
 class _TestConfig(object):
     """
@@ -0,0 +1,180 @@
+"""
+Benchmarks of the VM API and of setting up a whole tunnel, run against
+the stand-in vmrun so that they need neither VMware nor a guest:
+
+    python -m vmreflect.tests.benchmark --latency 0.05 --repeat 5
+
+Every operation forks the stand-in vmrun, the way the real one is forked,
+and latency is added to each of them. For each benchmark, the wall time
+and how many vmrun operations it took are reported.
+
+How long the vmreflect command takes to start is measured too, and has a
+budget, STARTUP_BUDGET: the benchmarks exit with status 1 if it takes
+longer. The unit tests only check what it imports, since their timings
+depend on how busy the machine is.
+"""
+
+import argparse
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import namedtuple
+
+from vmreflect.cache import Cache
+from vmreflect.session import SessionBackend, SessionServer
+from vmreflect.tests.fakevm import FakeGuest, _vmx_file
+from vmreflect.tests.fakevmrun import FakeVmrun
+from vmreflect.tunnel import Tunnel
+from vmreflect.vmapi import VM, VmrunBackend
+
+Result = namedtuple('Result', 'name times calls')
+
+# Seconds that vmreflect --help may take, from starting Python until it
+# exits. It takes about 0.03s; importing pkg_resources alone, as the
+# command used to, takes 0.1s.
+STARTUP_BUDGET = 0.08
+
+_STARTUP_NAME = 'vmreflect --help'
+
+_PACKAGE_ROOT = os.path.dirname(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))))
+
+def _vm(guest):
+    return VM(_vmx_file(), guest.username, guest.password,
+              backend=VmrunBackend(guest.username, guest.password))
+
+def _measure(name, fake_vmrun, repeat, func):
+    times = []
+    calls_before = len(fake_vmrun.guest().calls)
+    for i in range(repeat):
+        start = time.time()
+        func()
+        times.append(time.time() - start)
+    calls = len(fake_vmrun.guest().calls) - calls_before
+    return Result(name, times, calls / float(repeat))
+
+def bench_run_command(fake_vmrun, guest, repeat):
+    vm = _vm(guest)
+    # The first command also finds the guest's temporary directory.
+    vm._run_command('echo warm up')
+    return _measure('_run_command', fake_vmrun, repeat,
+                    lambda: vm._run_command('echo hello'))
+
+def bench_list_processes(fake_vmrun, guest, repeat):
+    vm = _vm(guest)
+    return _measure('list_processes', fake_vmrun, repeat, vm.list_processes)
+
+def bench_session(fake_vmrun, guest, repeat):
+    """
+    list_processes through a session daemon, which forks the stand-in
+    vmrun for each operation as the real daemon forks vmrun. Compare with
+    list_processes, which forks it directly.
+    """
+    server = SessionServer(('127.0.0.1', 0))
+    server_thread = threading.Thread(target=server.serve_forever)
+    server_thread.daemon = True
+    server_thread.start()
+    try:
+        vm = VM(_vmx_file(), guest.username, guest.password,
+                backend=SessionBackend(server.server_address,
+                                       guest.username, guest.password))
+        try:
+            return _measure('list_processes (session)', fake_vmrun, repeat,
+                            vm.list_processes)
+        finally:
+            vm.close()
+    finally:
+        server.shutdown()
+        server.server_close()
+
+def bench_tunnel_start(fake_vmrun, guest, repeat):
+    """
+    Time from calling Tunnel.open until the tunnel is open. The vmrun
+    operations include closing it again.
+    """
+    cache_dir = tempfile.mkdtemp(prefix='vmreflect')
+    times = []
+    def open_tunnel():
+        tunnel = Tunnel(None, 8000, None, None, vm=_vm(guest),
+                        cache=Cache(cache_dir))
+        start = time.time()
+        with tunnel.open():
+            times.append(time.time() - start)
+    try:
+        result = _measure('Tunnel.open', fake_vmrun, repeat, open_tunnel)
+    finally:
+        shutil.rmtree(cache_dir)
+    return result._replace(times=times)
+
+def bench_cli_startup(fake_vmrun, guest, repeat):
+    """Time to run vmreflect --help in a new Python process."""
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(
+        [_PACKAGE_ROOT] + filter(None, [env.get('PYTHONPATH')]))
+    command = [sys.executable, '-c',
+               'from vmreflect.cli import main; main(["--help"])']
+    with open(os.devnull, 'w') as devnull:
+        return _measure(_STARTUP_NAME, fake_vmrun, repeat,
+                        lambda: subprocess.check_call(command, env=env,
+                                                      stdout=devnull))
+
+BENCHMARKS = [bench_run_command, bench_list_processes, bench_session,
+              bench_tunnel_start, bench_cli_startup]
+
+def run_benchmarks(latency=0, repeat=3, benchmarks=BENCHMARKS):
+    results = []
+    for benchmark in benchmarks:
+        guest = FakeGuest(latency=latency, ip_address='127.0.0.1')
+        fake_vmrun = FakeVmrun(guest)
+        try:
+            results.append(benchmark(fake_vmrun, guest, repeat))
+        finally:
+            fake_vmrun.close()
+    return results
+
+def print_results(results, out=sys.stdout):
+    print >>out, '%-24s %5s %9s %9s %9s' % ('benchmark', 'runs', 'mean',
+                                           'min', 'vmruns')
+    for result in results:
+        print >>out, '%-24s %5d %8.3fs %8.3fs %9.1f' % (
+            result.name, len(result.times),
+            sum(result.times) / len(result.times), min(result.times),
+            result.calls)
+
+def main(args=None):
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--latency', type=float, default=0.05,
+                        help="""Seconds added to every vmrun operation.
+                        Defaults to %(default)s.""")
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--only', action='append', metavar='NAME',
+                        choices=[b.__name__[len('bench_'):]
+                                 for b in BENCHMARKS],
+                        help='Run only this benchmark')
+    args = parser.parse_args(args=args)
+
+    os.environ.pop('VMREFLECT_SESSION', None)
+    benchmarks = [b for b in BENCHMARKS
+                  if not args.only or b.__name__[len('bench_'):] in args.only]
+    # Tunnel.open prints its progress.
+    with open(os.devnull, 'w') as devnull:
+        saved_stdout = sys.stdout
+        sys.stdout = devnull
+        try:
+            results = run_benchmarks(args.latency, args.repeat, benchmarks)
+        finally:
+            sys.stdout = saved_stdout
+    print_results(results)
+    for result in results:
+        if result.name == _STARTUP_NAME and min(result.times) > STARTUP_BUDGET:
+            print >>sys.stderr, '%s took %.3fs, over its budget of %.3fs.' % (
+                result.name, min(result.times), STARTUP_BUDGET)
+            return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,508 @@
+"""
+A stand-in for the tcpr reflector server that runs in the guest, for
+testing the host side without a VM.
+
+It speaks the reflector client protocol, authentication included, and
+the part of the admin console that vmreflect uses, with a thread per
+connection. It is stricter than the real server: where a
+client does something that would crash or corrupt the real server, such
+as sending data for a tunnel the server has already closed, the problem is
+recorded in errors and the stand-in carries on.
+
+It can also be run as a program, for a simulated guest to start in the
+background:
+
+    python -m vmreflect.tests.fakereflector --listen 127.0.0.1:4000 \\
+        --console 127.0.0.1:4001 --user user.manager:password
+"""
+
+import argparse
+import re
+import signal
+import socket
+import sys
+import threading
+
+from vmreflect import tcpr
+
+class _Tunnel(object):
+
+    def __init__(self, tunnel_id, forward, sock):
+        self.id = tunnel_id
+        self.forward = forward
+        self.sock = sock
+        self.state = 'new'
+
+class _Forward(object):
+
+    def __init__(self, reflector, forward_id, num, protocol, name):
+        self.reflector = reflector
+        self.id = forward_id
+        self.num = num
+        self.protocol = protocol
+        self.name = name
+        self.listener = None
+        self.port = None
+        self.console_port = None
+
+class FakeReflector(object):
+    """
+    Listens for reflector clients on address, and for console users on
+    console_address. Users are added with add_user(), with the same
+    client. and user. prefixes as tcpr uses. Forwards are numbered
+    globally in the order clients register them, and start_forward() makes
+    one listen on a port.
+
+    The guest and the host are the same machine here, so a console start
+    command for a port listens on some free port instead, and guest_port()
+    gives the port it really used.
+    """
+
+    def __init__(self, address=('127.0.0.1', 0), console_address=None):
+        self.lock = threading.RLock()
+        self.changed = threading.Condition(self.lock)
+        self.users = {}
+        self.errors = []
+        self.reflectors = []
+        self.forwards = []
+        self.tunnels_opened = 0
+        self.console_commands = []
+        self._guest_ports = {}
+        self._closed = False
+        self._sockets = set()
+        self._threads = []
+
+        self.listener = self._listen(address)
+        self.address = self.listener.getsockname()
+        self.port = self.address[1]
+        self._spawn(self._accept, self.listener, _ClientConnection)
+        self.console_listener = self._listen(
+            console_address or (self.address[0], 0))
+        self.console_address = self.console_listener.getsockname()
+        self.console_port = self.console_address[1]
+        self._spawn(self._accept, self.console_listener, _ConsoleConnection)
+
+    def add_user(self, username, password):
+        with self.lock:
+            self.users[username] = tcpr.create_verifier(username, password)
+
+    def close(self):
+        with self.lock:
+            self._closed = True
+            sockets = list(self._sockets)
+            self._sockets.clear()
+        for sock in sockets:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+            sock.close()
+        for thread in list(self._threads):
+            thread.join(5)
+
+    def wait_for_forwards(self, count, timeout=5):
+        """Wait until at least count forwards are registered."""
+        with self.lock:
+            while len(self.forwards) < count:
+                self.changed.wait(timeout)
+                if len(self.forwards) < count:
+                    raise Exception('only %d forwards registered'
+                                    % len(self.forwards))
+
+    def start_forward(self, forward_id, port=0):
+        """Start listening for forward_id, returning the port number."""
+        with self.lock:
+            forward = self.forwards[forward_id]
+            if forward.listener is not None:
+                raise Exception('already started')
+            forward.listener = self._listen(('127.0.0.1', port))
+            forward.port = forward.listener.getsockname()[1]
+        self._spawn(self._accept_guests, forward)
+        return forward.port
+
+    def guest_port(self, port):
+        """The port listening in place of port, started on the console."""
+        with self.lock:
+            return self._guest_ports[port]
+
+    def stop_forward(self, forward_id):
+        with self.lock:
+            forward = self.forwards[forward_id]
+            listener, forward.listener = forward.listener, None
+        if listener is not None:
+            self._close_socket(listener)
+
+    # Plumbing
+
+    def _spawn(self, target, *args):
+        thread = threading.Thread(target=target, args=args)
+        thread.daemon = True
+        thread.start()
+        with self.lock:
+            self._threads = [t for t in self._threads if t.is_alive()]
+            self._threads.append(thread)
+        return thread
+
+    def _listen(self, address):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind(address)
+        sock.listen(128)
+        self._track(sock)
+        return sock
+
+    def _track(self, sock):
+        with self.lock:
+            if self._closed:
+                sock.close()
+                raise socket.error('closed')
+            self._sockets.add(sock)
+
+    def _close_socket(self, sock):
+        with self.lock:
+            self._sockets.discard(sock)
+        try:
+            sock.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+        sock.close()
+
+    def _accept_socket(self, listener):
+        try:
+            (sock, _) = listener.accept()
+            # Otherwise delays from Nagle's algorithm here would swamp the
+            # relay's own in load tests.
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            self._track(sock)
+            return sock
+        except socket.error:
+            return None
+
+    def _error(self, message):
+        with self.lock:
+            self.errors.append(message)
+
+    def _accept(self, listener, connection_class):
+        while True:
+            sock = self._accept_socket(listener)
+            if sock is None:
+                return
+            self._spawn(connection_class(self, sock).run)
+
+    # Guest connections to forwarded ports
+
+    def _accept_guests(self, forward):
+        listener = forward.listener
+        while True:
+            sock = self._accept_socket(listener)
+            if sock is None:
+                return
+            client = forward.reflector
+            with self.lock:
+                tunnel = _Tunnel(client.next_tunnel_id, forward, sock)
+                client.next_tunnel_id += 1
+                client.tunnels[tunnel.id] = tunnel
+                self.tunnels_opened += 1
+            client.send(tcpr.pack('T', tunnel.id, forward.num))
+            self._spawn(self._read_guest, client, tunnel)
+
+    def _read_guest(self, client, tunnel):
+        # Like the real server, data is passed on before the client has
+        # acknowledged the tunnel, and the guest closing its end closes
+        # the whole tunnel.
+        while True:
+            try:
+                data = tunnel.sock.recv(16384)
+            except socket.error:
+                data = ''
+            if not data:
+                break
+            with self.lock:
+                if client.tunnels.get(tunnel.id) is not tunnel:
+                    return
+            client.send(tcpr.pack_data(tunnel.id, data))
+        with self.lock:
+            if client.tunnels.get(tunnel.id) is not tunnel:
+                return
+            del client.tunnels[tunnel.id]
+            client.closed_tunnels.add(tunnel.id)
+        client.send(tcpr.pack('C', tunnel.id, tunnel.forward.num))
+        self._close_socket(tunnel.sock)
+
+class _Connection(object):
+
+    user_prefix = None
+
+    def __init__(self, server, sock):
+        self.server = server
+        self.sock = sock
+        self.reader = tcpr.LineReader(sock)
+        self.send_lock = threading.Lock()
+
+    def send(self, data):
+        with self.send_lock:
+            try:
+                self.sock.sendall(data)
+            except socket.error:
+                pass
+
+    def authenticate(self):
+        line = self.reader.read_until('\n')
+        username = line.split()[1] if line.startswith('USER ') else None
+        A = tcpr.string_to_long(tcpr.decode_chunk(
+            self.reader.read_until('\n\n')))
+        with self.server.lock:
+            user = self.server.users.get(username)
+        if user is None or not username.startswith(self.user_prefix):
+            self.send('No such user "%s".\n' % username)
+            return False
+        (salt, verifier) = user
+        session = tcpr.SrpServerSession(username, salt, verifier, A)
+        self.send('KEY\n' + tcpr.encode_chunk(salt)
+                  + tcpr.encode_chunk(session.B)
+                  + tcpr.encode_chunk(session.u))
+        proof = tcpr.decode_chunk(self.reader.read_until('\n\n'))
+        if proof != session.proof:
+            self.send('Client authentication failed.\n')
+            return False
+        self.send('AOK\n' + tcpr.encode_chunk(session.host_proof()))
+        self.username = username
+        return True
+
+class _ClientConnection(_Connection):
+
+    user_prefix = 'client.'
+
+    def __init__(self, server, sock):
+        _Connection.__init__(self, server, sock)
+        self.tunnels = {}
+        # Tunnels closed by the guest, whose packets may still be on
+        # their way from the client
+        self.closed_tunnels = set()
+        self.forwards = []
+        self.next_tunnel_id = 1
+        self.key = None
+
+    def run(self):
+        try:
+            if self.authenticate() and self.register():
+                self.relay()
+        except (EOFError, socket.error):
+            pass
+        finally:
+            self.disconnect()
+
+    def register(self):
+        header = self.reader.read_until('\r\n').strip()
+        try:
+            (class_name, node_id, hostname) = header.split(None, 2)
+        except ValueError:
+            self.send('513 bad header, bye\r\n')
+            return False
+        key = (class_name, node_id, hostname)
+        with self.server.lock:
+            if any(c.key == key for c in self.server.reflectors):
+                self.send('500 already connected\r\n')
+                return False
+            self.key = key
+            self.server.reflectors.append(self)
+        self.send('400 waiting forwards\r\n')
+
+        while True:
+            line = self.reader.read_until('\r\n').strip()
+            if not line:
+                break
+            (protocol, name) = line.split(None, 1)
+            with self.server.lock:
+                forward = _Forward(self, len(self.server.forwards),
+                                   len(self.forwards), protocol, name)
+                self.forwards.append(forward)
+                self.server.forwards.append(forward)
+                self.server.changed.notify_all()
+        return True
+
+    def read_exactly(self, size):
+        while len(self.reader.buffer) < size:
+            data = self.sock.recv(65536)
+            if not data:
+                raise EOFError('connection closed')
+            self.reader.buffer += data
+        data = self.reader.buffer[:size]
+        self.reader.buffer = self.reader.buffer[size:]
+        return data
+
+    def relay(self):
+        while True:
+            (packet_type, tunnel_id, arg) = tcpr.unpack(
+                self.read_exactly(tcpr.HEADER_SIZE))
+            with self.server.lock:
+                tunnel = self.tunnels.get(tunnel_id)
+                # The client sent these before it saw the C. The real
+                # server doesn't cope with that, but nor can the client.
+                crossed = tunnel_id in self.closed_tunnels
+            if packet_type == 'D':
+                data = self.read_exactly(arg)
+                if crossed:
+                    pass
+                elif tunnel is None:
+                    self.server._error('data for unknown tunnel %d'
+                                       % tunnel_id)
+                elif tunnel.state != 'open':
+                    self.server._error('data for unacknowledged tunnel %d'
+                                       % tunnel_id)
+                else:
+                    try:
+                        tunnel.sock.sendall(data)
+                    except socket.error:
+                        pass
+            elif packet_type == 'T':
+                if crossed:
+                    pass
+                elif tunnel is None:
+                    self.server._error('acknowledgement for unknown tunnel %d'
+                                       % tunnel_id)
+                elif arg == 0:
+                    tunnel.state = 'open'
+                else:
+                    self.drop(tunnel)
+            elif packet_type == 'C':
+                if tunnel is not None:
+                    self.drop(tunnel)
+            elif packet_type == 'P':
+                if arg > 0:
+                    self.send(tcpr.pack('P', tunnel_id, arg - 1))
+            else:
+                self.server._error('unknown packet type %r' % packet_type)
+
+    def drop(self, tunnel):
+        with self.server.lock:
+            if self.tunnels.get(tunnel.id) is tunnel:
+                del self.tunnels[tunnel.id]
+        self.server._close_socket(tunnel.sock)
+
+    def disconnect(self):
+        with self.server.lock:
+            if self in self.server.reflectors:
+                self.server.reflectors.remove(self)
+            tunnels = self.tunnels.values()
+            self.tunnels.clear()
+        for forward in self.forwards:
+            self.server.stop_forward(forward.id)
+        for tunnel in tunnels:
+            self.server._close_socket(tunnel.sock)
+        self.server._close_socket(self.sock)
+
+class _ConsoleConnection(_Connection):
+
+    user_prefix = 'user.'
+
+    def run(self):
+        try:
+            if self.authenticate():
+                self.send('\r\nWelcome %s\r\ntype help for help.\r\n\r\n'
+                          % self.username)
+                while self.command(self.reader.read_until('\r\n').strip()):
+                    pass
+        except (EOFError, socket.error):
+            pass
+        finally:
+            self.server._close_socket(self.sock)
+
+    def reply(self, *lines):
+        self.send(''.join(line + '\r\n' for line in lines) + '\r\n')
+
+    def command(self, line):
+        """Answer the console command line, returning False after quit."""
+        server = self.server
+        with server.lock:
+            server.console_commands.append(line)
+        match = re.match(r'client add (\S+) (\S+)', line)
+        if match:
+            server.add_user('client.' + match.group(1), match.group(2))
+            self.reply('client %s added' % match.group(1))
+            return True
+        if line == 'list':
+            self.reply(*self.list())
+            return True
+        match = re.match(r'start (\d+) \* p=(\d+)$', line)
+        if match:
+            (forward_id, port) = [int(g) for g in match.groups()]
+            try:
+                with server.lock:
+                    if server.forwards[forward_id].listener is not None:
+                        self.reply('553 forward already started, '
+                                   'use modify instead')
+                        return True
+                    server._guest_ports[port] = server.start_forward(
+                        forward_id)
+                    server.forwards[forward_id].console_port = port
+            except IndexError:
+                self.reply('553 unknown or unavailable forward id: %d'
+                           % forward_id)
+            else:
+                self.reply('250 forwarder listening on 0.0.0.0:%d' % port)
+            return True
+        match = re.match(r'stop (\d+)$', line)
+        if match:
+            forward_id = int(match.group(1))
+            if forward_id >= len(server.forwards):
+                self.reply('553 unknown or unavailable forward id: %d'
+                           % forward_id)
+            else:
+                server.stop_forward(forward_id)
+                self.reply('250 forwarder stoped')
+            return True
+        if line in ('exit', 'quit'):
+            self.reply('bye')
+            return False
+        self.reply('command unknown')
+        return True
+
+    def list(self):
+        lines = []
+        with self.server.lock:
+            for client in self.server.reflectors:
+                (class_name, node_id, hostname) = client.key
+                (host, port) = client.sock.getpeername()
+                lines.append('%s %s %s %s:%d' % (class_name, hostname,
+                                                 node_id, host, port))
+                for forward in client.forwards:
+                    status = ''
+                    if forward.listener is not None:
+                        status = ' listening on port %d' % (
+                            forward.console_port or forward.port)
+                    lines.append('   #%d %s %s%s' % (forward.id,
+                                                     forward.protocol,
+                                                     forward.name, status))
+        if lines:
+            return lines + ['250 OK']
+        return ['251 no match']
+
+def _address(s):
+    (host, port) = s.rsplit(':', 1)
+    return (host, int(port))
+
+def main(args=None):
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--listen', type=_address, required=True,
+                        metavar='HOST:PORT')
+    parser.add_argument('--console', type=_address, required=True,
+                        metavar='HOST:PORT')
+    parser.add_argument('--user', action='append', default=[],
+                        metavar='NAME:PASSWORD')
+    args = parser.parse_args(args=args)
+
+    reflector = FakeReflector(args.listen, args.console)
+    for user in args.user:
+        reflector.add_user(*user.split(':', 1))
+    stopped = threading.Event()
+    signal.signal(signal.SIGTERM, lambda signum, frame: stopped.set())
+    try:
+        # With a timeout, so that signals are handled
+        while not stopped.is_set():
+            stopped.wait(1)
+    finally:
+        reflector.close()
+
+if __name__ == '__main__':
+    sys.exit(main())
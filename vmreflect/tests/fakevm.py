@@ -0,0 +1,727 @@
+# coding: UTF-8
+
+"""
+A simulated Windows guest for testing the VM API without VMware.
+
+FakeGuest keeps a guest filesystem, a process table, and a tiny CMD
+interpreter in memory, and answers the same vmrun-style operations that a
+backend’s run() method receives. Every operation can be given an injected
+latency, and logging in can be given one too, so that per-operation costs
+can be measured with and without a persistent session.
+"""
+
+import atexit
+import fnmatch
+import os
+import re
+import shutil
+import signal
+import tempfile
+import threading
+import time
+
+from vmreflect import cab
+from vmreflect.addresses import AddressCache
+from vmreflect.vmapi import VM, GuestProcess
+
+_INVALID_LOGIN = 'Error: Invalid user name or password for the guest OS'
+
+_IPCONFIG = """\r
+Windows IP Configuration\r
+\r
+\r
+Ethernet adapter Local Area Connection:\r
+\r
+        Connection-specific DNS Suffix  . : localdomain\r
+        IP Address. . . . . . . . . . . . : %(ip_address)s\r
+        Subnet Mask . . . . . . . . . . . : 255.255.255.0\r
+        Default Gateway . . . . . . . . . : 192.168.56.2\r
+"""
+
+_NETSTAT_HEADER = """\r
+Active Connections\r
+\r
+  Proto  Local Address          Foreign Address        State\r
+"""
+
+_WMIC_CREATED = """Executing (Win32_Process)->Create()\r
+Method execution successful.\r
+Out Parameters:\r
+instance of __PARAMETERS\r
+{\r
+        ProcessId = %d;\r
+        ReturnValue = 0;\r
+};\r
+"""
+
+_NOT_RECOGNIZED = ("'%s' is not recognized as an internal or external"
+                   " command,\r\noperable program or batch file.\r\n")
+
+_re_redirect = re.compile(r'(\d?)(>>|>|<)\s*(&\d|"[^"]*"|[^\s()&|<>]+)')
+_re_word = re.compile(r'"[^"]*"|[^\s"]+')
+_re_variable = re.compile(r'%(\w+)%')
+
+def _normalize(guest_path):
+    return guest_path.replace('/', '\\').rstrip('\\').lower()
+
+def _unquote(s):
+    if len(s) >= 2 and s[0] == s[-1] == '"':
+        return s[1:-1]
+    return s
+
+def _split_top_level(line, separators, operators=None):
+    """Split line on any of separators, outside of quotes and parentheses.
+
+    An & that is part of a 2>&1 redirection is not a separator. If
+    operators is a list, the separator between each pair of parts, such
+    as & or &&, is appended to it.
+    """
+    parts = []
+    depth = 0
+    quoted = False
+    start = 0
+    i = 0
+    while i < len(line):
+        c = line[i]
+        if c == '"':
+            quoted = not quoted
+        elif quoted:
+            pass
+        elif c == '(':
+            depth += 1
+        elif c == ')':
+            depth -= 1
+        elif depth == 0 and c in separators:
+            if c == '&' and i > 0 and line[i - 1] == '>':
+                pass
+            else:
+                parts.append(line[start:i])
+                operator = c
+                if line[i:i + 2] in ('&&', '||'):
+                    operator = line[i:i + 2]
+                    i += 1
+                if operators is not None:
+                    operators.append(operator)
+                start = i + 1
+        i += 1
+    parts.append(line[start:])
+    return parts
+
+def _strip_redirects(stage):
+    """Return stage without its top-level redirections, and a list of
+    (fd, operator, target) tuples for them."""
+    body = ''
+    redirects = []
+    depth = 0
+    quoted = False
+    i = 0
+    while i < len(stage):
+        c = stage[i]
+        if c == '"':
+            quoted = not quoted
+        elif not quoted and c == '(':
+            depth += 1
+        elif not quoted and c == ')':
+            depth -= 1
+        elif not quoted and depth == 0 and (c in '<>' or (
+                c.isdigit() and stage[i + 1:i + 2] == '>')):
+            match = _re_redirect.match(stage, i)
+            if match:
+                redirects.append((match.group(1) or None, match.group(2),
+                                  _unquote(match.group(3))))
+                i = match.end()
+                continue
+        body += c
+        i += 1
+    return (body.strip(), redirects)
+
+def _lookup(programs, command):
+    basename = os.path.basename(_unquote(command).replace('\\', '/')).lower()
+    if basename in programs:
+        return programs[basename]
+    for pattern, handler in programs.items():
+        if fnmatch.fnmatchcase(basename, pattern):
+            return handler
+    return None
+
+class _FakeSession(object):
+    """A connection to a FakeGuest that has already logged in."""
+
+    def __init__(self, guest):
+        self.guest = guest
+
+    def run(self, cmd_args):
+        return self.guest.run(cmd_args)
+
+    def close(self):
+        pass
+
+class FakeBackend(object):
+    """
+    Backend that talks to a FakeGuest the way vmrun does, logging in again
+    for every operation.
+    """
+
+    def __init__(self, guest, username='Administrator', password='test'):
+        self.guest = guest
+        self.username = username
+        self.password = password
+
+    def run(self, cmd_args):
+        if not self.guest.login(self.username, self.password):
+            return (255, _INVALID_LOGIN, '')
+        return self.guest.run(cmd_args)
+
+    def close(self):
+        pass
+
+class FakeGuest(object):
+    """
+    A simulated Windows XP guest.
+
+    latency is slept on every operation and login_latency on every login.
+    Programs other than the CMD builtins are looked up by lowercase
+    basename, or by a wildcard pattern matching it, in the programs dict,
+    and are called as
+    handler(guest, argv, stdin) returning (returncode, stdout, stderr).
+    Programs launched with start or wmic process call create are added to
+    the process table and, if their basename is in background_programs,
+    that handler is called as handler(guest, pid, argv). A handler that
+    starts a process on the host to stand in for the guest one can put its
+    pid in host_pids, under the guest pid, and it is sent SIGTERM when the
+    guest process is killed. netstat shows the ports in listening as
+    listening, and killing the process they map to stops them. cmd /c
+    script.bat runs the script on a thread of its own, in the directory
+    it was started in, and wait_for_background() waits for those threads.
+
+    Guests can be pickled, but the programs and background_programs dicts
+    are reset to their defaults when they are unpickled.
+    """
+
+    temp_dir = r'C:\DOCUME~1\ADMINI~1\LOCALS~1\Temp'
+
+    def __init__(self, username='Administrator', password='test',
+                 latency=0, login_latency=0, ip_address='192.168.56.101'):
+        self.username = username
+        self.password = password
+        self.latency = latency
+        self.login_latency = login_latency
+        self.ip_address = ip_address
+        self.lock = threading.RLock()
+        self.files = {}
+        self.dirs = set()
+        self.names = {}
+        self.calls = []
+        self.logins = 0
+        self.processes = [
+            GuestProcess(4, r'NT AUTHORITY\SYSTEM', 'System'),
+            GuestProcess(1420, r'ADMIN\Administrator',
+                         r'"C:\WINDOWS\system32\cmd.exe"'),
+        ]
+        self.host_pids = {}
+        self.listening = {445: 4}
+        self.process_dirs = {}
+        self._threads = []
+        self._next_pid = 2000
+        self._next_temp = 100
+        self._default_programs()
+        for d in [r'C:\WINDOWS\system32', self.temp_dir]:
+            self.make_dirs(d)
+
+    def _default_programs(self):
+        self.programs = {
+            'ipconfig': FakeGuest._ipconfig,
+            'ipconfig.exe': FakeGuest._ipconfig,
+            'netstat': FakeGuest._netstat,
+            'netstat.exe': FakeGuest._netstat,
+            'find': FakeGuest._find,
+            'find.exe': FakeGuest._find,
+            'more': FakeGuest._more,
+            'more.com': FakeGuest._more,
+            'wmic': FakeGuest._wmic,
+            'wmic.exe': FakeGuest._wmic,
+            'expand': FakeGuest._expand_cab,
+            'expand.exe': FakeGuest._expand_cab,
+            'makecab': FakeGuest._makecab,
+            'makecab.exe': FakeGuest._makecab,
+        }
+        self.background_programs = {
+            'cmd': FakeGuest._cmd_background,
+            'cmd.exe': FakeGuest._cmd_background,
+        }
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        for name in ['lock', 'programs', 'background_programs', '_threads']:
+            del state[name]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.RLock()
+        self._threads = []
+        self._default_programs()
+
+    # Filesystem
+
+    def make_dirs(self, guest_path):
+        with self.lock:
+            parts = guest_path.replace('/', '\\').rstrip('\\').split('\\')
+            for i in range(1, len(parts) + 1):
+                key = _normalize('\\'.join(parts[:i]))
+                if key not in self.dirs:
+                    self.dirs.add(key)
+                    self.names[key] = parts[i - 1]
+
+    def is_dir(self, guest_path):
+        return _normalize(guest_path) in self.dirs
+
+    def is_file(self, guest_path):
+        return _normalize(guest_path) in self.files
+
+    def read_file(self, guest_path):
+        return self.files[_normalize(guest_path)]
+
+    def write_file(self, guest_path, data, append=False):
+        with self.lock:
+            key = _normalize(guest_path)
+            if key.rpartition('\\')[0] not in self.dirs:
+                raise IOError('The system cannot find the path specified.')
+            if append:
+                data = self.files.get(key, '') + data
+            self.files[key] = data
+            self.names.setdefault(
+                key, guest_path.replace('/', '\\').rpartition('\\')[2])
+
+    def _remove_tree(self, guest_path):
+        key = _normalize(guest_path)
+        prefix = key + '\\'
+        for name in [n for n in self.files if n.startswith(prefix)]:
+            self.delete_file(name)
+        for name in [n for n in self.dirs
+                     if n == key or n.startswith(prefix)]:
+            self.dirs.remove(name)
+            self.names.pop(name, None)
+
+    def delete_file(self, guest_path):
+        key = _normalize(guest_path)
+        self.names.pop(key, None)
+        return self.files.pop(key, None) is not None
+
+    def _listdir(self, guest_path):
+        prefix = _normalize(guest_path) + '\\'
+        names = set()
+        for name in list(self.files) + list(self.dirs):
+            if name.startswith(prefix) and '\\' not in name[len(prefix):]:
+                names.add(self.names[name])
+        return sorted(names)
+
+    # Processes
+
+    def add_process(self, cmd, owner=r'ADMIN\Administrator'):
+        with self.lock:
+            pid = self._next_pid
+            self._next_pid += 4
+            self.processes.append(GuestProcess(pid, owner, cmd))
+            return pid
+
+    def find_process(self, pid):
+        for p in self.processes:
+            if p.pid == pid:
+                return p
+        return None
+
+    # Backend interface
+
+    def login(self, username, password):
+        self.logins += 1
+        if self.login_latency:
+            time.sleep(self.login_latency)
+        return username == self.username and password == self.password
+
+    def open_session(self, username, password):
+        """backend_factory for a vmreflect.session.SessionServer"""
+        if not self.login(username, password):
+            raise Exception(_INVALID_LOGIN)
+        return _FakeSession(self)
+
+    def run(self, cmd_args):
+        name = cmd_args[0].lower()
+        with self.lock:
+            self.calls.append(name)
+        if self.latency:
+            time.sleep(self.latency)
+        try:
+            handler = getattr(self, '_op_' + name)
+        except AttributeError:
+            return (255, 'Error: Unrecognized command: %s' % cmd_args[0], '')
+        with self.lock:
+            return handler(*cmd_args[2:])
+
+    def call_count(self, name=None):
+        if name is None:
+            return len(self.calls)
+        return self.calls.count(name.lower())
+
+    # vmrun operations
+
+    def _op_createtempfileinguest(self):
+        self._next_temp += 1
+        guest_path = '%s\\vmware%d' % (self.temp_dir, self._next_temp)
+        self.write_file(guest_path, '')
+        return (0, guest_path + '\n', '')
+
+    def _op_deletefileinguest(self, guest_path):
+        if not self.delete_file(guest_path):
+            return (255, 'Error: A file was not found', '')
+        return (0, '', '')
+
+    def _op_deletedirectoryinguest(self, guest_path):
+        if not self.is_dir(guest_path):
+            return (255, 'Error: A file was not found', '')
+        self._remove_tree(guest_path)
+        return (0, '', '')
+
+    def _op_fileexistsinguest(self, guest_path):
+        if not self.is_file(guest_path):
+            return (255, 'The file does not exist.\n', '')
+        return (0, 'The file exists.\n', '')
+
+    def _op_createdirectoryinguest(self, guest_path):
+        if self.is_dir(guest_path) or self.is_file(guest_path):
+            return (255, 'Error: The file already exists', '')
+        self.make_dirs(guest_path)
+        return (0, '', '')
+
+    def _op_renamefileinguest(self, old_path, new_path):
+        with self.lock:
+            if not self.is_file(old_path):
+                return (255, 'Error: A file was not found', '')
+            if self.is_file(new_path) or self.is_dir(new_path):
+                return (255, 'Error: The file already exists', '')
+            data = self.read_file(old_path)
+            self.delete_file(old_path)
+            self.write_file(new_path, data)
+        return (0, '', '')
+
+    def _op_copyfilefromhosttoguest(self, host_path, guest_path):
+        if os.path.isdir(host_path):
+            self.make_dirs(guest_path)
+            for name in os.listdir(host_path):
+                self._op_copyfilefromhosttoguest(
+                    os.path.join(host_path, name), guest_path + '\\' + name)
+        else:
+            with open(host_path, 'rb') as f:
+                data = f.read()
+            try:
+                self.write_file(guest_path, data)
+            except IOError:
+                return (255, 'Error: A file was not found', '')
+        return (0, '', '')
+
+    def _op_copyfilefromguesttohost(self, guest_path, host_path):
+        if self.is_dir(guest_path):
+            if not os.path.isdir(host_path):
+                os.mkdir(host_path)
+            for name in self._listdir(guest_path):
+                self._op_copyfilefromguesttohost(
+                    guest_path + '\\' + name, os.path.join(host_path, name))
+        elif self.is_file(guest_path):
+            with open(host_path, 'wb') as f:
+                f.write(self.read_file(guest_path))
+        else:
+            return (255, 'Error: A file was not found', '')
+        return (0, '', '')
+
+    def _op_listdirectoryinguest(self, guest_path):
+        if not self.is_dir(guest_path):
+            return (255, 'Error: A file was not found', '')
+        names = self._listdir(guest_path)
+        lines = ['Directory list: %d' % len(names)] + names
+        return (0, '\n'.join(lines) + '\n', '')
+
+    def _op_getguestipaddress(self):
+        return (0, self.ip_address + '\n', '')
+
+    def _op_listprocessesinguest(self):
+        lines = ['Process list: %d' % len(self.processes)]
+        lines.extend('pid=%d, owner=%s, cmd=%s' % p for p in self.processes)
+        return (0, '\n'.join(lines) + '\n', '')
+
+    def _op_killprocessinguest(self, pid):
+        process = self.find_process(int(pid))
+        if process is None:
+            return (255, 'Error: Unknown error', '')
+        self.processes.remove(process)
+        for (port, pid) in self.listening.items():
+            if pid == process.pid:
+                del self.listening[port]
+        host_pid = self.host_pids.pop(process.pid, None)
+        if host_pid is not None:
+            try:
+                os.kill(host_pid, signal.SIGTERM)
+            except OSError:
+                pass
+        return (0, '', '')
+
+    def _op_runscriptinguest(self, interpreter, script):
+        returncode = self._run_script(script)
+        if returncode:
+            return (255, 'Guest program exited with non-zero exit code: %d'
+                    % returncode, '')
+        return (0, '', '')
+
+    # CMD interpreter
+
+    def _run_script(self, script):
+        """Run the lines of script and return the last exit code."""
+        returncode = 0
+        for line in script.replace('\r\n', '\n').split('\n'):
+            line = self._expand(line.strip(), returncode)
+            if not line or line.lower().startswith('rem '):
+                continue
+            match = re.match(r'exit\s+/b\s+(\d+)$', line, re.I)
+            if match:
+                returncode = int(match.group(1))
+                break
+            (returncode, _, _) = self._run_line(line)
+        return returncode
+
+    def _expand(self, line, errorlevel):
+        variables = {'temp': self.temp_dir, 'tmp': self.temp_dir,
+                     'errorlevel': str(errorlevel)}
+        return _re_variable.sub(
+            lambda m: variables.get(m.group(1).lower(), m.group(0)), line)
+
+    def _run_line(self, line, stdin=''):
+        """Run a line of CMD and return (returncode, stdout, stderr)."""
+        returncode, stdout, stderr = 0, '', ''
+        operators = []
+        for (i, command) in enumerate(_split_top_level(line, '&',
+                                                       operators)):
+            if not command.strip():
+                continue
+            if i and operators[i - 1] == '&&' and returncode:
+                continue
+            stdin_for_stage = stdin
+            for stage in _split_top_level(command, '|'):
+                (returncode, stage_out, stage_err) = self._run_stage(
+                    stage.strip(), stdin_for_stage)
+                stdin_for_stage = stage_out
+                stderr += stage_err
+            stdout += stdin_for_stage
+        return (returncode, stdout, stderr)
+
+    def _run_stage(self, stage, stdin):
+        (body, redirects) = _strip_redirects(stage)
+
+        for (fd, op, target) in redirects:
+            if op == '<' and target.lower() != 'nul':
+                stdin = self.read_file(target)
+
+        if body.startswith('(') and body.endswith(')'):
+            (returncode, stdout, stderr) = self._run_line(body[1:-1], stdin)
+        else:
+            (returncode, stdout, stderr) = self._run_simple(body, stdin)
+
+        for (fd, op, target) in redirects:
+            if op == '<':
+                continue
+            if fd == '2' and target == '&1':
+                stdout, stderr = stdout + stderr, ''
+                continue
+            data = stderr if fd == '2' else stdout
+            if fd == '2':
+                stderr = ''
+            else:
+                stdout = ''
+            if target.lower() == 'nul':
+                continue
+            try:
+                self.write_file(target, data, append=(op == '>>'))
+            except IOError, e:
+                return (1, stdout, stderr + '%s\r\n' % e)
+        return (returncode, stdout, stderr)
+
+    def _run_simple(self, command, stdin):
+        words = _re_word.findall(command)
+        if not words:
+            return (0, '', '')
+        name = words[0].lower()
+        if name == 'echo' or name.startswith('echo.'):
+            text = command[4:].strip() if name == 'echo' else command[5:]
+            return (0, (text or 'ECHO is on.') + '\r\n', '')
+        if name in ('mkdir', 'md'):
+            target = _unquote(words[1])
+            if self.is_dir(target) or self.is_file(target):
+                return (1, '', 'A subdirectory or file %s already exists.\r\n'
+                        % target)
+            self.make_dirs(target)
+            return (0, '', '')
+        if name in ('rmdir', 'rd'):
+            for word in words[1:]:
+                if not word.startswith('/'):
+                    self._remove_tree(_unquote(word))
+            return (0, '', '')
+        if name in ('del', 'erase'):
+            for word in words[1:]:
+                if not word.startswith('/'):
+                    self.delete_file(_unquote(word))
+            return (0, '', '')
+        if name == 'type':
+            target = _unquote(words[1])
+            if not self.is_file(target):
+                return (1, '', 'The system cannot find the file specified.\r\n')
+            return (0, self.read_file(target), '')
+        if name == 'start':
+            args = words[1:]
+            if args and args[0].startswith('"'):
+                args = args[1:]
+            self._start_process(args)
+            return (0, '', '')
+        handler = _lookup(self.programs, words[0])
+        if handler is None:
+            return (9009, '', _NOT_RECOGNIZED % _unquote(words[0]))
+        return handler(self, [_unquote(w) for w in words], stdin)
+
+    def _start_process(self, words, directory=None):
+        pid = self.add_process(' '.join(words))
+        if directory is not None:
+            self.process_dirs[pid] = directory
+        handler = _lookup(self.background_programs, words[0])
+        if handler:
+            handler(self, pid, [_unquote(w) for w in words])
+        return pid
+
+    # Programs
+
+    def _ipconfig(self, argv, stdin):
+        return (0, _IPCONFIG % {'ip_address': self.ip_address}, '')
+
+    def _netstat(self, argv, stdin):
+        lines = ['  TCP    %-22s 0.0.0.0:0              LISTENING\r\n'
+                 % ('0.0.0.0:%d' % port) for port in sorted(self.listening)]
+        # Not listening
+        lines.append('  TCP    %-22s 192.168.56.2:80        ESTABLISHED\r\n'
+                     % ('%s:1053' % self.ip_address))
+        return (0, _NETSTAT_HEADER + ''.join(lines), '')
+
+    def _find(self, argv, stdin):
+        needle = argv[-1]
+        lines = [l for l in stdin.splitlines(True) if needle in l]
+        return (0 if lines else 1, ''.join(lines), '')
+
+    def _more(self, argv, stdin):
+        return (0, stdin, '')
+
+    def _wmic(self, argv, stdin):
+        # Only wmic process call create "command line"[,"directory"]
+        if [a.lower() for a in argv[1:4]] != ['process', 'call', 'create']:
+            return (44135, '', 'Invalid alias verb.\r\n')
+        directory = None
+        if len(argv) > 6 and argv[5] == ',':
+            directory = argv[6]
+        pid = self._start_process(_re_word.findall(argv[4]), directory)
+        return (0, _WMIC_CREATED % pid, '')
+
+    def _cmd_background(self, pid, argv):
+        # Only cmd /c script
+        script = argv[2] if len(argv) == 3 and argv[1].lower() == '/c' else ''
+        if script and ':' not in script:
+            script = '%s\\%s' % (self.process_dirs.get(pid, 'C:'), script)
+        thread = threading.Thread(target=self._run_background_script,
+                                  args=(pid, script))
+        thread.daemon = True
+        with self.lock:
+            self._threads.append(thread)
+        thread.start()
+
+    def _run_background_script(self, pid, script):
+        try:
+            if self.is_file(script):
+                self._run_script(self.read_file(script))
+        finally:
+            with self.lock:
+                process = self.find_process(pid)
+                if process is not None:
+                    self.processes.remove(process)
+                self.process_dirs.pop(pid, None)
+
+    def wait_for_background(self):
+        """Wait for the scripts started with cmd /c to finish."""
+        with self.lock:
+            (threads, self._threads) = (self._threads, [])
+        for thread in threads:
+            thread.join()
+
+    def _expand_cab(self, argv, stdin):
+        # Only expand source.cab -F:files destination
+        patterns = [a[3:] for a in argv[1:] if a.lower().startswith('-f:')]
+        paths = [a for a in argv[1:] if not a.lower().startswith('-f:')]
+        if len(patterns) != 1 or len(paths) != 2:
+            return (1, '', 'Invalid parameters.\r\n')
+        (source, destination) = paths
+        if not self.is_file(source):
+            return (1, '', "Can't open input file: %s.\r\n" % source)
+        if not self.is_dir(destination):
+            return (1, '', "Can't open output directory: %s.\r\n"
+                    % destination)
+        try:
+            files = cab.unpack(self.read_file(source))
+        except cab.CabError, e:
+            return (1, '', '%s: %s\r\n' % (source, e))
+        stdout = ''
+        for (name, data) in files:
+            if fnmatch.fnmatch(name.lower(), patterns[0].lower()):
+                self.write_file(destination + '\\' + name, data)
+                stdout += 'Expanding %s to %s\\%s.\r\n' % (
+                    source, destination, name)
+        return (0, stdout, '')
+
+    def _makecab(self, argv, stdin):
+        # Only makecab /f directives.ddf, with .Set and file lines
+        if len(argv) != 3 or argv[1].lower() != '/f':
+            return (1, 'ERROR: Invalid parameters\r\n', '')
+        if not self.is_file(argv[2]):
+            return (1, 'ERROR: Could not find file: %s\r\n' % argv[2], '')
+        variables = {}
+        files = []
+        for line in self.read_file(argv[2]).splitlines():
+            match = re.match(r'\.set\s+(\w+)=(.*)$', line.strip(), re.I)
+            if match:
+                variables[match.group(1).lower()] = _unquote(match.group(2))
+                continue
+            words = [_unquote(w) for w in _re_word.findall(line)]
+            if not words or words[0].startswith('.'):
+                continue
+            if not self.is_file(words[0]):
+                return (1, 'ERROR: Could not find file: %s\r\n' % words[0],
+                        '')
+            files.append((words[-1].rpartition('\\')[2],
+                          self.read_file(words[0])))
+        directory = variables.get('diskdirectorytemplate', '.')
+        name = variables.get('cabinetnametemplate', '1.cab')
+        self.write_file(directory + '\\' + name, cab.pack(files))
+        return (0, 'Microsoft (R) Cabinet Maker\r\n', '')
+
+_vmx_dir = None
+
+def _vmx_file():
+    global _vmx_dir
+    if _vmx_dir is None:
+        _vmx_dir = tempfile.mkdtemp(prefix='vmreflect')
+        atexit.register(shutil.rmtree, _vmx_dir, True)
+        with open(os.path.join(_vmx_dir, 'fake.vmx'), 'w') as f:
+            f.write('displayName = "fake"\n')
+    return os.path.join(_vmx_dir, 'fake.vmx')
+
+def fake_vm(guest, backend=None, **kwargs):
+    """
+    Return a VM whose operations go to guest, remembering its address only
+    in memory.
+    """
+    if backend is None:
+        backend = FakeBackend(guest, guest.username, guest.password)
+    kwargs.setdefault('address_cache', AddressCache())
+    return VM(vm_name=_vmx_file(), username=guest.username,
+              password=guest.password, backend=backend, **kwargs)
@@ -0,0 +1,160 @@
+"""
+A stand-in for the vmrun program, so that the VM API and whole tunnels can
+be run, and timed, without VMware.
+
+FakeVmrun writes a FakeGuest to a state file and points the VMRUN
+environment variable at a script that runs this module. Every vmrun
+process then loads the guest, applies one operation to it and saves it
+again, holding a lock so that concurrent processes take turns. The
+guest's latency and login_latency are slept before taking the lock, the
+way real vmrun processes wait at the same time.
+
+The guest can run tcpr.exe: -m sets the manager password, and starting it
+with -s starts the stand-in reflector server on the host, on the ports
+from its .ini file, so the guest's IP address is 127.0.0.1.
+"""
+
+import cPickle as pickle
+import fcntl
+import os
+import pipes
+import re
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+from contextlib import contextmanager
+
+from path import path
+
+from vmreflect.tests.fakevm import FakeBackend
+
+def _tcpr(guest, argv, stdin):
+    if '-m' in argv:
+        password = argv[argv.index('-m') + 1]
+        guest.write_file(_user_db(guest, argv[1]),
+                         'user.manager:%s\n' % password)
+        return (0, 'manager password changed\r\n', '')
+    return (1, '', 'unsupported\r\n')
+
+def _user_db(guest, ini_path):
+    match = re.search(r'^user_db=(.*)$', guest.read_file(ini_path), re.M)
+    return match.group(1).strip()
+
+def _tcpr_server(guest, pid, argv):
+    ini = guest.read_file(argv[1])
+    (server_port, console_port) = [
+        int(re.search(r'^%s=.*:(\d+)$' % name, ini, re.M).group(1))
+        for name in ['listen', 'listen_cmd']]
+    cmd = [sys.executable, '-m', 'vmreflect.tests.fakereflector',
+           '--listen', '127.0.0.1:%d' % server_port,
+           '--console', '127.0.0.1:%d' % console_port]
+    for user in guest.read_file(_user_db(guest, argv[1])).split():
+        cmd.extend(['--user', user])
+    with open(os.devnull, 'r+b') as devnull:
+        proc = subprocess.Popen(cmd, stdin=devnull, stdout=devnull,
+                                stderr=devnull, close_fds=True)
+    guest.host_pids[pid] = proc.pid
+    guest.listening[server_port] = guest.listening[console_port] = pid
+
+def _add_programs(guest):
+    guest.programs['tcpr*.exe'] = _tcpr
+    guest.background_programs['tcpr*.exe'] = _tcpr_server
+
+@contextmanager
+def _locked(state):
+    with open(state + '.lock', 'a') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+def _load(state):
+    with open(state, 'rb') as f:
+        guest = pickle.load(f)
+    _add_programs(guest)
+    return guest
+
+def _save(state, guest):
+    temp_name = state + '.new'
+    with open(temp_name, 'wb') as f:
+        pickle.dump(guest, f, pickle.HIGHEST_PROTOCOL)
+    os.rename(temp_name, state)
+
+class FakeVmrun(object):
+    """
+    Sets VMRUN to a stand-in vmrun for guest, a FakeGuest, until close().
+    guest() returns the guest as it is after the operations so far.
+    """
+
+    def __init__(self, guest):
+        self.directory = path(tempfile.mkdtemp(prefix='vmreflect'))
+        self.state = self.directory.joinpath('guest.pickle')
+        self.script = self.directory.joinpath('vmrun')
+
+        (latency, login_latency) = (guest.latency, guest.login_latency)
+        guest.latency = guest.login_latency = 0
+        try:
+            _save(self.state, guest)
+        finally:
+            (guest.latency, guest.login_latency) = (latency, login_latency)
+
+        package_root = path(__file__).abspath().dirname().dirname().dirname()
+        with open(self.script, 'w') as f:
+            f.write('#!/bin/sh\n'
+                    'PYTHONPATH=%s${PYTHONPATH:+:$PYTHONPATH}\n'
+                    'export PYTHONPATH\n'
+                    'exec %s -m vmreflect.tests.fakevmrun --state %s'
+                    ' --latency %s --login-latency %s "$@"\n'
+                    % tuple(pipes.quote(str(s)) for s in [
+                        package_root, sys.executable, self.state,
+                        latency, login_latency]))
+        os.chmod(self.script, 0700)
+
+        self._saved_vmrun = os.environ.get('VMRUN')
+        os.environ['VMRUN'] = self.script
+
+    def guest(self):
+        with _locked(self.state):
+            return _load(self.state)
+
+    def close(self):
+        if self._saved_vmrun is None:
+            os.environ.pop('VMRUN', None)
+        else:
+            os.environ['VMRUN'] = self._saved_vmrun
+        # Servers the guest left running
+        for host_pid in self.guest().host_pids.values():
+            try:
+                os.kill(host_pid, signal.SIGTERM)
+            except OSError:
+                pass
+        shutil.rmtree(self.directory)
+
+def main(args=None):
+    """Run as vmrun [-T type] -gu user -gp password operation vmx args..."""
+    args = list(sys.argv[1:] if args is None else args)
+    options = {'--state': None, '--latency': '0', '--login-latency': '0',
+               '-T': None, '-gu': None, '-gp': None}
+    while args and args[0] in options:
+        name = args.pop(0)
+        options[name] = args.pop(0)
+
+    time.sleep(float(options['--login-latency'])
+               + float(options['--latency']))
+    state = options['--state']
+    with _locked(state):
+        guest = _load(state)
+        backend = FakeBackend(guest, options['-gu'], options['-gp'])
+        (returncode, stdout, stderr) = backend.run(args)
+        guest.wait_for_background()
+        _save(state, guest)
+    sys.stdout.write(stdout)
+    sys.stderr.write(stderr)
+    return returncode
+
+if __name__ == '__main__':
+    sys.exit(main())
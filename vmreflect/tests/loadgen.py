@@ -0,0 +1,397 @@
+"""
+A load generator for the data path of a tunnel: many connections at once,
+like a browser fetching a development site's assets, through the relay
+and the stand-in reflector server, with no VM needed:
+
+    python -m vmreflect.tests.loadgen --connections 50 --requests 2000 \\
+        --response-size 2k,64k,8m --rate 500 --half-close 0.1
+
+The host end is the Server from test_end_to_end with LoadRequestHandler,
+which answers each request with as many bytes as the request asks for,
+streamed in chunks. Each connection makes up to --keep-alive requests
+before being closed. With --rate, requests are started on a fixed
+schedule rather than as fast as the connections allow, and latency is
+measured from when each one was due, so that a stalled tunnel shows up
+in the percentiles instead of just slowing the load down.
+
+A --half-close fraction of requests close their connection halfway,
+alternating between two ways that the relay has to get right:
+
+- The guest sends its body and shuts down its side of the connection,
+  and then waits for the connection to close. The reflector server closes
+  the whole tunnel when the guest's side is shut down, so no response can
+  come back. The host end sends one byte first, as a go-ahead. A tunnel
+  closed before the relay acknowledges it would have the relay
+  acknowledge a tunnel that the server has forgotten, which the real
+  server can't cope with; with the go-ahead, that can't happen.
+- The guest sends its body along with the request, and the host end
+  sends the response and shuts down its side of the connection before
+  reading the body. The relay then closes the tunnel, so the body is
+  kept to HALF_CLOSE_BODY_SIZE bytes, for it to be on its way already.
+
+The bytes that the host end received are checked against those sent, so
+that data lost in a half-close is reported.
+"""
+
+import Queue
+import SocketServer
+import argparse
+import math
+import socket
+import struct
+import sys
+import threading
+import time
+from collections import namedtuple
+
+from vmreflect.relay import Forward, Relay
+from vmreflect.tests.fakereflector import FakeReflector
+from vmreflect.tests.test_end_to_end import Server
+
+# Request body size, response size, mode
+_HEADER = struct.Struct('!qqB')
+
+(REQUEST, GUEST_HALF_CLOSE, HOST_HALF_CLOSE) = range(3)
+
+HALF_CLOSE_BODY_SIZE = 8 * 1024
+
+_CHUNK = ''.join(chr(i % 251) for i in range(64 * 1024))
+
+Request = namedtuple('Request', 'request_size response_size mode')
+
+LoadResult = namedtuple('LoadResult', 'requests latencies errors bytes_sent'
+                        ' bytes_received bytes_lost elapsed')
+
+class LoadError(Exception):
+    pass
+
+def _read_exactly(sock, size):
+    """Read size bytes, but return '' if the connection is closed first."""
+    chunks = []
+    while size:
+        data = sock.recv(min(size, 65536))
+        if not data:
+            if chunks:
+                raise EOFError('connection closed mid-header')
+            return ''
+        chunks.append(data)
+        size -= len(data)
+    return ''.join(chunks)
+
+def _send_bytes(sock, size):
+    while size > 0:
+        chunk = _CHUNK[:min(size, len(_CHUNK))]
+        sock.sendall(chunk)
+        size -= len(chunk)
+
+def _receive_bytes(sock, size=None):
+    """Read size bytes, or to end of file if size is None."""
+    received = 0
+    while size is None or received < size:
+        wanted = 65536 if size is None else min(65536, size - received)
+        data = sock.recv(wanted)
+        if not data:
+            if size is not None:
+                raise LoadError('short response: %d of %d bytes'
+                                % (received, size))
+            break
+        received += len(data)
+    return received
+
+class LoadRequestHandler(SocketServer.BaseRequestHandler):
+    """
+    Serves requests made of a header, packed as _HEADER, and a body, in
+    one of the modes described in the module docstring.
+    """
+
+    def handle(self):
+        sock = self.request
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        while True:
+            header = _read_exactly(sock, _HEADER.size)
+            if not header:
+                return
+            (request_size, response_size, mode) = _HEADER.unpack(header)
+            if mode == HOST_HALF_CLOSE:
+                _send_bytes(sock, response_size)
+                sock.shutdown(socket.SHUT_WR)
+                self.server.count(_receive_bytes(sock))
+                return
+            if mode == GUEST_HALF_CLOSE:
+                sock.sendall('+')
+                self.server.count(_receive_bytes(sock))
+                return
+            self.server.count(_receive_bytes(sock, request_size))
+            _send_bytes(sock, response_size)
+
+class LoadServer(Server):
+    """A Server with LoadRequestHandler that counts the bytes it read."""
+
+    def __init__(self, **kwargs):
+        Server.__init__(self, handler=LoadRequestHandler, **kwargs)
+        self.server.bytes_received = 0
+        self.server.count = self._count
+        self._lock = threading.Lock()
+
+    @property
+    def bytes_received(self):
+        return self.server.bytes_received
+
+    def _count(self, size):
+        with self._lock:
+            self.server.bytes_received += size
+
+def percentile(values, fraction):
+    """The nearest-rank percentile of values, or None if there are none."""
+    if not values:
+        return None
+    values = sorted(values)
+    rank = int(math.ceil(fraction * len(values)))
+    return values[max(rank, 1) - 1]
+
+def make_requests(count, request_sizes, response_sizes, half_close=0.0):
+    """
+    count Requests cycling through the sizes given, with a half_close
+    fraction of them spread evenly through the rest.
+    """
+    requests = []
+    for i in range(count):
+        mode = REQUEST
+        if int((i + 1) * half_close) > int(i * half_close):
+            mode = (GUEST_HALF_CLOSE, HOST_HALF_CLOSE)[
+                int(i * half_close) % 2]
+        request_size = request_sizes[i % len(request_sizes)]
+        response_size = response_sizes[i % len(response_sizes)]
+        if mode == GUEST_HALF_CLOSE:
+            response_size = 0
+        elif mode == HOST_HALF_CLOSE:
+            request_size = min(request_size, HALF_CLOSE_BODY_SIZE)
+        requests.append(Request(request_size, response_size, mode))
+    return requests
+
+class LoadGenerator(object):
+    """
+    Sends requests, a list of Requests, to a LoadServer at address, over
+    up to connections connections at once, each making up to keep_alive
+    requests. If rate is set, requests are started at that many per
+    second.
+    """
+
+    def __init__(self, address, requests, connections=20, keep_alive=10,
+                 rate=None, timeout=30):
+        self.address = address
+        self.requests = requests
+        self.connections = connections
+        self.keep_alive = keep_alive
+        self.rate = rate
+        self.timeout = timeout
+        self._lock = threading.Lock()
+
+    def run(self, server_bytes_received=None):
+        """
+        Send every request and return a LoadResult. If given,
+        server_bytes_received() is how many body bytes the host end has
+        read, for working out bytes_lost.
+        """
+        self._jobs = Queue.Queue()
+        self._latencies = []
+        self._errors = {}
+        self._sent = self._received = 0
+
+        start = time.time()
+        for (i, request) in enumerate(self.requests):
+            due = start + i / float(self.rate) if self.rate else None
+            self._jobs.put((due, request))
+        threads = [threading.Thread(target=self._worker)
+                   for i in range(min(self.connections, len(self.requests)))]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        for thread in threads:
+            # With a timeout, so that ^C still works
+            while thread.is_alive():
+                thread.join(1)
+        elapsed = time.time() - start
+
+        lost = None
+        if server_bytes_received is not None:
+            # The host end may still be reading what was sent last.
+            deadline = time.time() + self.timeout
+            while (server_bytes_received() < self._sent
+                   and time.time() < deadline):
+                time.sleep(0.01)
+            lost = self._sent - server_bytes_received()
+        return LoadResult(len(self.requests), self._latencies, self._errors,
+                          self._sent, self._received, lost, elapsed)
+
+    def _worker(self):
+        sock = None
+        used = 0
+        while True:
+            try:
+                (due, request) = self._jobs.get_nowait()
+            except Queue.Empty:
+                break
+            if due is not None:
+                time.sleep(max(0, due - time.time()))
+            started = due or time.time()
+            try:
+                if sock is None:
+                    sock = socket.create_connection(self.address,
+                                                    self.timeout)
+                    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY,
+                                    1)
+                    used = 0
+                (sent, received) = self._exchange(sock, request)
+                used += 1
+                with self._lock:
+                    self._latencies.append(time.time() - started)
+                    self._sent += sent
+                    self._received += received
+                if request.mode != REQUEST or used >= self.keep_alive:
+                    sock.close()
+                    sock = None
+            except (socket.error, EOFError, LoadError), e:
+                message = '%s: %s' % (e.__class__.__name__, e)
+                with self._lock:
+                    self._errors[message] = self._errors.get(message, 0) + 1
+                if sock is not None:
+                    sock.close()
+                    sock = None
+        if sock is not None:
+            sock.close()
+
+    def _exchange(self, sock, request):
+        """Make request, returning the body bytes sent and received."""
+        if request.mode == HOST_HALF_CLOSE:
+            sock.sendall(_HEADER.pack(*request)
+                         + _CHUNK[:request.request_size])
+            received = _receive_bytes(sock)
+            if received != request.response_size:
+                raise LoadError('short response: %d of %d bytes'
+                                % (received, request.response_size))
+            return (request.request_size, received)
+        sock.sendall(_HEADER.pack(*request))
+        if request.mode == GUEST_HALF_CLOSE:
+            if sock.recv(1) != '+':
+                raise LoadError('no go-ahead for half-close')
+            _send_bytes(sock, request.request_size)
+            sock.shutdown(socket.SHUT_WR)
+            return (request.request_size, _receive_bytes(sock))
+        _send_bytes(sock, request.request_size)
+        return (request.request_size,
+                _receive_bytes(sock, request.response_size))
+
+def run_local(requests, direct=False, buffer_size=None, **kwargs):
+    """
+    Run a LoadGenerator with kwargs through a Relay and a FakeReflector to
+    a LoadServer, all on this machine, or straight to the LoadServer if
+    direct is set. Returns the LoadResult and the reflector's errors.
+    """
+    server = LoadServer()
+    reflector = relay = thread = None
+    try:
+        address = (server.ip, server.port)
+        if not direct:
+            reflector = FakeReflector()
+            reflector.add_user('client.loadgen', 'secret')
+            relay_kwargs = {}
+            if buffer_size:
+                relay_kwargs['buffer_size'] = buffer_size
+            relay = Relay(reflector.address, 'loadgen', 'secret',
+                          [Forward('forward', 'forward', server.ip,
+                                   server.port)], **relay_kwargs)
+            relay.connect()
+            thread = threading.Thread(target=relay.run)
+            thread.daemon = True
+            thread.start()
+            reflector.wait_for_forwards(1)
+            address = ('127.0.0.1', reflector.start_forward(0))
+        result = LoadGenerator(address, requests, **kwargs).run(
+            lambda: server.bytes_received)
+        return (result, list(reflector.errors) if reflector else [])
+    finally:
+        if relay is not None:
+            relay.close()
+            thread.join(5)
+        if reflector is not None:
+            reflector.close()
+        server.close()
+
+def print_result(result, out=sys.stdout):
+    errors = sum(result.errors.values())
+    total = result.bytes_sent + result.bytes_received
+    print >>out, 'requests    %d, %d failed' % (result.requests, errors)
+    print >>out, 'elapsed     %.3fs' % result.elapsed
+    print >>out, 'throughput  %.1f requests/s, %.2f MB/s' % (
+        (result.requests - errors) / result.elapsed,
+        total / result.elapsed / (1024 * 1024))
+    if result.latencies:
+        print >>out, 'latency     p50 %.1fms, p99 %.1fms, max %.1fms' % tuple(
+            1000 * percentile(result.latencies, f) for f in [0.5, 0.99, 1])
+    if result.bytes_lost:
+        print >>out, 'lost        %d bytes sent to the host end' % (
+            result.bytes_lost,)
+    for (message, count) in sorted(result.errors.items()):
+        print >>out, 'error       %d x %s' % (count, message)
+
+def _sizes(spec):
+    """Parse a comma-separated list of sizes such as 512,16k,8m."""
+    multipliers = {'k': 1024, 'm': 1024 * 1024}
+    sizes = []
+    try:
+        for size in spec.lower().split(','):
+            multiplier = multipliers.get(size[-1:], 1)
+            if size[-1:] in multipliers:
+                size = size[:-1]
+            sizes.append(int(size) * multiplier)
+    except ValueError:
+        raise argparse.ArgumentTypeError('bad list of sizes %r' % spec)
+    return sizes
+
+def main(args=None):
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--connections', type=int, default=20,
+                        help="""How many connections to make at once.
+                        Defaults to %(default)s.""")
+    parser.add_argument('--requests', type=int, default=1000)
+    parser.add_argument('--keep-alive', type=int, default=10,
+                        metavar='REQUESTS',
+                        help="""How many requests to make over each
+                        connection. Defaults to %(default)s.""")
+    parser.add_argument('--request-size', type=_sizes, default=[512],
+                        metavar='SIZES',
+                        help="""Sizes of the request bodies, used in
+                        turn, such as 512,16k,8m. Defaults to 512.""")
+    parser.add_argument('--response-size', type=_sizes,
+                        default=[2048, 64 * 1024], metavar='SIZES',
+                        help='Defaults to 2k,64k.')
+    parser.add_argument('--rate', type=float, metavar='REQUESTS',
+                        help="""Start this many requests per second,
+                        instead of one whenever a connection is free.""")
+    parser.add_argument('--half-close', type=float, default=0.0,
+                        metavar='FRACTION',
+                        help='The fraction of requests that half-close.')
+    parser.add_argument('--buffer-size', type=_sizes, metavar='SIZE',
+                        help="The relay's buffer size in each direction.")
+    parser.add_argument('--direct', action='store_true',
+                        help="""Connect straight to the host end, for
+                        comparison, instead of through the relay.""")
+    args = parser.parse_args(args=args)
+
+    requests = make_requests(args.requests, args.request_size,
+                             args.response_size, args.half_close)
+    (result, errors) = run_local(
+        requests, direct=args.direct,
+        buffer_size=args.buffer_size and args.buffer_size[0],
+        connections=args.connections, keep_alive=args.keep_alive,
+        rate=args.rate)
+    print_result(result)
+    for error in errors:
+        print 'reflector   %s' % error
+    if result.errors or result.bytes_lost or errors:
+        return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
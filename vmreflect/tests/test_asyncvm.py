@@ -0,0 +1,198 @@
+import Queue
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+from path import path
+
+from vmreflect.asyncvm import AsyncVM, Cancelled, Limiter
+from vmreflect.cache import Cache
+from vmreflect.tests.fakevm import FakeBackend, FakeGuest, fake_vm
+from vmreflect.tests.test_pipeline import _tcpr_guest
+from vmreflect.tunnel import Tunnel
+from vmreflect.vmapi import VmException
+
+class _GatedBackend(FakeBackend):
+    """
+    A FakeBackend that records how many operations are in flight, and
+    holds each operation named in gated until gate is set.
+    """
+
+    def __init__(self, guest, gated=()):
+        FakeBackend.__init__(self, guest, guest.username, guest.password)
+        self.gated = [name.lower() for name in gated]
+        self.gate = threading.Event()
+        self.waiting = threading.Event()
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self._lock = threading.Lock()
+
+    def run(self, cmd_args):
+        with self._lock:
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            if cmd_args[0].lower() in self.gated:
+                self.waiting.set()
+                self.gate.wait(5)
+            return FakeBackend.run(self, cmd_args)
+        finally:
+            with self._lock:
+                self.in_flight -= 1
+
+class _Waiter(object):
+    """Wraps a threading.Event, waiting with the given function instead."""
+
+    def __init__(self, event, wait):
+        self.event = event
+        self.wait = wait
+
+    def __getattr__(self, name):
+        return getattr(self.event, name)
+
+class TestAsyncVM(unittest.TestCase):
+
+    def setUp(self):
+        self.async_vms = []
+
+    def tearDown(self):
+        for async_vm in self.async_vms:
+            async_vm.close(cancel=True)
+
+    def async_vm(self, guest, backend=None, **kwargs):
+        async_vm = AsyncVM(fake_vm(guest, backend=backend), **kwargs)
+        self.async_vms.append(async_vm)
+        return async_vm
+
+    def test_methods(self):
+        guest = FakeGuest()
+        async_vm = self.async_vm(guest)
+        self.assertEquals(None, async_vm.create_directory(r'C:\dir').result())
+        self.assertTrue(guest.is_dir(r'C:\dir'))
+        self.assertFalse(async_vm.file_exists(r'C:\file').result())
+        self.assertEquals(('hi\r\n', ''),
+                          async_vm._run_command('echo hi').result())
+        self.assertEquals(guest.call_count(), async_vm.backend_calls)
+
+        done = []
+        call = async_vm.delete_directory(r'C:\missing')
+        call.add_done_callback(done.append)
+        self.assertIsInstance(call.exception(), VmException)
+        self.assertEquals([call], done)
+
+    def test_limit(self):
+        guest = FakeGuest(latency=0.02)
+        backend = _GatedBackend(guest)
+        async_vm = self.async_vm(guest, backend, limit=2)
+        calls = [async_vm.create_directory(r'C:\dir%d' % i)
+                 for i in range(8)]
+        for call in calls:
+            call.result()
+        self.assertEquals(2, backend.max_in_flight)
+
+    def test_global_limit(self):
+        guest = FakeGuest(latency=0.02)
+        backend = _GatedBackend(guest)
+        limiter = Limiter(3)
+        async_vms = [self.async_vm(guest, backend, limit=2,
+                                   global_limiter=limiter)
+                     for i in range(3)]
+        calls = [async_vm.create_directory(r'C:\dir%d%d' % (i, j))
+                 for (i, async_vm) in enumerate(async_vms)
+                 for j in range(4)]
+        for call in calls:
+            call.result()
+        self.assertEquals(3, backend.max_in_flight)
+        self.assertEquals(0, limiter.in_flight)
+
+    def test_cancel_pending(self):
+        guest = FakeGuest()
+        backend = _GatedBackend(guest, ['createDirectoryInGuest'])
+        async_vm = self.async_vm(guest, backend, limit=1)
+        first = async_vm.create_directory(r'C:\first')
+        second = async_vm.create_directory(r'C:\second')
+        backend.waiting.wait(5)
+        self.assertTrue(second.cancel())
+        backend.gate.set()
+        first.result()
+        self.assertRaises(Cancelled, second.result)
+        self.assertTrue(second.cancelled())
+        self.assertFalse(first.cancel())
+        self.assertFalse(guest.is_dir(r'C:\second'))
+
+    def test_cancel_running(self):
+        guest = FakeGuest()
+        backend = _GatedBackend(guest, ['runScriptInGuest'])
+        async_vm = self.async_vm(guest, backend)
+        async_vm._temp_dir().result()
+        call = async_vm.run_batch(['echo hi'])
+        backend.waiting.wait(5)
+        call.cancel()
+        backend.gate.set()
+        self.assertRaises(Cancelled, call.result)
+        # The batch's guest directory was still cleaned up.
+        self.assertEquals(['runscriptinguest', 'deletedirectoryinguest'],
+                          guest.calls[-2:])
+        self.assertEquals([], [d for d in guest._listdir(guest.temp_dir)
+                               if d.startswith('vmreflect')])
+
+    def test_cancel_waiting_for_slot(self):
+        guest = FakeGuest()
+        backend = _GatedBackend(guest, ['createDirectoryInGuest'])
+        limiter = Limiter(1)
+        (first_vm, second_vm) = [self.async_vm(guest, backend,
+                                               global_limiter=limiter)
+                                 for i in range(2)]
+        first = first_vm.create_directory(r'C:\first')
+        backend.waiting.wait(5)
+        second = second_vm.create_directory(r'C:\second')
+        time.sleep(0.05)
+        self.assertFalse(second.done())
+        second.cancel()
+        self.assertRaises(Cancelled, second.result, 5)
+        self.assertFalse(first.done())
+        backend.gate.set()
+        first.result()
+
+    def test_result_timeout(self):
+        guest = FakeGuest()
+        backend = _GatedBackend(guest, ['createDirectoryInGuest'])
+        call = self.async_vm(guest, backend).create_directory(r'C:\dir')
+        self.assertRaises(Queue.Empty, call.result, 0.01)
+        backend.gate.set()
+        call.result()
+
+    def test_result_waits_past_timeout(self):
+        guest = FakeGuest()
+        backend = _GatedBackend(guest, ['createDirectoryInGuest'])
+        call = self.async_vm(guest, backend).create_directory(r'C:\dir')
+        backend.waiting.wait(5)
+        # Pretend the first finite wait ran out while the call was running
+        waits = []
+        done_event = call._done
+        def wait(timeout):
+            waits.append(timeout)
+            if len(waits) == 1:
+                backend.gate.set()
+                return False
+            return done_event.wait(timeout)
+        call._done = _Waiter(done_event, wait)
+        self.assertEquals(None, call.result())
+        self.assertEquals(2, len(waits))
+
+    def test_tunnel(self):
+        guest = _tcpr_guest(latency=0.01)
+        backend = _GatedBackend(guest)
+        temp_dir = path(tempfile.mkdtemp(prefix='vmreflect'))
+        async_vm = self.async_vm(guest, backend, limit=1)
+        tunnel = Tunnel(None, 8000, None, None, vm=async_vm,
+                        cache=Cache(temp_dir))
+        tunnel._cleanups = []
+        try:
+            tunnel._bring_up()
+        finally:
+            tunnel._tear_down()
+            shutil.rmtree(temp_dir)
+        self.assertEquals(1, backend.max_in_flight)
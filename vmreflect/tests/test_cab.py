@@ -0,0 +1,42 @@
+import os
+import struct
+import unittest
+
+from vmreflect import cab
+
+class TestCab(unittest.TestCase):
+
+    def setUp(self):
+        self.files = [('readme.txt', 'hello, world\r\n' * 5000),
+                      ('random.bin', os.urandom(70000)),
+                      ('empty', ''),
+                      (u'caf\xe9.txt', 'x')]
+
+    def test_round_trip(self):
+        data = cab.pack(self.files)
+        self.assertEquals(self.files, cab.unpack(data))
+        self.assertLess(len(data), sum(len(d) for (_, d) in self.files))
+        self.assertEquals(self.files,
+                          cab.unpack(cab.pack(self.files, cab.COMPRESS_NONE)))
+        self.assertEquals([], cab.unpack(cab.pack([])))
+
+    def test_history(self):
+        # The second block refers back to the first.
+        block = cab._mszip_block('abc' * 11000, 'abc' * 10000)
+        self.assertLess(len(block), 100)
+        self.assertRaises(cab.CabError, cab._unmszip_block, '', block)
+        self.assertEquals('abc' * 10000,
+                          cab._unmszip_block('abc' * 11000, block))
+
+    def test_checksum(self):
+        data = cab.pack(self.files[:1])
+        (data_offset,) = struct.unpack_from('<I', data, 36)
+        corrupt = data[:data_offset + 10] + 'X' + data[data_offset + 11:]
+        self.assertRaises(cab.CabError, cab.unpack, corrupt)
+        self.assertEquals(0x04030201 ^ 0x05, cab._checksum('\1\2\3\4\5'))
+
+    def test_not_a_cabinet(self):
+        self.assertRaises(cab.CabError, cab.unpack, 'PK\3\4')
+        self.assertRaises(cab.CabError, cab.unpack, 'MSCF')
+        self.assertRaises(cab.CabError, cab.unpack,
+                          cab.pack(self.files)[:1000])
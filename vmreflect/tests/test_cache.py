@@ -0,0 +1,73 @@
+"""
+Tests for the host cache of files extracted from archives.
+"""
+
+import os
+import shutil
+import tempfile
+import time
+import unittest
+import zipfile
+
+from path import path
+
+from vmreflect.cache import Cache
+
+class TestCache(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = path(tempfile.mkdtemp(prefix='vmreflect'))
+        self.cache = Cache(self.temp_dir.joinpath('cache'), max_size=2500)
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def make_archive(self, name, data):
+        archive = self.temp_dir.joinpath(name)
+        with zipfile.ZipFile(archive, 'w', zipfile.ZIP_DEFLATED) as zf:
+            zf.writestr('dir/tool.exe', data)
+        return archive
+
+    def test_extract(self):
+        archive = self.make_archive('a.zip', 'x' * 1000)
+        cached = self.cache.extract(archive, 'dir/tool.exe')
+        self.assertEquals('tool.exe', cached.name)
+        self.assertEquals('x' * 1000, cached.bytes())
+        self.assertEquals(0600, os.stat(cached).st_mode & 0777)
+
+    def test_reuse(self):
+        archive = self.make_archive('a.zip', 'x' * 1000)
+        cached = self.cache.extract(archive, 'dir/tool.exe')
+        mtime = cached.mtime
+        time.sleep(0.01)
+        self.assertEquals(cached, self.cache.extract(archive, 'dir/tool.exe'))
+        self.assertEquals(mtime, cached.mtime)
+
+    def test_keyed_by_content(self):
+        first = self.cache.extract(self.make_archive('a.zip', 'x' * 1000),
+                                   'dir/tool.exe')
+        second = self.cache.extract(self.make_archive('a.zip', 'y' * 1000),
+                                    'dir/tool.exe')
+        self.assertNotEquals(first, second)
+        self.assertEquals('y' * 1000, second.bytes())
+
+    def test_evict_least_recently_used(self):
+        archives = [self.make_archive('%d.zip' % i, chr(ord('a') + i) * 1000)
+                    for i in range(3)]
+        first = self.cache.extract(archives[0], 'dir/tool.exe')
+        second = self.cache.extract(archives[1], 'dir/tool.exe')
+        os.utime(first.dirname(), (0, 0))
+        os.utime(second.dirname(), (1, 1))
+        # Using the first one again makes the second the oldest.
+        self.cache.extract(archives[0], 'dir/tool.exe')
+        third = self.cache.extract(archives[2], 'dir/tool.exe')
+        self.assertTrue(first.isfile())
+        self.assertFalse(second.exists())
+        self.assertTrue(third.isfile())
+
+    def test_missing_member(self):
+        archive = self.make_archive('a.zip', 'x')
+        self.assertRaises(KeyError,
+                          lambda: self.cache.extract(archive, 'nonexistent'))
+        [entry] = self.cache.directory.dirs()
+        self.assertEquals([], entry.listdir())
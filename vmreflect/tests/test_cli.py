@@ -0,0 +1,59 @@
+"""
+Tests that the vmreflect command answers --help and bad arguments without
+importing the modules that only its subcommands need.
+"""
+
+import json
+import os
+import subprocess
+import sys
+import unittest
+
+from vmreflect.tests.benchmark import _PACKAGE_ROOT
+
+_HEAVY_MODULES = ['path', 'pkg_resources', 'zipfile', 'vmreflect.daemon',
+                  'vmreflect.tunnel', 'vmreflect.vmapi']
+
+# Runs the command, then prints the modules it imported as the last line.
+_SCRIPT = """
+import sys
+from vmreflect.cli import main
+try:
+    main(sys.argv[1:])
+except SystemExit:
+    pass
+modules = sorted(sys.modules)
+import json
+print
+print json.dumps(modules)
+"""
+
+def _imported_by(args):
+    env = dict(os.environ)
+    env['PYTHONPATH'] = _PACKAGE_ROOT
+    process = subprocess.Popen([sys.executable, '-c', _SCRIPT] + args,
+                               env=env, stdout=subprocess.PIPE,
+                               stderr=subprocess.PIPE)
+    (out, err) = process.communicate()
+    return (json.loads(out.splitlines()[-1]), err)
+
+class TestStartup(unittest.TestCase):
+
+    def test_lightweight(self):
+        for args in [['--help'], ['ie6', '--port', 'x'], ['gc', '--help'],
+                     ['list-vms', '--help'], ['status', '--help'],
+                     ['add-port']]:
+            (modules, _) = _imported_by(args)
+            self.assertIn('vmreflect.cli', modules)
+            self.assertEquals([], [m for m in _HEAVY_MODULES
+                                   if m in modules], args)
+
+    def test_argument_error(self):
+        (_, err) = _imported_by(['ie6', '--port', '0'])
+        self.assertIn("bad port range '0'", err)
+
+    def test_tunnel(self):
+        import vmreflect
+        from vmreflect.tunnel import Tunnel
+        self.assertIs(Tunnel, vmreflect.Tunnel)
+        self.assertRaises(AttributeError, getattr, vmreflect, 'Tunel')
@@ -0,0 +1,103 @@
+"""
+Tests for the admin console client, run against the stand-in reflector
+server.
+"""
+
+import unittest
+
+from vmreflect import tcpr
+from vmreflect.console import (Console, ConsoleError, ListedForward,
+                               listening_port, parse_list, parse_reply)
+from vmreflect.relay import Forward, Relay
+from vmreflect.tests.fakereflector import FakeReflector
+
+class TestParsing(unittest.TestCase):
+
+    def test_reply(self):
+        self.assertEquals(250, parse_reply(['a', '250 OK']).code)
+        self.assertEquals(None, parse_reply(['client c added']).code)
+        self.assertEquals(None, parse_reply([]).code)
+
+    def test_listening_port(self):
+        self.assertEquals(8000, listening_port(parse_reply(
+            ['250 forwarder listening on 0.0.0.0:8000'])))
+        self.assertEquals(None, listening_port(parse_reply(
+            ['553 forward already started, use modify instead'])))
+
+    def test_list(self):
+        reply = parse_reply([
+            'workstation mac 0123456789AB 10.0.0.1:50000',
+            '   #0 tcp forward8000 listening on port 8000',
+            '   #1 tcp forward3000',
+            'workstation mac 0123456789AB.1 10.0.0.1:50001',
+            '   #2 tcp forward4000',
+            '250 OK'])
+        [first, second] = parse_list(reply)
+        self.assertEquals('0123456789AB', first.node_id)
+        self.assertEquals([ListedForward(0, 'tcp', 'forward8000', 8000),
+                           ListedForward(1, 'tcp', 'forward3000', None)],
+                          first.forwards)
+        self.assertEquals([2], [f.id for f in second.forwards])
+        self.assertEquals([], parse_list(parse_reply(['251 no match'])))
+
+class TestConsole(unittest.TestCase):
+
+    def setUp(self):
+        self.reflector = FakeReflector()
+        self.reflector.add_user('user.manager', 'secret')
+        self.console = Console(self.reflector.console_address,
+                               'manager', 'secret')
+        self.console.connect()
+        self.relays = []
+
+    def tearDown(self):
+        self.console.close()
+        for relay in self.relays:
+            relay.close()
+        self.reflector.close()
+        self.assertEquals([], self.reflector.errors)
+
+    def connect_client(self, ports):
+        relay = Relay(self.reflector.address, 'tcprclient', 'pw',
+                      [Forward('forward%d' % p, 'forward%d' % p,
+                               '127.0.0.1', p) for p in ports])
+        relay.connect()
+        self.relays.append(relay)
+        self.reflector.wait_for_forwards(len(ports))
+
+    def test_one_connection(self):
+        self.console.add_client('tcprclient', 'pw')
+        self.connect_client([8000, 8001])
+        self.assertEquals(8000, self.console.start(0, 8000))
+        self.console.stop(0)
+        self.assertEquals(8000, self.console.start(0, 8000))
+        # Every command went over the one connection.
+        self.assertEquals(4, self.console.commands_sent)
+        self.assertEquals(4, len(self.reflector.console_commands))
+
+    def test_pipelined(self):
+        self.console.add_client('tcprclient', 'pw')
+        self.connect_client([8000, 8001, 8002])
+        replies = self.console.start_many([(2, 8002), (7, 8007), (0, 8000)])
+        self.assertEquals([8002, None, 8000],
+                          [listening_port(r) for r in replies])
+        self.assertEquals(553, replies[1].code)
+
+        [reflector] = self.console.list()
+        self.assertEquals([(0, 8000), (1, None), (2, 8002)],
+                          [(f.id, f.port) for f in reflector.forwards])
+
+    def test_errors(self):
+        self.assertRaises(ConsoleError, self.console.start, 0, 8000)
+        self.assertRaises(ConsoleError, self.console.stop, 0)
+        self.assertEquals(None, self.console.command('frobnicate').code)
+        # The connection is still usable.
+        self.assertEquals([], self.console.list())
+
+    def test_bad_login(self):
+        console = Console(self.reflector.console_address, 'manager', 'wrong')
+        self.assertRaises(tcpr.AuthenticationError, console.connect)
+
+    def test_closed(self):
+        self.console.close()
+        self.assertRaises(ConsoleError, self.console.list)
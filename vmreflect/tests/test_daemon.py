@@ -0,0 +1,158 @@
+"""
+Tests for adding and removing forwarded ports while a tunnel is open, and
+for the daemon that does it on request.
+"""
+
+import shutil
+import socket
+import tempfile
+import threading
+import unittest
+
+from path import path
+
+from vmreflect.console import Console
+from vmreflect.daemon import Daemon, DaemonError, send_command
+from vmreflect.tests.fakereflector import FakeReflector
+from vmreflect.tests.test_relay import local_server, read_all
+from vmreflect.tunnel import Tunnel
+
+class TestAddPorts(unittest.TestCase):
+
+    def setUp(self):
+        self.reflector = FakeReflector()
+        self.reflector.add_user('client.tcprclient', 'secret')
+        self.reflector.add_user('user.manager', 'manager')
+        self.servers = []
+
+        self.tunnel = Tunnel(None, 8000, None, None, vm=object(),
+                             port_range=(1024, 65535))
+        self.tunnel.server_ip = '127.0.0.1'
+        self.tunnel.server_port = self.reflector.port
+        self.tunnel.client_name = 'tcprclient'
+        self.tunnel.client_password = 'secret'
+        self.tunnel._cleanups = []
+        self.tunnel.console = Console(self.reflector.console_address,
+                                      'manager', 'manager')
+        self.tunnel.console.connect()
+        self.tunnel._cleanups.append(self.tunnel.console.close)
+
+    def tearDown(self):
+        self.tunnel._tear_down()
+        for server in self.servers:
+            server.shutdown()
+            server.server_close()
+        self.reflector.close()
+        self.assertEquals([], self.reflector.errors)
+
+    def guest_connect(self, port):
+        return socket.create_connection(
+            ('127.0.0.1', self.reflector.guest_port(port)), 5)
+
+    def greeter(self, name):
+        server = local_server(lambda sock: sock.sendall('I am ' + name))
+        self.servers.append(server)
+        return server.server_address[1]
+
+    def test_add_and_remove(self):
+        first = self.greeter('first')
+        second = self.greeter('second')
+        self.assertEquals([first], self.tunnel.add_ports([first]))
+        self.assertEquals('I am first', read_all(self.guest_connect(first)))
+
+        # Adding a port doesn't disturb the ones already open.
+        self.assertEquals([second], self.tunnel.add_ports([first, second]))
+        self.assertEquals([first, second], self.tunnel.open_ports)
+        self.assertEquals(2, len(self.tunnel.relays))
+        self.assertEquals('I am second', read_all(self.guest_connect(second)))
+
+        self.tunnel.remove_ports([first])
+        self.assertEquals([second], self.tunnel.open_ports)
+        self.assertRaises(socket.error, self.guest_connect, first)
+
+        # Re-adding a port reuses its forward.
+        self.tunnel.add_ports([first])
+        self.assertEquals(2, len(self.tunnel.relays))
+        self.assertEquals('I am first', read_all(self.guest_connect(first)))
+
+    def test_bad_ports(self):
+        self.assertRaises(ValueError, self.tunnel.add_ports, [80])
+        self.assertRaises(ValueError, self.tunnel.remove_ports, [8000])
+
+class _StubTunnel(object):
+
+    server_ip = '10.0.0.2'
+    server_port = 4000
+    port_range = (1024, 65535)
+    health = None
+
+    def __init__(self):
+        self.open_ports = [8000]
+        self.relays = []
+        self.stopped = threading.Event()
+
+    def start(self, started_event=None):
+        started_event.set()
+        self.stopped.wait(10)
+
+    def stop(self):
+        self.stopped.set()
+
+    def add_ports(self, ports):
+        added = [p for p in ports if p not in self.open_ports]
+        self.open_ports.extend(added)
+        return added
+
+    def remove_ports(self, ports):
+        if 1 in ports:
+            raise ValueError('port 1 is not forwarded')
+        for port in ports:
+            self.open_ports.remove(port)
+
+class TestDaemon(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = path(tempfile.mkdtemp(prefix='vmreflect'))
+        self.control_path = self.temp_dir.joinpath('control.sock')
+        self.tunnel = _StubTunnel()
+        self.daemon = Daemon(self.tunnel, self.control_path)
+        self.thread = threading.Thread(target=self.daemon.serve)
+        self.thread.daemon = True
+        self.thread.start()
+        for i in range(50):
+            if self.control_path.exists():
+                break
+            self.tunnel.stopped.wait(0.1)
+
+    def tearDown(self):
+        self.tunnel.stop()
+        self.thread.join(5)
+        shutil.rmtree(self.temp_dir)
+
+    def command(self, command, **kwargs):
+        return send_command(self.control_path, command, **kwargs)
+
+    def test_commands(self):
+        self.assertEquals([8000], self.command('status')['ports'])
+        reply = self.command('add-port', ports=[3000, 8000])
+        self.assertEquals([3000], reply['added'])
+        self.assertEquals([8000, 3000], reply['ports'])
+        reply = self.command('remove-port', ports=[8000])
+        self.assertEquals([3000], reply['ports'])
+
+        self.command('shutdown')
+        self.thread.join(5)
+        self.assertFalse(self.thread.is_alive())
+        self.assertFalse(self.control_path.exists())
+        self.assertRaises(DaemonError, self.command, 'status')
+
+    def test_errors(self):
+        self.assertRaises(DaemonError, self.command, 'remove-port', ports=[1])
+        self.assertRaises(DaemonError, self.command, 'frobnicate')
+        # The daemon carries on.
+        self.assertEquals([8000], self.command('status')['ports'])
+
+    def test_already_running(self):
+        second = Daemon(_StubTunnel(), self.control_path)
+        self.assertRaises(DaemonError, second.serve)
+        self.assertEquals([8000], self.command('status')['ports'])
@@ -7,11 +7,8 @@ Full end-to-end test: start a server, tunnel, and connect from the VM
 import argparse
 import SocketServer
 import contextlib
-import os
-import pkg_resources
 import socket
 import string
-import tempfile
 import threading
 import time
 import unittest
@@ -19,8 +16,8 @@ import unittest
 from path import path
 
 from vmreflect import Tunnel
-from vmreflect.tests import test_config
-from vmreflect.utils import get_random_string
+from vmreflect.tests import test_config, use_temp_cache_dir
+from vmreflect.utils import get_random_string, resource_path
 from vmreflect.vmapi import VM
 
 class DataReversingTCPRequestHandler(SocketServer.BaseRequestHandler):
@@ -32,6 +29,8 @@ class DataReversingTCPRequestHandler(SocketServer.BaseRequestHandler):
 
 class ThreadedTCPServer(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
     allow_reuse_address = True
+    daemon_threads = True
+    request_queue_size = 128
 
 def client(ip, port, message):
     sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
@@ -45,15 +44,16 @@ def client(ip, port, message):
 
 class Server(object):
     """
-    A simple TCP server that echoes whatever is sent to it, in reverse.
+    A simple TCP server that echoes whatever is sent to it, in reverse,
+    or handles connections with handler, a request handler class, instead.
     """
 
-    def __init__(self, verbose=False, port=0):
+    def __init__(self, verbose=False, port=0,
+                 handler=DataReversingTCPRequestHandler):
         # Port 0 means to select an arbitrary unused port
         HOST, PORT = "localhost", port
 
-        self.server = ThreadedTCPServer((HOST, PORT),
-                                        DataReversingTCPRequestHandler)
+        self.server = ThreadedTCPServer((HOST, PORT), handler)
         self.ip, self.port = self.server.server_address
 
         # Start a thread with the server -- that thread will then start one
@@ -67,6 +67,7 @@ class Server(object):
 
     def close(self):
         self.server.shutdown()
+        self.server.server_close()
 
 class TestEndToEnd(unittest.TestCase):
     """
@@ -75,6 +76,9 @@ class TestEndToEnd(unittest.TestCase):
     from the guest and verify that it works.
     """
 
+    def setUp(self):
+        use_temp_cache_dir(self)
+
     def test_reversing_server(self):
         random_string = get_random_string()
         with contextlib.closing(Server()) as server:
@@ -85,63 +89,29 @@ class TestEndToEnd(unittest.TestCase):
         random_string = get_random_string()
         with contextlib.closing(Server()) as server:
 
-            # Create a tunnel and wait for it to start.
-
-            tunnel = Tunnel(port=server.port,
-                            vm_name=test_config.vm_name,
-                            username=test_config.vm_username,
-                            password=test_config.vm_password)
-
-            started = threading.Event()
-            done = threading.Event()
-
-            def tunnel_thread():
-                tunnel.start(started_event=started, done_event=done)
-
-            tunnel_thread = threading.Thread(target=tunnel_thread)
-            tunnel_thread.start()
-
-            started.wait()
-
-            try:
-
-                tunnel_vmapi = VM(vm_name=test_config.vm_name,
-                                username=test_config.vm_username,
-                                password=test_config.vm_password)
-
-                # get temp dir
-                tmpdir, _ = tunnel_vmapi._run_command('echo %TEMP%')
-                tmpdir = tmpdir.strip()
-
-                # copy socketclient.exe to temporary filename
-                target_filename = (tmpdir + r'\socketclient-' +
-                                get_random_string() + '.exe')
-                fd, local_temp = tempfile.mkstemp(prefix='vmreflect')
-                os.close(fd)
-                try:
-                    socketclient_bin = pkg_resources.resource_stream(
-                        'vmreflect', 'lib-win32/socketclient/socketclient.exe')
-                    with open(local_temp, 'wb') as out:
-                        out.write(socketclient_bin.read())
-                    os.chmod(local_temp, 0700)
-                    tunnel_vmapi.copy_file_to_guest(
-                        local_temp, target_filename)
-                    try:
-                        output, _ = tunnel_vmapi._run_command(
-                            '%s %s %d %s' % (target_filename,
-                                            'localhost', server.port,
-                                            repr(random_string)))
-
-                    finally:
-                        tunnel_vmapi.delete_file(target_filename)
-
-                    self.assertIn(''.join(reversed(random_string)),
-                                output)
-                finally:
-                    os.unlink(local_temp)
-
-            finally:
-                done.set()
+            # Open a tunnel, sharing the VM with the guest operations
+            # below.
+
+            with VM(vm_name=test_config.vm_name,
+                    username=test_config.vm_username,
+                    password=test_config.vm_password) as tunnel_vmapi:
+                with Tunnel(None, server.port, None, None,
+                            vm=tunnel_vmapi).open():
+
+                    # Send socketclient.exe over, unless an earlier run
+                    # already has.
+                    guest_dir = (tunnel_vmapi._temp_dir()
+                                 + r'\vmreflect-socketclient')
+                    tunnel_vmapi.copy_files_to_guest(
+                        [resource_path(
+                            'lib-win32/socketclient/socketclient.exe')],
+                        guest_dir)
+
+                    output, _ = tunnel_vmapi._run_command(
+                        '%s\\socketclient.exe %s %d %s'
+                        % (guest_dir, 'localhost', server.port,
+                           repr(random_string)))
+                    self.assertIn(''.join(reversed(random_string)), output)
 
 def main():
     parser = argparse.ArgumentParser()
@@ -0,0 +1,151 @@
+"""
+Tests for the stand-in vmrun, which also run the VM API and a whole
+tunnel through forked vmrun processes.
+"""
+
+import os
+import shutil
+import socket
+import tempfile
+import threading
+import unittest
+
+from vmreflect.cache import Cache
+from vmreflect.health import HealthMonitor
+from vmreflect.tests.benchmark import (bench_cli_startup, bench_session,
+                                       bench_tunnel_start, run_benchmarks,
+                                       _vm)
+from vmreflect.tests.fakevm import FakeGuest
+from vmreflect.tests.fakevmrun import FakeVmrun
+from vmreflect.tunnel import Tunnel
+
+class TestFakeVmrun(unittest.TestCase):
+
+    def setUp(self):
+        self.saved_session = os.environ.pop('VMREFLECT_SESSION', None)
+        self.guest = FakeGuest(ip_address='127.0.0.1')
+        self.fake_vmrun = FakeVmrun(self.guest)
+        self.vm = _vm(self.guest)
+
+    def tearDown(self):
+        self.fake_vmrun.close()
+        if self.saved_session is not None:
+            os.environ['VMREFLECT_SESSION'] = self.saved_session
+
+    def test_run_command(self):
+        self.assertEquals(('hello\r\n', ''), self.vm._run_command('echo hello'))
+        guest = self.fake_vmrun.guest()
+        self.assertEquals(self.vm.backend_calls, len(guest.calls))
+        self.assertEquals(['runscriptinguest'],
+                          [c for c in guest.calls if c.startswith('run')])
+
+    def test_concurrent_operations(self):
+        threads = [threading.Thread(target=self.vm.create_directory,
+                                    args=(r'C:\dir%d' % i,))
+                   for i in range(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        guest = self.fake_vmrun.guest()
+        self.assertEquals(['dir%d' % i for i in range(8)],
+                          [d for d in guest._listdir('C:')
+                           if d.startswith('dir')])
+
+    def test_list_processes(self):
+        self.assertEquals(self.guest.processes, self.vm.list_processes())
+
+class TestBenchmark(unittest.TestCase):
+
+    def test_tunnel_start(self):
+        [result] = run_benchmarks(repeat=1, benchmarks=[bench_tunnel_start])
+        self.assertEquals(1, len(result.times))
+        self.assertGreater(result.calls, 0)
+
+    def test_session(self):
+        [result] = run_benchmarks(repeat=2, benchmarks=[bench_session])
+        self.assertEquals(2, len(result.times))
+        # One operation each time, forked by the daemon
+        self.assertEquals(1, result.calls)
+
+    def test_cli_startup(self):
+        [result] = run_benchmarks(repeat=1, benchmarks=[bench_cli_startup])
+        self.assertEquals(1, len(result.times))
+
+class TestTunnel(unittest.TestCase):
+
+    def setUp(self):
+        self.saved_session = os.environ.pop('VMREFLECT_SESSION', None)
+        self.fake_vmrun = FakeVmrun(FakeGuest(ip_address='127.0.0.1'))
+        self.cache_dir = tempfile.mkdtemp(prefix='vmreflect')
+
+    def tearDown(self):
+        self.fake_vmrun.close()
+        shutil.rmtree(self.cache_dir)
+        if self.saved_session is not None:
+            os.environ['VMREFLECT_SESSION'] = self.saved_session
+
+    def tunnel(self, vm, port):
+        return Tunnel(None, port, None, None, vm=vm,
+                      cache=Cache(self.cache_dir))
+
+    def servers(self):
+        return [p for p in self.fake_vmrun.guest().processes
+                if 'tcpr' in p.cmd]
+
+    def test_shared_vm(self):
+        with _vm(self.fake_vmrun.guest()) as vm:
+            with self.tunnel(vm, 8000).open() as first:
+                self.assertTrue(first.is_open)
+                with self.tunnel(vm, 8001) as second:
+                    self.assertEquals([8001], second.open_ports)
+                    self.assertEquals(
+                        sorted([first.server_pid, second.server_pid]),
+                        sorted(p.pid for p in self.servers()))
+                self.assertFalse(second.is_open)
+                self.assertEquals([first.server_pid],
+                                  [p.pid for p in self.servers()])
+            self.assertFalse(first.is_open)
+            self.assertEquals([], self.servers())
+
+            # Closed tunnels can be opened again.
+            with first.open():
+                self.assertEquals([8000], first.open_ports)
+            first.close()
+            self.assertEquals([], self.servers())
+
+    def test_server_restart(self):
+        # Probed in place of the forwarded port, which the stand-in
+        # reflector listens for on another port
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listener.bind(('127.0.0.1', 0))
+        listener.listen(5)
+        try:
+            with _vm(self.fake_vmrun.guest()) as vm:
+                with self.tunnel(vm, 8000).open() as tunnel:
+                    open_calls = len(self.fake_vmrun.guest().calls)
+                    monitor = HealthMonitor(
+                        tunnel, guest_address=lambda port:
+                        listener.getsockname())
+                    tunnel.health = monitor
+                    old_pid = tunnel.server_pid
+                    vm.kill_process(old_pid)
+                    for relay in tunnel.relays:
+                        tunnel._relay_threads[relay].join(5)
+
+                    probe = monitor.check()
+                    self.assertEquals(('server',), probe.repaired)
+                    self.assertNotEquals(old_pid, tunnel.server_pid)
+                    self.assertEquals([tunnel.server_pid],
+                                      [p.pid for p in self.servers()])
+                    # After the kill, fewer vmrun calls than opening the
+                    # tunnel took, and no copies to the guest
+                    repair_calls = self.fake_vmrun.guest().calls[
+                        open_calls + 1:]
+                    self.assertLess(len(repair_calls), open_calls)
+                    self.assertNotIn('copyfilefromhosttoguest', repair_calls)
+                    self.assertEquals([8000], tunnel.open_ports)
+                    self.assertIsNone(monitor.check().error)
+                self.assertEquals([], self.servers())
+        finally:
+            listener.close()
@@ -0,0 +1,161 @@
+"""
+Tests for the health monitor, which repairs the part of an open tunnel
+that broke, run against the stand-in reflector server.
+"""
+
+import socket
+import time
+import unittest
+
+from vmreflect.health import HealthMonitor
+from vmreflect.tests.fakereflector import FakeReflector
+from vmreflect.tests.test_relay import local_server, read_all
+from vmreflect.tunnel import Tunnel
+
+class _Started(object):
+    """A result of the batch that starts the server."""
+
+    pid = 1234
+    stdout = ''
+
+    def check(self):
+        return self
+
+class _StoppedServerVM(object):
+    """A VM in which the server is no longer running."""
+
+    listening_ports = None
+
+    def is_running(self, pid):
+        return False
+
+class TestHealthMonitor(unittest.TestCase):
+
+    def setUp(self):
+        self.reflector = FakeReflector()
+        self.reflector.add_user('client.tcprclient', 'secret')
+        self.reflector.add_user('user.manager', 'manager')
+        self.server = local_server(lambda sock: sock.sendall('hello'))
+        self.port = self.server.server_address[1]
+
+        self.tunnel = Tunnel(None, self.port, None, None, vm=object())
+        self.tunnel.server_ip = '127.0.0.1'
+        self.tunnel.server_port = self.reflector.port
+        self.tunnel.console_port = self.reflector.console_port
+        self.tunnel.manager_password = 'manager'
+        self.tunnel.client_name = 'tcprclient'
+        self.tunnel.client_password = 'secret'
+        self.tunnel._cleanups = []
+        self.tunnel._connect_console(time.time() + 5)
+        self.tunnel.add_ports([self.port])
+        self.monitor = HealthMonitor(self.tunnel,
+                                     guest_address=self.guest_address)
+        self.tunnel.health = self.monitor
+
+    def tearDown(self):
+        self.monitor.stop()
+        self.tunnel._tear_down()
+        self.server.shutdown()
+        self.server.server_close()
+        self.reflector.close()
+        self.assertEquals([], self.reflector.errors)
+
+    def guest_address(self, port):
+        return ('127.0.0.1', self.reflector.guest_port(port))
+
+    def guest_connect(self):
+        return socket.create_connection(self.guest_address(self.port), 5)
+
+    def lose_relay(self):
+        [relay] = self.tunnel.relays
+        [client] = self.reflector.reflectors
+        client.disconnect()
+        self.tunnel._relay_threads[relay].join(5)
+        return relay
+
+    def test_healthy(self):
+        probe = self.monitor.check()
+        self.assertIsNone(probe.error)
+        self.assertEquals((), probe.repaired)
+        self.assertEquals([probe], list(self.monitor.history))
+        self.assertEquals(probe.latency, self.monitor.latency())
+
+    def test_relay_lost(self):
+        console = self.tunnel.console
+        relay = self.lose_relay()
+        probe = self.monitor.check()
+        self.assertIsNotNone(probe.error)
+        self.assertEquals(('relay',), probe.repaired)
+        self.assertNotIn(relay, self.tunnel.relays)
+        self.assertIs(console, self.tunnel.console)
+        self.assertEquals([self.port], self.tunnel.open_ports)
+        self.assertEquals('hello', read_all(self.guest_connect()))
+        self.assertFalse(self.tunnel.wait(0))
+        self.assertIsNone(self.monitor.check().error)
+
+    def test_console_lost(self):
+        relays = list(self.tunnel.relays)
+        self.tunnel.console.sock.shutdown(socket.SHUT_RDWR)
+        probe = self.monitor.check()
+        self.assertEquals(('console',), probe.repaired)
+        self.assertEquals(relays, self.tunnel.relays)
+        self.assertEquals(1, len(self.tunnel.console.list()))
+        self.assertEquals('hello', read_all(self.guest_connect()))
+
+    def restart_with_new_server(self):
+        """Make a restarted server a new stand-in one."""
+        self.addCleanup(self.reflector.close)
+        def run_server():
+            self.reflector = FakeReflector()
+            self.reflector.add_user('client.tcprclient', 'secret')
+            self.reflector.add_user('user.manager', 'manager')
+            self.tunnel.server_port = self.reflector.port
+            self.tunnel.console_port = self.reflector.console_port
+            return [_Started()] * 3
+        self.tunnel._run_server = run_server
+
+    def test_forward_stopped(self):
+        relays = list(self.tunnel.relays)
+        self.tunnel.console.stop(self.tunnel._forward_ids[self.port])
+        probe = self.monitor.check()
+        self.assertIsNotNone(probe.error)
+        self.assertEquals(('forwards',), probe.repaired)
+        self.assertEquals(relays, self.tunnel.relays)
+        self.assertEquals('hello', read_all(self.guest_connect()))
+        self.assertIsNone(self.monitor.check().error)
+
+    def test_server_died(self):
+        self.restart_with_new_server()
+        self.tunnel.vmapi = _StoppedServerVM()
+        self.tunnel.server_pid = 1000
+        self.reflector.close()
+        probe = self.monitor.check()
+        self.assertEquals(('server',), probe.repaired)
+        self.assertEquals(1234, self.tunnel.server_pid)
+        self.assertFalse(self.tunnel.wait(0.1))
+        self.assertEquals('hello', read_all(self.guest_connect()))
+
+    def test_server_restarted(self):
+        # The relays are still connected to the old server when the repair
+        # closes them.
+        relays = list(self.tunnel.relays)
+        self.restart_with_new_server()
+        self.tunnel.vmapi = _StoppedServerVM()
+        self.tunnel._restart_server(time.time() + 5)
+        self.assertEquals(1234, self.tunnel.server_pid)
+        self.assertFalse(set(relays) & set(self.tunnel.relays))
+        self.assertFalse(self.tunnel.wait(0.1))
+        self.assertEquals([self.port], self.tunnel.open_ports)
+        self.assertEquals('hello', read_all(self.guest_connect()))
+
+    def test_woken_by_relay(self):
+        self.monitor.interval = 60
+        self.monitor.start()
+        self.lose_relay()
+        for i in range(50):
+            if self.monitor.history:
+                break
+            time.sleep(0.1)
+        self.assertEquals(('relay',), self.monitor.history[0].repaired)
+        self.assertEquals(1, self.monitor.repairs)
+        self.assertEquals('hello', read_all(self.guest_connect()))
@@ -0,0 +1,135 @@
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import unittest
+
+from path import path
+
+from vmreflect import janitor, vmapi
+from vmreflect.cache import write_json
+from vmreflect.tests.fakevm import FakeGuest, fake_vm
+
+class TestLeases(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = path(tempfile.mkdtemp(prefix='vmreflect'))
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def test_leases(self):
+        lease = janitor.take_lease('/vms/ie6.vmx', [r'C:\Temp\vmware5',
+                                                    r'C:\Temp\VMware5.d'],
+                                   self.temp_dir)
+        janitor.take_lease('/vms/ie7.vmx', [r'C:\Temp\vmware6.d'],
+                           self.temp_dir)
+        self.assertEquals(set(['vmware5', 'vmware5.d']),
+                          janitor.leased_names('/vms/ie6.vmx', self.temp_dir))
+        janitor.release_lease(lease)
+        janitor.release_lease(lease)
+        self.assertEquals(set(), janitor.leased_names('/vms/ie6.vmx',
+                                                      self.temp_dir))
+
+    def test_same_vm(self):
+        vm_dir = self.temp_dir.joinpath('ie6.vmwarevm')
+        vm_dir.mkdir()
+        vmx = vm_dir.joinpath('ie6.vmx')
+        vmx.write_bytes('')
+        vm_dir.symlink(self.temp_dir.joinpath('vms'))
+        cwd = os.getcwd()
+        os.chdir(self.temp_dir)
+        try:
+            janitor.take_lease('vms/ie6.vmx', [r'C:\Temp\vmware5.d'],
+                               self.temp_dir)
+            self.assertEquals(set(['vmware5.d']),
+                              janitor.leased_names(vmx, self.temp_dir))
+            self.assertEquals(vmx.realpath(), vmapi._vmx_path('vms'))
+        finally:
+            os.chdir(cwd)
+
+    def test_dead_process(self):
+        process = subprocess.Popen([sys.executable, '-c', ''])
+        process.wait()
+        lease = self.temp_dir.joinpath('lease-%d-x.json' % process.pid)
+        write_json(lease, {'pid': process.pid, 'vmx': '/vms/ie6.vmx',
+                           'paths': [r'C:\Temp\vmware5.d']})
+        self.assertEquals(set(), janitor.leased_names('/vms/ie6.vmx',
+                                                      self.temp_dir))
+        self.assertFalse(lease.exists())
+
+class TestLeftovers(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = path(tempfile.mkdtemp(prefix='vmreflect'))
+        self.guest = FakeGuest()
+        self.vm = fake_vm(self.guest, lease_directory=self.temp_dir)
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def make_tunnel_files(self, number):
+        base = '%s\\vmware%d' % (self.guest.temp_dir, number)
+        self.guest.write_file(base, '')
+        self.guest.make_dirs(base + '.d')
+        self.guest.write_file(base + r'.d\tcpr.ini', '[server]')
+        pid = self.guest.add_process(r'%s.d\tcpr.exe %s.d\tcpr.ini -s'
+                                     % (base, base))
+        return (base, pid)
+
+    def test_find_and_remove(self):
+        (left_base, left_pid) = self.make_tunnel_files(200)
+        (open_base, open_pid) = self.make_tunnel_files(201)
+        janitor.take_lease(self.vm.vmx, [open_base, open_base + '.d'],
+                           self.temp_dir)
+        batch_dir = self.guest.temp_dir + r'\vmreflect-ab12CD34.d'
+        self.guest.make_dirs(batch_dir)
+        # Not vmreflect's
+        other = self.guest.temp_dir + r'\vmware202'
+        self.guest.write_file(other, '')
+        other_pid = self.guest.add_process(r'C:\tcpr\tcpr.exe tcpr.ini -s')
+
+        leftovers = janitor.find_leftovers(self.vm, self.temp_dir)
+        self.assertEquals([left_pid], [p.pid for p in leftovers.processes])
+        self.assertEquals(sorted([left_base, left_base + '.d', batch_dir]),
+                          sorted(leftovers.paths))
+
+        self.guest.calls = []
+        janitor.remove_leftovers(self.vm, leftovers)
+        self.assertEquals(['killprocessinguest', 'runscriptinguest'],
+                          self.guest.calls)
+        self.assertIsNone(self.guest.find_process(left_pid))
+        self.assertEquals([open_pid, other_pid],
+                          [p.pid for p in self.guest.processes[-2:]])
+        self.assertEquals(['vmware201', 'vmware201.d', 'vmware202'],
+                          self.guest._listdir(self.guest.temp_dir))
+
+    def test_stream_open(self):
+        release = threading.Event()
+        def job(guest, argv, stdin):
+            release.wait(5)
+            return (0, 'done\r\n', '')
+        self.guest.programs['job'] = job
+        stream = self.vm.stream_command('job', interval=0.01)
+        try:
+            leftovers = janitor.find_leftovers(self.vm, self.temp_dir)
+            self.assertEquals([], leftovers.paths)
+            janitor.remove_leftovers(self.vm, leftovers)
+            self.assertTrue(self.guest.is_dir(stream.guest_dir))
+            release.set()
+            self.assertEquals([('stdout', 'done\r\n')], list(stream))
+        finally:
+            release.set()
+            stream.close()
+            self.guest.wait_for_background()
+        self.assertEquals([], self.guest._listdir(self.guest.temp_dir))
+        self.assertEquals([], self.temp_dir.files('lease-*.json'))
+
+    def test_nothing_left(self):
+        leftovers = janitor.find_leftovers(self.vm, self.temp_dir)
+        self.assertEquals(janitor.Leftovers([], []), leftovers)
+        self.guest.calls = []
+        janitor.remove_leftovers(self.vm, leftovers)
+        self.assertEquals([], self.guest.calls)
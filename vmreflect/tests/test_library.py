@@ -0,0 +1,122 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from path import path
+
+from vmreflect import library, vmapi
+from vmreflect.library import Library, LibraryEntry
+from vmreflect.tests import use_temp_cache_dir
+
+def _make_vm(directory, folder, basename, display_name):
+    vmx = directory.joinpath(folder, basename + '.vmx')
+    vmx.parent.makedirs_p()
+    vmx.write_bytes('.encoding = "UTF-8"\nconfig.version = "8"\n'
+                    'displayName = "%s"\nmemsize = "512"\n' % display_name)
+    return vmx
+
+def _touch_later(filename):
+    """Move filename's mtime on, as the clock may not have ticked."""
+    mtime = os.stat(filename).st_mtime + 10
+    os.utime(filename, (mtime, mtime))
+
+class TestLibrary(unittest.TestCase):
+
+    def setUp(self):
+        use_temp_cache_dir(self)
+        self.temp_dir = path(tempfile.mkdtemp(prefix='vmreflect'))
+        self.vm_dir = self.temp_dir.joinpath('Virtual Machines')
+        self.index_path = self.temp_dir.joinpath('cache', 'library.json')
+        self.ie6 = _make_vm(self.vm_dir, 'ie6.vmwarevm', 'ie6', 'ie6')
+        # A copy of ie6, renamed in VMware and in the Finder
+        self.copy = _make_vm(self.vm_dir, 'IE6 Copy.vmwarevm', 'ie6',
+                             'Windows XP IE6 (copy)')
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def library(self):
+        return Library([self.vm_dir], self.index_path)
+
+    def test_names(self):
+        lib = self.library()
+        for name in ['ie6', 'ie6.vmwarevm', self.ie6, self.ie6.parent,
+                     self.ie6.parent.stripext()]:
+            self.assertEquals(self.ie6, lib.find(name))
+        for name in ['Windows XP IE6 (copy)', 'windows xp ie6 (COPY)',
+                     'IE6 Copy', 'IE6 Copy.vmwarevm', self.copy,
+                     self.copy.parent + '/']:
+            self.assertEquals(self.copy, lib.find(name))
+        self.assertEquals(None, lib.find('ie7'))
+
+    def test_entries(self):
+        self.assertEquals([LibraryEntry('ie6', self.ie6),
+                           LibraryEntry('Windows XP IE6 (copy)', self.copy)],
+                          self.library().entries())
+
+    def test_saved_index(self):
+        self.library().entries()
+        self.assertTrue(self.index_path.isfile())
+
+        lib = self.library()
+        scans = []
+        lib._scan = lambda: scans.append(1)
+        self.assertEquals(self.copy, lib.find('Windows XP IE6 (copy)'))
+        self.assertEquals([], scans)
+
+    def test_new_vm(self):
+        self.library().entries()
+        lib = self.library()
+        self.assertEquals(None, lib.find('ie8'))
+        ie8 = _make_vm(self.vm_dir, 'ie8.vmwarevm', 'ie8', 'ie8')
+        _touch_later(self.vm_dir)
+        self.assertEquals(ie8, lib.find('ie8'))
+        self.assertEquals(ie8, self.library().find('ie8'))
+
+    def test_renamed_vm(self):
+        lib = self.library()
+        self.assertEquals(self.ie6, lib.find('ie6'))
+        self.ie6.write_bytes('displayName = "Old IE"\n')
+        _touch_later(self.ie6)
+        self.assertEquals(self.ie6, lib.find('Old IE'))
+        # Still the name of its folder
+        self.assertEquals(self.ie6, lib.find('IE6'))
+        shutil.rmtree(self.ie6.parent)
+        _touch_later(self.vm_dir)
+        # Now only the basename of the copy's .vmx file
+        self.assertEquals(self.copy, lib.find('IE6'))
+
+    def test_removed_vm(self):
+        lib = self.library()
+        self.assertEquals(self.copy, lib.find('IE6 Copy'))
+        shutil.rmtree(self.copy.parent)
+        self.assertEquals(None, lib.find('IE6 Copy'))
+        self.assertEquals([self.ie6], [e.vmx for e in lib.entries()])
+
+    def test_corrupt_index(self):
+        self.index_path.parent.makedirs_p()
+        self.index_path.write_bytes('{"vms": [')
+        self.assertEquals(self.ie6, self.library().find('ie6'))
+
+    def test_missing_dir(self):
+        lib = Library([self.temp_dir.joinpath('missing')], None)
+        self.assertEquals([], lib.entries())
+        self.assertEquals(None, lib.find('ie6'))
+
+    def test_vmx_path(self):
+        saved_libraries = library._libraries
+        saved_dirs = os.environ.get('VMREFLECT_VM_DIRS')
+        library._libraries = {}
+        os.environ['VMREFLECT_VM_DIRS'] = self.vm_dir
+        try:
+            self.assertEquals(self.copy,
+                              vmapi._vmx_path('Windows XP IE6 (copy)'))
+            self.assertEquals(self.copy, vmapi._vmx_path(self.copy.parent))
+            self.assertRaises(Exception, vmapi._vmx_path, 'ie7')
+        finally:
+            library._libraries = saved_libraries
+            if saved_dirs is None:
+                del os.environ['VMREFLECT_VM_DIRS']
+            else:
+                os.environ['VMREFLECT_VM_DIRS'] = saved_dirs
@@ -0,0 +1,61 @@
+"""
+Tests for the data-path load generator, which also put the relay under
+load.
+"""
+
+import unittest
+
+from vmreflect.tests.loadgen import (GUEST_HALF_CLOSE, HALF_CLOSE_BODY_SIZE,
+                                     HOST_HALF_CLOSE, REQUEST, LoadGenerator,
+                                     make_requests, percentile, run_local)
+
+class TestLoadGenerator(unittest.TestCase):
+
+    def test_percentile(self):
+        values = range(1, 101)
+        self.assertEquals(50, percentile(values, 0.5))
+        self.assertEquals(99, percentile(values, 0.99))
+        self.assertEquals(1, percentile(values, 0))
+        self.assertEquals(7, percentile([7], 0.99))
+        self.assertIsNone(percentile([], 0.5))
+
+    def test_make_requests(self):
+        requests = make_requests(20, [10, 20 * 1024], [30], half_close=0.2)
+        modes = [r.mode for r in requests]
+        self.assertEquals(16, modes.count(REQUEST))
+        self.assertEquals(2, modes.count(GUEST_HALF_CLOSE))
+        self.assertEquals(2, modes.count(HOST_HALF_CLOSE))
+        for request in requests:
+            if request.mode == GUEST_HALF_CLOSE:
+                self.assertEquals(0, request.response_size)
+            if request.mode == HOST_HALF_CLOSE:
+                self.assertLessEqual(request.request_size,
+                                     HALF_CLOSE_BODY_SIZE)
+
+    def test_through_relay(self):
+        requests = make_requests(120, [100, 256 * 1024],
+                                 [10, 64 * 1024, 4 * 1024 * 1024],
+                                 half_close=0.2)
+        (result, errors) = run_local(requests, connections=30, keep_alive=5)
+        self.assertEquals({}, result.errors)
+        self.assertEquals([], errors)
+        self.assertEquals(120, len(result.latencies))
+        self.assertEquals(sum(r.request_size for r in requests),
+                          result.bytes_sent)
+        self.assertEquals(sum(r.response_size for r in requests),
+                          result.bytes_received)
+        self.assertEquals(0, result.bytes_lost)
+
+    def test_rate(self):
+        (result, _) = run_local(make_requests(10, [10], [10]), direct=True,
+                                rate=100)
+        self.assertGreaterEqual(result.elapsed, 0.09)
+        self.assertEquals({}, result.errors)
+
+    def test_errors(self):
+        # Nothing listens on port 1.
+        generator = LoadGenerator(('127.0.0.1', 1),
+                                  make_requests(5, [10], [10]))
+        result = generator.run()
+        self.assertEquals(5, sum(result.errors.values()))
+        self.assertEquals([], result.latencies)
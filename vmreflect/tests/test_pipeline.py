@@ -0,0 +1,397 @@
+"""
+Tests for the setup pipeline, and for bringing up a tunnel's guest side
+with it against a simulated guest.
+"""
+
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+from path import path
+
+from vmreflect.cache import Cache
+from vmreflect.pipeline import Pipeline
+from vmreflect.tests.fakevm import FakeGuest, fake_vm
+from vmreflect.tunnel import Tunnel
+
+class _Rendezvous(object):
+    """
+    Functions wrapped with wrap() wait, for up to five seconds, until all
+    count of them have been called, and then run. met records, for each
+    call, whether the others were called at the same time.
+    """
+
+    def __init__(self, count):
+        self.count = count
+        self.met = []
+        self._arrived = 0
+        self._lock = threading.Lock()
+        self._all_arrived = threading.Event()
+
+    def wrap(self, func):
+        def wrapper(*args):
+            with self._lock:
+                self._arrived += 1
+                if self._arrived == self.count:
+                    self._all_arrived.set()
+            self.met.append(self._all_arrived.wait(5))
+            return func(*args)
+        return wrapper
+
+class TestPipeline(unittest.TestCase):
+
+    def test_order(self):
+        order = []
+        pipeline = Pipeline()
+        pipeline.add('c', lambda: order.append('c'), requires=['a', 'b'])
+        pipeline.add('a', lambda: order.append('a'))
+        pipeline.add('b', lambda: order.append('b'), requires=['a'])
+        pipeline.run()
+        self.assertEquals(['a', 'b', 'c'], order)
+
+    def test_results_and_timings(self):
+        pipeline = Pipeline()
+        pipeline.add('one', lambda: 1)
+        pipeline.add('two', lambda: time.sleep(0.05) or 2, requires=['one'])
+        self.assertEquals({'one': 1, 'two': 2}, pipeline.run())
+        timings = dict((t.name, t) for t in pipeline.timings)
+        self.assertGreaterEqual(timings['two'].duration, 0.05)
+        self.assertGreaterEqual(timings['two'].start,
+                                timings['one'].start + timings['one'].duration)
+
+    def test_concurrent(self):
+        rendezvous = _Rendezvous(3)
+        pipeline = Pipeline(max_workers=3)
+        for name in ['a', 'b', 'c']:
+            pipeline.add(name, rendezvous.wrap(lambda: None))
+        pipeline.run()
+        self.assertEquals([True] * 3, rendezvous.met)
+
+    def test_max_workers(self):
+        pipeline = Pipeline(max_workers=1)
+        for name in ['a', 'b', 'c']:
+            pipeline.add(name, lambda: time.sleep(0.02))
+        start = time.time()
+        pipeline.run()
+        self.assertGreaterEqual(time.time() - start, 0.06)
+
+    def test_failure(self):
+        ran = []
+        def fail():
+            raise ValueError('failed')
+        pipeline = Pipeline()
+        pipeline.add('a', fail)
+        pipeline.add('b', lambda: ran.append('b'), requires=['a'])
+        self.assertRaises(ValueError, pipeline.run)
+        self.assertEquals([], ran)
+
+    def test_keep_going(self):
+        ran = []
+        def fail():
+            raise ValueError('failed')
+        pipeline = Pipeline(keep_going=True)
+        pipeline.add('a', fail)
+        pipeline.add('b', lambda: ran.append('b'), requires=['a'])
+        pipeline.add('c', lambda: ran.append('c'))
+        self.assertEquals({'b': None, 'c': None}, pipeline.run())
+        self.assertEquals(['b', 'c'], sorted(ran))
+        [(name, exc_info)] = pipeline.errors
+        self.assertEquals(('a', ValueError), (name, exc_info[0]))
+
+    def test_unknown_stage(self):
+        pipeline = Pipeline()
+        pipeline.add('a', lambda: None, requires=['nonexistent'])
+        self.assertRaises(Exception, pipeline.run)
+
+    def test_cycle(self):
+        pipeline = Pipeline()
+        pipeline.add('a', lambda: None, requires=['b'])
+        pipeline.add('b', lambda: None, requires=['a'])
+        self.assertRaises(Exception, pipeline.run)
+
+def _tcpr(guest, argv, stdin):
+    if '-m' in argv:
+        guest.write_file(argv[1].rsplit('\\', 1)[0] + r'\user_db', 'users')
+        return (0, 'manager password changed\r\n', '')
+    return (1, '', 'unsupported\r\n')
+
+def _tcpr_guest(latency):
+    guest = FakeGuest(latency=latency)
+    guest.programs['tcpr*.exe'] = _tcpr
+    return guest
+
+class TestBringUp(unittest.TestCase):
+
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp(prefix='vmreflect')
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir)
+
+    def tunnel(self, guest, port=8000, **kwargs):
+        return Tunnel(None, port, None, None, vm=fake_vm(guest),
+                      cache=Cache(self.cache_dir), **kwargs)
+
+    def bring_up(self, guest, max_workers):
+        tunnel = self.tunnel(guest, max_workers=max_workers)
+        tunnel._cleanups = []
+        try:
+            tunnel._bring_up()
+            return tunnel
+        finally:
+            tunnel._tear_down()
+
+    def test_bring_up(self):
+        guest = _tcpr_guest(latency=0)
+        tunnel = self.bring_up(guest, max_workers=4)
+        self.assertEquals(guest.ip_address, tunnel.server_ip)
+        self.assertEquals(set(['extract', 'guest_temp', 'guest_ip', 'ini',
+                               'copy', 'server']),
+                          set(t.name for t in tunnel.timings))
+        self.assertIsNone(guest.find_process(tunnel.server_pid))
+        self.assertFalse(guest.is_dir(tunnel.guest_temp_dir))
+        self.assertFalse(tunnel.host_temp_dir.exists())
+
+    def test_steps_overlap(self):
+        # Finding the guest's address and making its temporary directory
+        # don't depend on each other, so they run at the same time.
+        guest = _tcpr_guest(latency=0)
+        tunnel = self.tunnel(guest, max_workers=4)
+        rendezvous = _Rendezvous(2)
+        tunnel._find_guest_ip = rendezvous.wrap(tunnel._find_guest_ip)
+        tunnel._create_guest_temp_dir = rendezvous.wrap(
+            tunnel._create_guest_temp_dir)
+        tunnel._cleanups = []
+        try:
+            tunnel._bring_up()
+        finally:
+            tunnel._tear_down()
+        self.assertEquals([True, True], rendezvous.met)
+
+    def test_several_ports(self):
+        def bring_up(port):
+            guest = _tcpr_guest(latency=0)
+            tunnel = self.tunnel(guest, port=port)
+            tunnel._cleanups = []
+            try:
+                tunnel._bring_up()
+                ini = guest.read_file(tunnel.remote_tcpr_ini)
+                forwards = tunnel._forwards(tunnel.forward_ports)
+                return (guest.call_count(), ini, forwards)
+            finally:
+                tunnel._tear_down()
+
+        (one_calls, ini, forwards) = bring_up(8000)
+        self.assertIn('reflector=0.0.0.0:7999-7999-8000', ini)
+        self.assertEquals([8000], [f.port for f in forwards])
+
+        # Forwarding more ports costs nothing extra in the guest.
+        (calls, ini, forwards) = bring_up([3000, 8000, 8001, 8002])
+        self.assertEquals(one_calls, calls)
+        self.assertIn('reflector=0.0.0.0:2999-2999-8002', ini)
+        self.assertEquals([3000, 8000, 8001, 8002],
+                          [f.port for f in forwards])
+        self.assertEquals(4, len(set(f.name for f in forwards)))
+
+    def test_ports_taken(self):
+        guest = _tcpr_guest(latency=0)
+        tunnel = self.tunnel(guest)
+        taken = []
+        def netstat(guest, argv, stdin):
+            if not taken:
+                # Something else has started listening on the ports
+                # chosen, since netstat was last run.
+                taken.extend([tunnel.server_port, tunnel.console_port])
+                for port in taken:
+                    guest.listening[port] = None
+            return guest._netstat(argv, stdin)
+        guest.programs['netstat'] = netstat
+        tunnel._cleanups = []
+        try:
+            tunnel._bring_up()
+            self.assertNotIn(tunnel.server_port, taken)
+            self.assertEquals(tunnel.server_port + 1, tunnel.console_port)
+            self.assertIn('listen=0.0.0.0:%d' % tunnel.server_port,
+                          guest.read_file(tunnel.remote_tcpr_ini))
+            self.assertEquals([tunnel.server_pid],
+                              [p.pid for p in guest.processes
+                               if 'tcpr' in p.cmd])
+            self.assertEquals(set(taken + [445]),
+                              tunnel.vmapi.listening_ports)
+
+            # A second tunnel to the VM avoids them from the start.
+            guest.calls = []
+            second = Tunnel(None, 8000, None, None, vm=tunnel.vmapi,
+                            cache=Cache(self.cache_dir))
+            second._cleanups = []
+            try:
+                second._bring_up()
+                self.assertEquals(1, guest.calls.count('runscriptinguest'))
+                self.assertNotIn(second.server_port,
+                                 taken + [tunnel.server_port])
+            finally:
+                second._tear_down()
+        finally:
+            tunnel._tear_down()
+
+    def test_ports_always_taken(self):
+        guest = _tcpr_guest(latency=0)
+        tunnel = self.tunnel(guest)
+        tried = []
+        def netstat(guest, argv, stdin):
+            tried.append((tunnel.server_port, tunnel.console_port))
+            for port in tried[-1]:
+                guest.listening[port] = None
+            return guest._netstat(argv, stdin)
+        guest.programs['netstat'] = netstat
+        tunnel._cleanups = []
+        try:
+            try:
+                tunnel._bring_up()
+            except Exception, e:
+                (server_port, console_port) = tried[-1]
+                self.assertIn('port %d and port %d already in use'
+                              % (server_port, console_port), str(e))
+            else:
+                self.fail('expected the ports to be in use')
+            self.assertEquals(3, len(tried))
+        finally:
+            tunnel._tear_down()
+        # Each server was killed once, and none is left running.
+        self.assertEquals(3, guest.calls.count('killprocessinguest'))
+        self.assertEquals([], [p for p in guest.processes
+                               if 'tcpr' in p.cmd])
+        self.assertEquals([], guest._listdir(guest.temp_dir))
+
+    def test_restart_ports_taken(self):
+        guest = _tcpr_guest(latency=0)
+        tunnel = self.tunnel(guest)
+        tunnel._cleanups = []
+        try:
+            tunnel._bring_up()
+            tunnel.vmapi.kill_process(tunnel.server_pid)
+            tried = []
+            def netstat(guest, argv, stdin):
+                tried.append((tunnel.server_port, tunnel.console_port))
+                for port in tried[-1]:
+                    guest.listening[port] = None
+                return guest._netstat(argv, stdin)
+            guest.programs['netstat'] = netstat
+            guest.calls = []
+            try:
+                tunnel._restart_server(time.time() + 5)
+            except Exception, e:
+                (server_port, console_port) = tried[-1]
+                self.assertIn('port %d and port %d already in use'
+                              % (server_port, console_port), str(e))
+            else:
+                self.fail('expected the ports to be in use')
+            self.assertEquals(3, len(set(tried)))
+            self.assertEquals(3, guest.calls.count('killprocessinguest'))
+            self.assertIsNone(tunnel.server_pid)
+        finally:
+            tunnel._tear_down()
+        # Tearing down doesn't look for a server to kill.
+        self.assertEquals(3, guest.calls.count('killprocessinguest'))
+
+    def test_cleanup_after_failure(self):
+        guest = _tcpr_guest(latency=0.01)
+        # Finding the guest's address fails.
+        guest.ip_address = 'unknown'
+        tunnel = self.tunnel(guest)
+        tunnel._cleanups = []
+        try:
+            self.assertRaises(Exception, tunnel._bring_up)
+        finally:
+            tunnel._tear_down()
+        self.assertEquals([], guest._listdir(guest.temp_dir))
+        self.assertFalse(tunnel.host_temp_dir.exists())
+
+    def test_open_failure(self):
+        guest = _tcpr_guest(latency=0)
+        guest.ip_address = 'unknown'
+        tunnel = self.tunnel(guest)
+        self.assertRaises(Exception, tunnel.open)
+        self.assertFalse(tunnel.is_open)
+        self.assertEquals([], guest._listdir(guest.temp_dir))
+        self.assertFalse(tunnel.host_temp_dir.exists())
+        self.assertEquals([], path(self.cache_dir).files('lease-*.json'))
+
+    def test_tear_down(self):
+        guest = _tcpr_guest(latency=0)
+        tunnel = self.tunnel(guest)
+        tunnel._cleanups = []
+        try:
+            tunnel._bring_up()
+            # One for the guest's files, and one for its ports
+            self.assertEquals(2, len(path(self.cache_dir).files(
+                'lease-*.json')))
+        finally:
+            guest.calls = []
+            # The cleanups all run at once.
+            rendezvous = _Rendezvous(len(tunnel._cleanups))
+            tunnel._cleanups = [rendezvous.wrap(cleanup)
+                                for cleanup in tunnel._cleanups]
+            tunnel._tear_down()
+        self.assertEquals([True] * rendezvous.count, rendezvous.met)
+        self.assertEquals(['deletedirectoryinguest', 'deletefileinguest',
+                           'killprocessinguest'], sorted(guest.calls))
+        # The server's directory is only deleted once it has been killed,
+        # but the temporary file goes at the same time.
+        self.assertLess(guest.calls.index('killprocessinguest'),
+                        guest.calls.index('deletedirectoryinguest'))
+        self.assertEquals([], guest._listdir(guest.temp_dir))
+        self.assertEquals([], path(self.cache_dir).files('lease-*.json'))
+
+    def test_detach(self):
+        guest = _tcpr_guest(latency=0)
+        tunnel = self.tunnel(guest)
+        tunnel._cleanups = []
+        tunnel._bring_up()
+        leases = path(self.cache_dir).files('lease-*.json')
+        # The background process takes a while to clean up.
+        guest.latency = 0.2
+        tunnel._detach()
+        self.assertEquals([], tunnel._cleanups)
+        self.assertIsNone(tunnel._lease)
+        pids = set(json.loads(lease.bytes())['pid'] for lease in leases)
+        self.assertEquals(1, len(pids))
+        self.assertNotIn(os.getpid(), pids)
+        for i in range(100):
+            if not (tunnel.host_temp_dir.exists() or
+                    path(self.cache_dir).files('lease-*.json')):
+                break
+            time.sleep(0.05)
+        self.assertFalse(tunnel.host_temp_dir.exists())
+        self.assertEquals([], path(self.cache_dir).files('lease-*.json'))
+
+    def test_guest_install_dir(self):
+        guest = _tcpr_guest(latency=0)
+        install_dir = r'C:\vmreflect'
+        (tunnel, _) = self.bring_up_installed(guest, install_dir)
+        self.assertTrue(tunnel.remote_tcpr_cmd.startswith(install_dir + '\\'))
+        self.assertTrue(guest.is_file(tunnel.remote_tcpr_cmd))
+        self.assertEquals(1, len(guest._listdir(install_dir)))
+
+        # A second tunnel only copies its .ini file over.
+        guest.calls = []
+        (second, _) = self.bring_up_installed(guest, install_dir)
+        self.assertEquals(tunnel.remote_tcpr_cmd, second.remote_tcpr_cmd)
+        self.assertEquals(1, guest.call_count('copyFileFromHostToGuest'))
+        self.assertEquals(1, guest.call_count('fileExistsInGuest'))
+        self.assertEquals([], guest._listdir(guest.temp_dir))
+
+    def bring_up_installed(self, guest, install_dir):
+        tunnel = self.tunnel(guest, guest_install_dir=install_dir)
+        tunnel._cleanups = []
+        try:
+            tunnel._bring_up()
+            process = guest.find_process(tunnel.server_pid)
+            self.assertIn(tunnel.remote_tcpr_cmd, process.cmd)
+            return (tunnel, None)
+        finally:
+            tunnel._tear_down()
@@ -0,0 +1,90 @@
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import unittest
+
+from path import path
+
+from vmreflect import janitor
+from vmreflect.cache import write_json
+from vmreflect.ports import NoFreePorts, allocate_ports, parse_netstat
+
+_NETSTAT = """
+Active Connections
+
+  Proto  Local Address          Foreign Address        State
+  TCP    0.0.0.0:135            0.0.0.0:0              LISTENING
+  TCP    0.0.0.0:445            0.0.0.0:0              ABHOEREN
+  TCP    192.168.1.5:139        0.0.0.0:0              LISTENING
+  TCP    192.168.1.5:1040       192.168.1.1:4000       ESTABLISHED
+  UDP    0.0.0.0:500            *:*
+"""
+
+class TestPorts(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = path(tempfile.mkdtemp(prefix='vmreflect'))
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def allocate(self, **kwargs):
+        return allocate_ports('/vms/ie6.vmx', directory=self.temp_dir,
+                              **kwargs)
+
+    def test_parse_netstat(self):
+        self.assertEquals(set([135, 139, 445]), parse_netstat(_NETSTAT))
+
+    def test_allocate(self):
+        (ports, lease) = self.allocate(exclude=range(4000, 4009),
+                                       port_range=(4000, 4010))
+        self.assertEquals([4009, 4010], ports)
+        self.assertEquals(set(ports), janitor.leased_ports('/vms/ie6.vmx',
+                                                           self.temp_dir))
+        self.assertEquals(set(), janitor.leased_ports('/vms/ie7.vmx',
+                                                      self.temp_dir))
+        self.assertRaises(NoFreePorts, self.allocate,
+                          port_range=(4009, 4011))
+        janitor.release_lease(lease)
+        self.assertEquals([4009, 4010],
+                          self.allocate(port_range=(4009, 4010))[0])
+
+    def test_same_vm(self):
+        # One tunnel names the VM by a relative path, another by its full
+        # path.
+        vm_dir = self.temp_dir.joinpath('vms')
+        vm_dir.mkdir()
+        cwd = os.getcwd()
+        os.chdir(self.temp_dir)
+        try:
+            allocate_ports('vms/ie6.vmx', directory='.',
+                           port_range=(4000, 4001))
+        finally:
+            os.chdir(cwd)
+        self.assertRaises(NoFreePorts, allocate_ports,
+                          vm_dir.joinpath('ie6.vmx'),
+                          directory=self.temp_dir, port_range=(4000, 4001))
+
+    def test_dead_process(self):
+        process = subprocess.Popen([sys.executable, '-c', ''])
+        process.wait()
+        write_json(self.temp_dir.joinpath('lease-%d-x.json' % process.pid),
+                   {'pid': process.pid, 'vmx': '/vms/ie6.vmx',
+                    'paths': [], 'ports': [4000, 4001]})
+        self.assertEquals([4000, 4001],
+                          self.allocate(port_range=(4000, 4001))[0])
+
+    def test_concurrent(self):
+        results = []
+        def allocate():
+            results.append(self.allocate(port_range=(4000, 4039))[0])
+        threads = [threading.Thread(target=allocate) for i in range(10)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        ports = sum(results, [])
+        self.assertEquals(20, len(set(ports)))
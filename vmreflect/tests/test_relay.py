@@ -0,0 +1,299 @@
+"""
+Tests for the host-side relay, run against the stand-in reflector server.
+"""
+
+import os
+import socket
+import SocketServer
+import threading
+import time
+import unittest
+
+from vmreflect import tcpr
+from vmreflect.relay import Forward, Relay, RelayError
+from vmreflect.tests.fakereflector import FakeReflector
+
+class _LocalServer(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+    request_queue_size = 128
+
+def local_server(handle):
+    """Start a server on the host calling handle(sock) per connection."""
+    class Handler(SocketServer.BaseRequestHandler):
+        def handle(self):
+            handle(self.request)
+    server = _LocalServer(('127.0.0.1', 0), Handler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+def read_all(sock):
+    chunks = []
+    while True:
+        data = sock.recv(65536)
+        if not data:
+            return ''.join(chunks)
+        chunks.append(data)
+
+def read_exactly(sock, size):
+    chunks = []
+    while size:
+        data = sock.recv(min(size, 65536))
+        if not data:
+            raise EOFError('connection closed')
+        chunks.append(data)
+        size -= len(data)
+    return ''.join(chunks)
+
+def _open_fds():
+    return len(os.listdir('/dev/fd'))
+
+def reverse_request(sock):
+    """Read a length-prefixed request and reply with it reversed."""
+    size = int(read_exactly(sock, 10))
+    sock.sendall(read_exactly(sock, size)[::-1])
+
+class RelayTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.reflector = FakeReflector()
+        self.reflector.add_user('client.tcprclient', 'secret')
+        self.local_servers = []
+        self.relays = []
+
+    def tearDown(self):
+        for relay in self.relays:
+            relay.close()
+            relay.thread.join(5)
+        for server in self.local_servers:
+            server.shutdown()
+            server.server_close()
+        self.reflector.close()
+        self.assertEquals([], self.reflector.errors)
+
+    def start_local(self, handle):
+        server = local_server(handle)
+        self.local_servers.append(server)
+        return server.server_address[1]
+
+    def start_relay(self, ports, password='secret', **kwargs):
+        relay = Relay(self.reflector.address, 'tcprclient', password,
+                      [Forward('forward%d' % p, 'forward%d' % p,
+                               '127.0.0.1', p) for p in ports], **kwargs)
+        relay.connect()
+        self.relays.append(relay)
+        thread = threading.Thread(target=relay.run)
+        thread.daemon = True
+        thread.start()
+        relay.thread = thread
+        self.reflector.wait_for_forwards(len(ports))
+        return relay
+
+    def guest_connect(self, forward_port):
+        return socket.create_connection(('127.0.0.1', forward_port), 5)
+
+    def request(self, forward_port, payload):
+        sock = self.guest_connect(forward_port)
+        try:
+            sock.sendall('%10d' % len(payload) + payload)
+            return read_all(sock)
+        finally:
+            sock.close()
+
+class TestRelay(RelayTestCase):
+
+    def test_request(self):
+        relay = self.start_relay([self.start_local(reverse_request)])
+        port = self.reflector.start_forward(0)
+        self.assertEquals('olleh', self.request(port, 'hello'))
+        self.assertEquals(1, relay.tunnels_opened)
+
+    def test_large_transfer(self):
+        self.start_relay([self.start_local(reverse_request)])
+        port = self.reflector.start_forward(0)
+        payload = os.urandom(3 * 1024 * 1024)
+        self.assertEquals(payload[::-1], self.request(port, payload))
+
+    def test_many_connections(self):
+        relay = self.start_relay([self.start_local(reverse_request)])
+        port = self.reflector.start_forward(0)
+        results = {}
+        def run(i):
+            payload = os.urandom(20000 + i)
+            results[i] = (self.request(port, payload) == payload[::-1])
+        threads = [threading.Thread(target=run, args=(i,))
+                   for i in range(60)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join(30)
+        self.assertEquals(dict((i, True) for i in range(60)), results)
+        self.assertEquals(60, relay.tunnels_opened)
+        self.assertTrue(relay.thread.is_alive())
+
+    def test_several_forwards(self):
+        def greet(name):
+            return lambda sock: sock.sendall('I am ' + name)
+        self.start_relay([self.start_local(greet('one')),
+                          self.start_local(greet('two'))])
+        first = self.reflector.start_forward(0)
+        second = self.reflector.start_forward(1)
+        self.assertEquals('I am two', read_all(self.guest_connect(second)))
+        self.assertEquals('I am one', read_all(self.guest_connect(first)))
+
+    def test_connection_refused(self):
+        unused = socket.socket()
+        unused.bind(('127.0.0.1', 0))
+        unused_port = unused.getsockname()[1]
+        unused.close()
+        relay = self.start_relay([unused_port])
+        port = self.reflector.start_forward(0)
+        self.assertEquals('', read_all(self.guest_connect(port)))
+        self.assertTrue(relay.thread.is_alive())
+
+    def test_bad_password(self):
+        relay = Relay(self.reflector.address, 'tcprclient', 'wrong',
+                      [Forward('f', 'f', '127.0.0.1', 1)])
+        self.assertRaises(tcpr.AuthenticationError, relay.connect)
+
+    def test_never_run(self):
+        unused = socket.socket()
+        unused.bind(('127.0.0.1', 0))
+        unused_address = unused.getsockname()
+        unused.close()
+        fds = _open_fds()
+        for i in range(3):
+            relay = Relay(unused_address, 'tcprclient', 'secret',
+                          [Forward('f', 'f', '127.0.0.1', 1)])
+            self.assertRaises(socket.error, relay.connect)
+            relay.close()
+        self.assertEquals(fds, _open_fds())
+
+    def test_already_connected(self):
+        self.start_relay([1], hostname='host', node_id='1')
+        relay = Relay(self.reflector.address, 'tcprclient', 'secret',
+                      [Forward('f', 'f', '127.0.0.1', 1)],
+                      hostname='host', node_id='1')
+        self.assertRaises(RelayError, relay.connect)
+
+    def test_close(self):
+        relay = self.start_relay([1])
+        relay.close()
+        relay.thread.join(5)
+        self.assertFalse(relay.thread.is_alive())
+
+class TestHalfClose(RelayTestCase):
+
+    def test_host_half_close(self):
+        """
+        The host end shutting down its side of the connection doesn't stop
+        data from the guest that was already on its way.
+        """
+        received = []
+        done = threading.Event()
+        def handle(sock):
+            sock.sendall('greeting')
+            sock.shutdown(socket.SHUT_WR)
+            received.append(read_all(sock))
+            done.set()
+        relay = self.start_relay([self.start_local(handle)])
+        port = self.reflector.start_forward(0)
+
+        sock = self.guest_connect(port)
+        sock.sendall('sent right away')
+        self.assertEquals('greeting', read_all(sock))
+        sock.close()
+        done.wait(5)
+        self.assertEquals(['sent right away'], received)
+
+        # Unlike tcpr's own client, the relay survives.
+        self.assertEquals('greeting', read_all(self.guest_connect(port)))
+        self.assertTrue(relay.thread.is_alive())
+
+    def test_guest_close(self):
+        """Data from the guest is all written before the host end sees EOF."""
+        received = []
+        done = threading.Event()
+        def handle(sock):
+            received.append(read_all(sock))
+            done.set()
+        self.start_relay([self.start_local(handle)])
+        port = self.reflector.start_forward(0)
+
+        payload = os.urandom(1024 * 1024)
+        sock = self.guest_connect(port)
+        sock.sendall(payload)
+        sock.close()
+        done.wait(5)
+        self.assertEquals([payload], received)
+
+    def test_closed_while_connecting(self):
+        """
+        Data that arrives along with the tunnel and the guest closing it
+        still reaches the host end, and the tunnel, which the server has
+        forgotten, is never acknowledged.
+        """
+        received = []
+        done = threading.Event()
+        def handle(sock):
+            received.append(read_all(sock))
+            done.set()
+        port = self.start_local(handle)
+        # The server end is scripted, so that every packet arrives at once.
+        (relay_end, server_end) = socket.socketpair()
+        relay = Relay(None, 'tcprclient', 'secret',
+                      [Forward('f', 'f', '127.0.0.1', port)],
+                      alive_interval=0)
+        relay_end.setblocking(False)
+        (relay._sock, relay._last_received) = (relay_end, time.time())
+        thread = threading.Thread(target=relay.run)
+        thread.daemon = True
+        thread.start()
+
+        server_end.sendall(tcpr.pack('T', 7, 0)
+                           + tcpr.pack_data(7, 'sent right away')
+                           + tcpr.pack('C', 7, 0))
+        done.wait(5)
+        self.assertEquals(['sent right away'], received)
+        relay.close()
+        thread.join(5)
+        self.assertEquals('', read_all(server_end))
+        server_end.close()
+
+class TestBackpressure(RelayTestCase):
+
+    def test_bounded_buffers(self):
+        buffer_size = 64 * 1024
+        payload = os.urandom(16 * 1024 * 1024)
+        proceed = threading.Event()
+        received = []
+        def handle(sock):
+            proceed.wait(10)
+            received.append(read_all(sock))
+        relay = self.start_relay([self.start_local(handle)],
+                                 buffer_size=buffer_size)
+        port = self.reflector.start_forward(0)
+
+        sock = self.guest_connect(port)
+        sender = threading.Thread(target=lambda: (sock.sendall(payload),
+                                                  sock.close()))
+        sender.daemon = True
+        sender.start()
+        time.sleep(0.5)
+
+        # The host end isn't reading, so once the socket buffers are full
+        # the relay stops reading from the server instead of buffering
+        # everything.
+        [channel] = relay.channels.values()
+        self.assertLessEqual(channel.to_local_size, buffer_size + 16384)
+        self.assertLess(relay.bytes_from_server, len(payload) / 2)
+
+        proceed.set()
+        sender.join(10)
+        for i in range(50):
+            if received:
+                break
+            time.sleep(0.1)
+        self.assertEquals([payload], received)
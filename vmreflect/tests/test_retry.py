@@ -0,0 +1,60 @@
+import socket
+import unittest
+
+from vmreflect.retry import Backoff, DeadlineExceeded, NotReady, retry
+
+class FakeClock(object):
+
+    def __init__(self):
+        self.now = 0.0
+        self.sleeps = []
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+class TestRetry(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = FakeClock()
+
+    def retry(self, func, deadline, *args, **kwargs):
+        return retry(func, deadline, *args, clock=self.clock.time,
+                     sleep=self.clock.sleep, **kwargs)
+
+    def fails(self, times, error=NotReady):
+        calls = []
+        def func():
+            calls.append(self.clock.now)
+            if len(calls) <= times:
+                raise error('not yet')
+            return len(calls)
+        return func
+
+    def test_backoff(self):
+        self.assertEquals(5, self.retry(self.fails(4), 60,
+                                        backoff=Backoff(0.1, 2, 0.5)))
+        self.assertEquals([0.1, 0.2, 0.4, 0.5], self.clock.sleeps)
+
+    def test_ready_at_once(self):
+        self.assertEquals(1, self.retry(self.fails(0), 60))
+        self.assertEquals([], self.clock.sleeps)
+
+    def test_deadline(self):
+        try:
+            self.retry(self.fails(100), 1.0, backoff=Backoff(0.3, 1, 1))
+            self.fail('should have given up')
+        except DeadlineExceeded, e:
+            self.assertEquals('not yet', str(e))
+        # The last wait is cut short to end at the deadline.
+        self.assertEquals([0.3, 0.3, 0.3], self.clock.sleeps[:3])
+        self.assertAlmostEqual(1.0, self.clock.now)
+
+    def test_retry_on(self):
+        self.assertEquals(3, self.retry(self.fails(2, socket.error), 60,
+                                        (socket.error,)))
+        self.assertRaises(socket.error, self.retry,
+                          self.fails(2, socket.error), 60)
@@ -0,0 +1,83 @@
+"""
+Tests for persistent VM sessions, run against a simulated guest behind a
+local session daemon.
+"""
+
+import os
+import threading
+import unittest
+
+from vmreflect import vmapi
+from vmreflect.session import SessionBackend, SessionServer
+from vmreflect.tests.fakevm import FakeGuest, fake_vm
+
+class TestSession(unittest.TestCase):
+
+    def setUp(self):
+        self.guest = FakeGuest(login_latency=0.02)
+        self.server = SessionServer(('127.0.0.1', 0), self.guest.open_session)
+        server_thread = threading.Thread(target=self.server.serve_forever)
+        server_thread.daemon = True
+        server_thread.start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def session_backend(self, password='test'):
+        return SessionBackend(self.server.server_address,
+                              'Administrator', password)
+
+    def test_run_command(self):
+        vm = fake_vm(self.guest, backend=self.session_backend())
+        try:
+            (out, err) = vm._run_command('echo hi')
+            self.assertEquals('hi\r\n', out)
+            vm.list_processes()
+        finally:
+            vm.close()
+        self.assertEquals(1, self.guest.logins)
+
+    def test_bad_password(self):
+        self.assertRaises(vmapi.VmException,
+                          lambda: self.session_backend(password='wrong'))
+
+    def test_one_login_per_session(self):
+        """A session logs in once, however many operations it runs."""
+        operations = 10
+
+        vm = fake_vm(self.guest, backend=self.session_backend())
+        for i in range(operations):
+            vm._create_temp_file()
+        vm.close()
+        self.assertEquals(1, self.guest.logins)
+
+        for i in range(operations):
+            vm = fake_vm(self.guest, backend=self.session_backend())
+            vm._create_temp_file()
+            vm.close()
+        self.assertEquals(1 + operations, self.guest.logins)
+
+class TestDefaultBackend(unittest.TestCase):
+
+    def setUp(self):
+        self.saved = os.environ.get('VMREFLECT_SESSION')
+
+    def tearDown(self):
+        if self.saved is None:
+            os.environ.pop('VMREFLECT_SESSION', None)
+        else:
+            os.environ['VMREFLECT_SESSION'] = self.saved
+
+    def test_vmrun_without_session(self):
+        os.environ.pop('VMREFLECT_SESSION', None)
+        self.assertIsInstance(vmapi.default_backend('user', 'password'),
+                              vmapi.VmrunBackend)
+
+    def test_fallback_when_daemon_unreachable(self):
+        server = SessionServer(('127.0.0.1', 0))
+        address = '%s:%d' % server.server_address
+        server.server_close()
+        os.environ['VMREFLECT_SESSION'] = address
+        self.assertIsInstance(vmapi.default_backend('user', 'password'),
+                              vmapi.VmrunBackend)
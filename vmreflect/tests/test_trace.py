@@ -0,0 +1,111 @@
+import json
+import shutil
+import tempfile
+import unittest
+from StringIO import StringIO
+
+from path import path
+
+from vmreflect import trace
+from vmreflect.cache import Cache
+from vmreflect.tests.fakevm import FakeGuest, fake_vm
+from vmreflect.tests.test_pipeline import _tcpr_guest
+from vmreflect.tunnel import Tunnel
+
+class _FailingBackend(object):
+
+    def run(self, cmd_args):
+        raise EOFError('connection lost')
+
+    def close(self):
+        pass
+
+class TestTrace(unittest.TestCase):
+
+    def setUp(self):
+        self.tracer = trace.start()
+        self.temp_dir = path(tempfile.mkdtemp(prefix='vmreflect'))
+
+    def tearDown(self):
+        trace.stop()
+        shutil.rmtree(self.temp_dir)
+
+    def test_disabled(self):
+        trace.stop()
+        fake_vm(FakeGuest()).create_directory(r'C:\dir')
+        self.assertEquals([], self.tracer.spans)
+
+    def test_operations(self):
+        guest = FakeGuest()
+        vm = fake_vm(guest)
+        host_file = self.temp_dir.joinpath('file')
+        host_file.write_bytes('x' * 100)
+        vm.copy_file_to_guest(host_file, r'C:\file')
+        self.assertFalse(vm.file_exists(r'C:\missing'))
+
+        [copy, exists] = self.tracer.spans
+        self.assertEquals(('CopyFileFromHostToGuest', 'vmrun', 0, 100),
+                          (copy.name, copy.category, copy.returncode,
+                           copy.size))
+        self.assertEquals([vm.vmx, host_file, r'C:\file'], copy.args)
+        self.assertEquals('fileExistsInGuest', exists.name)
+        self.assertGreaterEqual(exists.duration, 0)
+
+    def test_error(self):
+        vm = fake_vm(FakeGuest(), backend=_FailingBackend())
+        self.assertRaises(EOFError, vm.delete_file, r'C:\file')
+        [span] = self.tracer.spans
+        self.assertEquals((None, 'connection lost'),
+                          (span.returncode, span.error))
+
+    def test_redaction(self):
+        password = trace.secret('s3cr3t-password')
+        fake_vm(FakeGuest())._run_command('echo %s' % password)
+        self.assertTrue(self.tracer.spans)
+        output = StringIO()
+        self.tracer.write_json_lines(output)
+        self.assertNotIn(password, output.getvalue())
+        self.assertIn('echo ***', output.getvalue())
+        self.assertEquals(['-gu', 'user', '-gp', '***'],
+                          trace.redact_args(['-gu', 'user', '-gp', 'pw']))
+
+    def test_bring_up(self):
+        guest = _tcpr_guest(latency=0)
+        tunnel = Tunnel(None, 8000, None, None, vm=fake_vm(guest),
+                        cache=Cache(self.temp_dir))
+        tunnel._cleanups = []
+        try:
+            tunnel._bring_up()
+        finally:
+            tunnel._tear_down()
+
+        stages = [s.name for s in self.tracer.spans if s.category == 'stage']
+        # Tearing down runs the cleanups as stages too.
+        self.assertEquals(sorted(t.name for t in tunnel.timings),
+                          sorted(s for s in stages
+                                 if not s.startswith('cleanup')))
+        self.assertIn('cleanup0', stages)
+        operations = [s for s in self.tracer.spans if s.category == 'vmrun']
+        self.assertEquals(guest.call_count(), len(operations))
+        for span in operations:
+            self.assertNotIn(tunnel.manager_password, ' '.join(span.args))
+
+    def test_export(self):
+        vm = fake_vm(FakeGuest())
+        vm.create_directory(r'C:\dir')
+        vm.delete_directory(r'C:\dir')
+
+        lines = StringIO()
+        self.tracer.write_json_lines(lines)
+        spans = [json.loads(l) for l in lines.getvalue().splitlines()]
+        self.assertEquals(['createDirectoryInGuest', 'deleteDirectoryInGuest'],
+                          [s['name'] for s in spans])
+        self.assertEquals(0, spans[0]['returncode'])
+
+        chrome = StringIO()
+        self.tracer.write_chrome(chrome)
+        events = json.loads(chrome.getvalue())['traceEvents']
+        self.assertEquals(['M', 'X', 'X'], [e['ph'] for e in events])
+        self.assertEquals(0, events[1]['ts'])
+        self.assertGreaterEqual(events[2]['ts'], events[1]['ts'])
+        self.assertEquals('vmrun', events[1]['cat'])
@@ -12,3 +12,13 @@ class TestUtil(unittest.TestCase):
                 all(c in alphabet
                     for c in get_random_string(alphabet=alphabet)))
 
+
+    def test_parse_ports(self):
+        from vmreflect.utils import parse_ports
+        self.assertEquals([8000], parse_ports('8000'))
+        self.assertEquals([3000, 8000, 8001, 8002],
+                          parse_ports('3000,8000-8002'))
+        self.assertEquals([8001, 8000, 8002], parse_ports('8001, 8000-8002'))
+        self.assertEquals(range(1, 65536), parse_ports('1-65535,1-65535'))
+        for bad in ['', 'http', '0', '65536', '8002-8000', '1-2-3']:
+            self.assertRaises(ValueError, parse_ports, bad)
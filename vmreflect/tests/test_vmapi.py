@@ -2,17 +2,24 @@
 Unit tests for the virtual machine API
 """
 
+import shutil
+import tempfile
+import threading
 import unittest
 
 from path import path
 
-from vmreflect.tests import test_config
+from vmreflect.tests import test_config, use_temp_cache_dir
 from vmreflect.utils import get_random_string
-from vmreflect import vmapi
+from vmreflect import addresses, vmapi
+from vmreflect.addresses import AddressCache
+from vmreflect.retry import Backoff, DeadlineExceeded
+from vmreflect.tests.fakevm import FakeBackend, FakeGuest, fake_vm
 
 class TestVmApi(unittest.TestCase):
 
     def setUp(self):
+        use_temp_cache_dir(self)
         self.vm = vmapi.VM(vm_name=test_config.vm_name,
                            username=test_config.vm_username,
                            password=test_config.vm_password)
@@ -46,6 +53,9 @@ pid=1232, owner=ADMIN\Administrator, cmd="C:\WINDOWS\system32\notepad.exe"
 
 class TestVmApiFailures(unittest.TestCase):
 
+    def setUp(self):
+        use_temp_cache_dir(self)
+
     def test_exception_on_bad_username_password(self):
         self.vm = vmapi.VM(vm_name=test_config.vm_name,
             username=get_random_string(), password=get_random_string())
@@ -54,6 +64,7 @@ class TestVmApiFailures(unittest.TestCase):
 class TestVmxPath(unittest.TestCase):
 
     def setUp(self):
+        use_temp_cache_dir(self)
         self.vmx_path = vmapi._vmx_path(test_config.vm_name)
         self.assertTrue(self.vmx_path.isfile())
 
@@ -79,3 +90,396 @@ class TestVmxPath(unittest.TestCase):
                           vmapi._vmx_path(
                               path(test_config.vm_dir)
                               .joinpath(test_config.vm_name)))
+
+class TestBatchedCommands(unittest.TestCase):
+    """_run_command against a simulated guest."""
+
+    def setUp(self):
+        self.guest = FakeGuest()
+        self.vm = fake_vm(self.guest)
+
+    def test_run_script(self):
+        (out, err) = self.vm._run_command('echo hi')
+        self.assertEquals('hi\r\n', out)
+        self.assertEquals('', err)
+
+    def test_backend_calls(self):
+        self.vm._run_command('echo warm up')
+        (out, err) = self.vm._run_command('ipconfig | find "IP Address"')
+        self.assertIn(self.guest.ip_address, out)
+        self.assertEquals(3, self.vm.last_command_cost)
+        self.assertEquals(['runscriptinguest', 'copyfilefromguesttohost',
+                           'deletedirectoryinguest'], self.guest.calls[-3:])
+
+    def test_unbatched(self):
+        self.vm.batch_commands = False
+        (out, err) = self.vm._run_command('echo hi')
+        self.assertEquals('hi\r\n', out)
+        self.assertEquals(7, self.vm.last_command_cost)
+
+    def test_run_batch(self):
+        self.vm._run_command('echo warm up')
+        results = self.vm.run_batch([
+            'echo one',
+            'nosuchcommand',
+            vmapi.NoOutput(r'start C:\tcpr.exe C:\tcpr.ini -s'),
+            'echo two',
+        ])
+        self.assertEquals(3, self.vm.last_command_cost)
+        self.assertEquals(['one\r\n', '', '', 'two\r\n'],
+                          [r.stdout for r in results])
+        self.assertEquals([0, 9009, 0, 0], [r.returncode for r in results])
+        self.assertIn('not recognized', results[1].stderr)
+        self.assertRaises(vmapi.VmException, results[1].check)
+        self.assertTrue(any(r'C:\tcpr.ini -s' in p.cmd
+                            for p in self.vm.list_processes()))
+
+    def test_failure(self):
+        try:
+            self.vm._run_command('nosuchcommand')
+        except vmapi.VmException, e:
+            self.assertEquals(9009, e.returncode)
+            self.assertIn('not recognized', e.message)
+        else:
+            self.fail('VmException not raised')
+
+    def test_no_guest_files_left_behind(self):
+        before = set(self.guest.files), set(self.guest.dirs)
+        self.vm._run_command('echo hi')
+        self.vm._run_command('echo hi')
+        self.assertEquals(before, (set(self.guest.files),
+                                   set(self.guest.dirs)))
+
+class TestProcesses(unittest.TestCase):
+    """Starting and finding processes in a simulated guest."""
+
+    def setUp(self):
+        self.guest = FakeGuest()
+        self.vm = fake_vm(self.guest)
+
+    def test_spawn(self):
+        # A stale instance of the same program
+        stale = self.guest.add_process(r'C:\tcpr.exe C:\tcpr.ini -s')
+        pid = self.vm.spawn(r'C:\tcpr.exe C:\tcpr.ini -s')
+        self.assertNotEquals(stale, pid)
+        self.assertEquals(r'C:\tcpr.exe C:\tcpr.ini -s',
+                          self.guest.find_process(pid).cmd)
+        self.assertTrue(self.vm.is_running(pid))
+
+    def test_spawn_in_batch(self):
+        self.vm._run_command('echo warm up')
+        results = self.vm.run_batch([
+            'echo one', vmapi.Spawn(r'C:\tcpr.exe C:\tcpr.ini -s')])
+        self.assertEquals(3, self.vm.last_command_cost)
+        self.assertEquals('one\r\n', results[0].stdout)
+        self.assertIsNotNone(self.guest.find_process(results[1].pid))
+
+    def test_spawned_pid(self):
+        output = ('Executing (Win32_Process)->Create()\r\n'
+                  'Method execution successful.\r\n'
+                  'Out Parameters:\r\n'
+                  'instance of __PARAMETERS\r\n'
+                  '{\r\n'
+                  '        ProcessId = 2572;\r\n'
+                  '        ReturnValue = 0;\r\n'
+                  '};\r\n')
+        self.assertEquals(2572, vmapi._spawned_pid('x', output))
+        self.assertEquals(2572, vmapi._spawned_pid(
+            'x', '\xff\xfe' + output.decode('ascii').encode('utf-16-le')))
+        # The program wasn't found.
+        self.assertRaises(vmapi.VmException, vmapi._spawned_pid, 'x',
+                          '{\r\n        ReturnValue = 9;\r\n};\r\n')
+
+    def test_find_processes(self):
+        pid = self.guest.add_process(r'C:\tunnel\tcpr.exe tcpr.ini -s')
+        self.assertEquals([pid], [p.pid for p in self.vm.find_processes(
+            cmd_contains=r'C:\tunnel')])
+        [process] = self.vm.find_processes(pid=pid)
+        self.assertEquals(self.guest.find_process(pid), process)
+        self.assertEquals([], list(self.vm.find_processes(pid=pid + 1)))
+        # One listing for each query
+        self.assertEquals(3, self.guest.call_count('listProcessesInGuest'))
+
+    def test_wait(self):
+        pid = self.vm.spawn('notepad.exe')
+        self.assertRaises(DeadlineExceeded, self.vm.wait, pid, 0.05,
+                          Backoff(0.01))
+        self.vm.kill_process(pid)
+        self.vm.wait(pid, 1)
+        self.assertFalse(self.vm.is_running(pid))
+
+class _NoGuestAddress(FakeBackend):
+    """A vmrun too old to have getGuestIPAddress."""
+
+    def run(self, cmd_args):
+        if cmd_args[0] == 'getGuestIPAddress':
+            return (255, 'Error: Unrecognized command: %s' % cmd_args[0], '')
+        return FakeBackend.run(self, cmd_args)
+
+class TestGuestAddress(unittest.TestCase):
+
+    def setUp(self):
+        self.guest = FakeGuest()
+        self.temp_dir = path(tempfile.mkdtemp(prefix='vmreflect'))
+        self.vmx = self.temp_dir.joinpath('ie6.vmx')
+        self.vmx.write_bytes('displayName = "ie6"\n')
+        self.log = self.temp_dir.joinpath('vmware.log')
+        self.log.write_bytes('')
+        self.addresses_path = self.temp_dir.joinpath('addresses.json')
+        self.now = 1000.0
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def vm(self, backend=None):
+        """A VM, as a new vmreflect process would make it."""
+        return vmapi.VM(self.vmx, self.guest.username, self.guest.password,
+                        backend=backend or FakeBackend(self.guest),
+                        address_cache=AddressCache(self.addresses_path,
+                                                   clock=lambda: self.now))
+
+    def test_one_call(self):
+        vm = self.vm()
+        self.assertEquals(self.guest.ip_address, vm.guest_ip_address())
+        self.assertEquals(['getguestipaddress'], self.guest.calls)
+
+    def test_ipconfig(self):
+        vm = self.vm(_NoGuestAddress(self.guest))
+        self.assertEquals(self.guest.ip_address, vm.guest_ip_address())
+        self.assertIn('runscriptinguest', self.guest.calls)
+
+    def test_remembered(self):
+        self.vm().guest_ip_address()
+        self.guest.ip_address = '192.168.56.102'
+        self.assertEquals('192.168.56.101', self.vm().guest_ip_address())
+        self.assertEquals(1, len(self.guest.calls))
+        self.assertEquals('192.168.56.102',
+                          self.vm().guest_ip_address(refresh=True))
+
+        # Expired
+        self.guest.ip_address = '192.168.56.103'
+        self.now += addresses.DEFAULT_MAX_AGE
+        self.assertEquals('192.168.56.103', self.vm().guest_ip_address())
+
+        # Powered on again, which starts a new log
+        self.guest.ip_address = '192.168.56.104'
+        self.log.rename(self.temp_dir.joinpath('vmware-0.log'))
+        self.log.write_bytes('')
+        self.assertEquals('192.168.56.104', self.vm().guest_ip_address())
+
+        vm = self.vm()
+        vm.address_cache.forget(vm.vmx)
+        self.guest.ip_address = '192.168.56.105'
+        self.assertEquals('192.168.56.105', vm.guest_ip_address())
+
+    def test_no_log(self):
+        self.log.remove()
+        self.vm().guest_ip_address()
+        self.vm().guest_ip_address()
+        self.assertEquals(2, len(self.guest.calls))
+
+    def test_parse_ipconfig(self):
+        self.assertEquals(['192.168.56.101'],
+                          vmapi._parse_ipconfig(_IPCONFIG_XP))
+        self.assertEquals(['172.16.5.130', '192.168.100.128'],
+                          vmapi._parse_ipconfig(_IPCONFIG_WIN7))
+        self.assertEquals(['10.0.2.15'],
+                          vmapi._parse_ipconfig(_IPCONFIG_GERMAN))
+        self.assertEquals([], vmapi._parse_ipconfig(''))
+
+class TestBulkCopy(unittest.TestCase):
+
+    def setUp(self):
+        self.guest = FakeGuest()
+        self.vm = fake_vm(self.guest)
+        self.vm._temp_dir()
+        self.temp_dir = path(tempfile.mkdtemp(prefix='vmreflect'))
+        self.files = []
+        for (name, data) in [('socketclient.exe', 'MZ' + '\0' * 5000),
+                             ('fixture.txt', 'hello\r\n' * 100),
+                             ('empty.txt', '')]:
+            self.files.append(self.temp_dir.joinpath(name))
+            self.files[-1].write_bytes(data)
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def test_to_guest(self):
+        guest_dir = r'C:\fixtures'
+        self.guest.calls = []
+        self.assertEquals(['socketclient.exe', 'fixture.txt', 'empty.txt'],
+                          self.vm.copy_files_to_guest(self.files, guest_dir))
+        # Looking for a manifest, copying the cabinet, unpacking it
+        self.assertEquals(['copyfilefromguesttohost',
+                           'copyfilefromhosttoguest', 'runscriptinguest'],
+                          self.guest.calls)
+        for f in self.files:
+            self.assertEquals(f.bytes(), self.guest.read_file(
+                guest_dir + '\\' + f.basename()))
+        self.assertEquals([], self.guest._listdir(self.guest.temp_dir))
+
+        # Unchanged files aren't sent again.
+        self.guest.calls = []
+        self.assertEquals([], self.vm.copy_files_to_guest(self.files,
+                                                          guest_dir))
+        self.assertEquals(['copyfilefromguesttohost'], self.guest.calls)
+
+        self.files[1].write_bytes('changed')
+        self.assertEquals(['fixture.txt'], self.vm.copy_files_to_guest(
+            self.files, guest_dir))
+        self.assertEquals('changed', self.guest.read_file(
+            guest_dir + r'\fixture.txt'))
+        self.assertEquals([], self.vm.copy_files_to_guest(self.files[:1],
+                                                          guest_dir))
+
+    def test_duplicate_names(self):
+        other = self.temp_dir.joinpath('other')
+        other.mkdir()
+        other.joinpath('FIXTURE.TXT').write_bytes('')
+        self.assertRaises(ValueError, self.vm.copy_files_to_guest,
+                          self.files + [other.joinpath('FIXTURE.TXT')],
+                          r'C:\fixtures')
+
+    def test_from_guest(self):
+        logs = [r'C:\logs\app.log', r'C:\logs\old\app.1.log']
+        self.guest.make_dirs(r'C:\logs\old')
+        for (i, log) in enumerate(logs):
+            self.guest.write_file(log, 'line %d\r\n' % i * 1000)
+        host_dir = self.temp_dir.joinpath('logs')
+        self.guest.calls = []
+        host_paths = self.vm.copy_files_from_guest(logs, host_dir)
+        self.assertEquals(['runscriptinguest', 'copyfilefromguesttohost',
+                           'deletedirectoryinguest'], self.guest.calls)
+        self.assertEquals([host_dir.joinpath('app.log'),
+                           host_dir.joinpath('app.1.log')], host_paths)
+        for (log, host_path) in zip(logs, host_paths):
+            self.assertEquals(self.guest.read_file(log), host_path.bytes())
+        self.assertEquals([], self.guest._listdir(self.guest.temp_dir))
+
+    def test_from_guest_missing(self):
+        self.assertRaises(vmapi.VmException, self.vm.copy_files_from_guest,
+                          [r'C:\missing.log'], self.temp_dir)
+        self.assertEquals([], self.guest._listdir(self.guest.temp_dir))
+
+    def test_manifest(self):
+        manifest = {'a.txt': ('da39a3ee', 'A.txt'), 'b c': ('5ba93c9d', 'b c')}
+        self.assertEquals(manifest, vmapi._parse_manifest(
+            vmapi._format_manifest(manifest)))
+
+class TestStreaming(unittest.TestCase):
+
+    def setUp(self):
+        self.guest = FakeGuest()
+        self.guest.programs['job'] = self.job
+        self.vm = fake_vm(self.guest)
+        self.vm._temp_dir()
+        self.release = threading.Event()
+        self.output = 'progress\r\n' * 3
+
+    def tearDown(self):
+        self.release.set()
+        self.guest.wait_for_background()
+
+    def job(self, guest, argv, stdin):
+        # Writes some of its output straight away, and the rest when it is
+        # released.
+        [stream_dir] = [d for d in guest._listdir(guest.temp_dir)
+                        if d.startswith('vmreflect-')]
+        guest.write_file('%s\\%s\\out' % (guest.temp_dir, stream_dir),
+                         'started\r\n', append=True)
+        self.release.wait(5)
+        return (int(argv[1]), self.output, 'warning\r\n')
+
+    def test_lines(self):
+        stream = self.vm.stream_command('job 0', interval=0.01)
+        lines = stream.lines()
+        self.assertEquals(('stdout', 'started\r\n'), next(lines))
+        self.assertIsNone(stream.returncode)
+        self.assertTrue(self.guest.find_process(stream.pid))
+        self.release.set()
+        self.assertEquals([('stdout', 'progress\r\n')] * 3
+                          + [('stderr', 'warning\r\n')], list(lines))
+        self.assertEquals(0, stream.check().returncode)
+        self.assertEquals([], self.guest._listdir(self.guest.temp_dir))
+
+    def test_chunks(self):
+        self.release.set()
+        self.output = 'x' * 1000
+        with self.vm.stream_command('job 3', interval=0.01,
+                                    chunk_size=64) as stream:
+            chunks = [data for (name, data) in stream if name == 'stdout']
+        self.assertEquals('started\r\n' + self.output, ''.join(chunks))
+        self.assertEquals(64, max(len(c) for c in chunks))
+        self.assertEquals(3, stream.returncode)
+        self.assertRaises(vmapi.VmException, stream.check)
+
+    def test_close(self):
+        stream = self.vm.stream_command('job 0', interval=0.01)
+        self.assertEquals(('stdout', 'started\r\n'), next(iter(stream)))
+        pid = stream.pid
+        stream.close()
+        self.assertIsNone(self.guest.find_process(pid))
+        self.assertEquals([], self.guest._listdir(self.guest.temp_dir))
+        self.assertRaises(vmapi.VmException, stream.check)
+
+    def test_close_before_reading(self):
+        stream = self.vm.stream_command('job 0')
+        stream.close()
+        self.assertEquals([], [p for p in self.guest.processes
+                               if p.cmd.startswith('cmd')])
+
+_IPCONFIG_XP = """\r
+Windows IP Configuration\r
+\r
+\r
+Ethernet adapter Local Area Connection:\r
+\r
+        Connection-specific DNS Suffix  . : localdomain\r
+        IP Address. . . . . . . . . . . . : 192.168.56.101\r
+        Subnet Mask . . . . . . . . . . . : 255.255.255.0\r
+        Default Gateway . . . . . . . . . : 192.168.56.2\r
+"""
+
+_IPCONFIG_WIN7 = """\r
+Windows IP Configuration\r
+\r
+\r
+Ethernet adapter Local Area Connection 3:\r
+\r
+   Connection-specific DNS Suffix  . :\r
+   Autoconfiguration IPv4 Address. . : 169.254.12.7(Preferred)\r
+   Subnet Mask . . . . . . . . . . . : 255.255.0.0\r
+   Default Gateway . . . . . . . . . :\r
+\r
+Ethernet adapter Local Area Connection:\r
+\r
+   Connection-specific DNS Suffix  . : localdomain\r
+   Link-local IPv6 Address . . . . . : fe80::5d2c:8e1e:2fd4:c1b1%11\r
+   IPv4 Address. . . . . . . . . . . : 172.16.5.130\r
+   Subnet Mask . . . . . . . . . . . : 255.255.255.0\r
+   Default Gateway . . . . . . . . . : 172.16.5.2\r
+\r
+Ethernet adapter Local Area Connection 2:\r
+\r
+   Connection-specific DNS Suffix  . : localdomain\r
+   IPv4 Address. . . . . . . . . . . : 192.168.100.128\r
+   Subnet Mask . . . . . . . . . . . : 255.255.255.0\r
+   Default Gateway . . . . . . . . . :\r
+\r
+Tunnel adapter isatap.localdomain:\r
+\r
+   Media State . . . . . . . . . . . : Media disconnected\r
+   Connection-specific DNS Suffix  . : localdomain\r
+"""
+
+_IPCONFIG_GERMAN = """\r
+Windows-IP-Konfiguration\r
+\r
+\r
+Ethernet-Adapter LAN-Verbindung:\r
+\r
+   Verbindungsspezifisches DNS-Suffix:\r
+   IPv4-Adresse  . . . . . . . . . . : 10.0.2.15\r
+   Subnetzmaske  . . . . . . . . . . : 255.255.255.0\r
+   Standardgateway . . . . . . . . . : 10.0.2.2\r
+"""
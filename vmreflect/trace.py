@@ -0,0 +1,158 @@
+"""
+Tracing of where the time goes when setting up a tunnel.
+
+While a Tracer is installed with start(), every operation sent to a VM
+backend, every console exchange and every step of Tunnel.start is
+recorded as a Span. The hooks only check whether the module-level tracer
+is None, so they cost next to nothing when tracing is off.
+
+Spans can be saved as JSON lines, one object per span, or in the Chrome
+trace-event format, which chrome://tracing and Perfetto can display.
+
+Values passed to secret(), such as the passwords a tunnel makes up, and
+the argument after any -gp are replaced by *** in the recorded arguments.
+"""
+
+import json
+import os
+import threading
+import time
+from collections import namedtuple
+
+from path import path
+
+Span = namedtuple('Span',
+                  'name category start duration args returncode size error'
+                  ' thread')
+
+REDACTED = '***'
+
+tracer = None
+
+_secrets = set()
+
+# Operations whose bytes transferred are the size of a host file or
+# directory, and the index of that host path in their arguments.
+_HOST_PATH_ARGS = {
+    'copyfilefromhosttoguest': 2,
+    'copyfilefromguesttohost': 3,
+}
+
+def secret(value):
+    """Have value redacted from traces, and return it."""
+    if value:
+        _secrets.add(value)
+    return value
+
+def redact(arg):
+    arg = str(arg)
+    for value in _secrets:
+        if value in arg:
+            arg = arg.replace(value, REDACTED)
+    return arg
+
+def redact_args(args):
+    args = list(args)
+    redacted = []
+    for (i, arg) in enumerate(args):
+        if i > 0 and args[i - 1] == '-gp':
+            redacted.append(REDACTED)
+        else:
+            redacted.append(redact(arg))
+    return redacted
+
+def _host_size(host_path):
+    host_path = path(host_path)
+    if host_path.isfile():
+        return host_path.getsize()
+    if host_path.isdir():
+        return sum(f.getsize() for f in host_path.walkfiles())
+    return None
+
+def start(new_tracer=None):
+    """Install new_tracer, or a new Tracer, and return it."""
+    global tracer
+    tracer = new_tracer or Tracer()
+    return tracer
+
+def stop():
+    """Stop tracing and return the tracer that was installed."""
+    global tracer
+    (stopped, tracer) = (tracer, None)
+    return stopped
+
+class Tracer(object):
+
+    def __init__(self):
+        self.spans = []
+        self._lock = threading.Lock()
+
+    def add(self, name, category, start, duration, args=(), returncode=None,
+            size=None, error=None):
+        span = Span(name, category, start, duration, redact_args(args),
+                    returncode, size, error,
+                    threading.current_thread().name)
+        with self._lock:
+            self.spans.append(span)
+        return span
+
+    def operation(self, cmd_args, start, result=None, error=None):
+        """
+        Add a span for the vmrun-style cmd_args, started at start, that
+        returned result, a (returncode, stdout, stderr) tuple, or raised
+        error.
+        """
+        (returncode, size) = (None, None)
+        host_arg = _HOST_PATH_ARGS.get(cmd_args[0].lower())
+        if host_arg is not None and host_arg < len(cmd_args):
+            size = _host_size(cmd_args[host_arg])
+        if result is not None:
+            (returncode, stdout, stderr) = result
+            if host_arg is None:
+                size = len(stdout or '') + len(stderr or '')
+        return self.add(cmd_args[0], 'vmrun', start, time.time() - start,
+                        cmd_args[1:], returncode, size,
+                        error and redact(error))
+
+    def _sorted_spans(self):
+        with self._lock:
+            return sorted(self.spans, key=lambda s: s.start)
+
+    def write_json_lines(self, f):
+        for span in self._sorted_spans():
+            f.write(json.dumps(span._asdict(), sort_keys=True) + '\n')
+
+    def write_chrome(self, f):
+        spans = self._sorted_spans()
+        epoch = spans[0].start if spans else 0
+        pid = os.getpid()
+        thread_ids = {}
+        events = []
+        for span in spans:
+            if span.thread not in thread_ids:
+                thread_ids[span.thread] = len(thread_ids) + 1
+                events.append({'name': 'thread_name', 'ph': 'M',
+                               'pid': pid, 'tid': thread_ids[span.thread],
+                               'args': {'name': span.thread}})
+            args = {'args': span.args}
+            for field in ['returncode', 'size', 'error']:
+                if getattr(span, field) is not None:
+                    args[field] = getattr(span, field)
+            events.append({'name': span.name, 'cat': span.category,
+                           'ph': 'X', 'pid': pid,
+                           'tid': thread_ids[span.thread],
+                           'ts': int((span.start - epoch) * 1e6),
+                           'dur': int(span.duration * 1e6),
+                           'args': args})
+        json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
+
+    def save(self, filename):
+        """
+        Write the spans to filename, as JSON lines if it ends in .jsonl
+        and in the Chrome trace-event format otherwise.
+        """
+        with open(filename, 'w') as f:
+            if filename.endswith('.jsonl'):
+                self.write_json_lines(f)
+            else:
+                self.write_chrome(f)
@@ -0,0 +1,786 @@
+"""
+Setting up a tunnel: configures tcpr, copies all the files to the virtual
+machine, runs all the different processes, and cleans up the temporary
+files and processes afterwards.
+"""
+
+import os
+import shutil
+import signal
+import socket
+import sys
+import tempfile
+import threading
+import time
+import uuid
+
+from path import path
+
+from . import trace
+from .asyncvm import AsyncVM
+from .cache import Cache, file_sha1, link_or_copy
+from .console import Console, ConsoleError, listening_port
+from .health import HealthMonitor
+from .janitor import release_lease, take_lease, take_over_lease
+from .pipeline import Pipeline, StageTiming
+from .ports import (NETSTAT_COMMAND, SERVER_PORT_RANGE, allocate_ports,
+                    parse_netstat)
+from .relay import Forward, Relay
+from .retry import Backoff, DeadlineExceeded, NotReady, retry
+from .vmapi import VM, Spawn, VmException
+from .utils import format_ports, get_random_string, resource_path
+
+_TCPR_INI_TEMPLATE = """
+[server]
+
+# server
+listen=0.0.0.0:%(server_port)d
+
+# admin console
+listen_cmd=0.0.0.0:%(console_port)d
+
+listen_http=
+
+# The reflector will listen on the address and port range below. Every
+# forwarded port is started with a fixed port number, which tcpr only
+# allows above the second port and up to the third.
+reflector=0.0.0.0:%(reflector_start)d-%(reflector_start)d-%(reflector_end)d
+
+user_db=%(temp_dir)s\user_db
+
+# Send keep alive packets to every connected client at regular intervals.
+# Time is in seconds. 0 disables the sending of these packets.
+alive_interval=120
+
+# When no packets have been received for "alive_timeout" seconds, close
+# the connection. Clients can try to reconnect afterwards.
+# If set to 0 , the server will never close any connection.
+alive_timeout=300
+"""
+
+# How many times the server is started before giving up on finding free
+# ports for it
+_PORT_ATTEMPTS = 3
+
+class Tunnel(object):
+
+    def __init__(self, vm_name, port, username, password, vm=None,
+                 max_workers=4, verbose=False, cache=None,
+                 guest_install_dir=None, port_range=None, ready_timeout=60,
+                 backoff=None, health_interval=None):
+        """
+        vm, if given, is used instead of connecting to vm_name, and cache
+        instead of the default host cache for tcpr.exe. Up to
+        max_workers setup steps are run at once, and if verbose is set, how
+        long each one took is printed once the tunnel is open. vm can be
+        an asyncvm.AsyncVM, whose limits then apply to the setup steps.
+        Any number of tunnels, and other guest operations, can share one
+        vm and its backend connection, at the same time or one after
+        another. Closing a tunnel leaves vm open.
+
+        If guest_install_dir is set, tcpr.exe is kept there between
+        tunnels instead of being copied into the guest every time.
+
+        port can be a single port number or a list of them. All of the
+        ports are forwarded through one server in the guest. More ports
+        can be forwarded with add_ports() while the tunnel is open, if
+        they are in port_range, a (first, last) pair that defaults to
+        the span of port.
+
+        Once the server in the guest is started, connecting to it and
+        starting the forwards are retried with backoff, a retry.Backoff,
+        for up to ready_timeout seconds. time_to_ready is how long open()
+        took to open the tunnel.
+
+        The server listens on two adjacent ports, server_port and
+        console_port, chosen in server_port_range once the tunnel is being
+        opened, so that they are free in the guest and not used by any
+        other tunnel to the same VM.
+
+        If health_interval is set, once the tunnel is open it is probed
+        every health_interval seconds by a health.HealthMonitor, health,
+        which repairs whatever part of it has broken. Losing the
+        connection to the guest then no longer closes the tunnel.
+        """
+        if isinstance(port, (int, long)):
+            port = [port]
+        self.forward_ports = list(port)
+        if not self.forward_ports:
+            raise ValueError('no ports to forward')
+        if port_range is None:
+            port_range = (min(self.forward_ports), max(self.forward_ports))
+        self.port_range = (min([port_range[0]] + self.forward_ports),
+                           max([port_range[1]] + self.forward_ports))
+        self.server_port_range = SERVER_PORT_RANGE
+        self.server_port = self.console_port = None
+        if isinstance(vm, AsyncVM):
+            # The setup steps already overlap on the pipeline's threads,
+            # and the AsyncVM's limits are installed on its VM.
+            vm = vm.vm
+        self.cache = cache or Cache()
+        if vm is None:
+            vm = VM(vm_name=vm_name, username=username, password=password,
+                    lease_directory=self.cache.directory)
+        self.vmapi = vm
+        self.manager_password = trace.secret(get_random_string())
+        self.max_workers = max_workers
+        self.verbose = verbose
+        self.guest_install_dir = guest_install_dir
+        self.ready_timeout = ready_timeout
+        self.backoff = backoff or Backoff()
+        self.health_interval = health_interval
+        self.health = None
+        self.timings = []
+        self.time_to_ready = None
+        self.is_open = False
+        self.open_ports = []
+        self.relays = []
+        self._cleanups = []
+        self._forward_ids = {}
+        self._forward_count = 0
+        self._relay_threads = {}
+        # Relays closed by a repair, whose ending doesn't stop the tunnel
+        self._replaced_relays = set()
+        self._relays_connected = 0
+        self.console = None
+        self._lease = None
+        self._port_lease = None
+        self._start_time = None
+        self._lock = threading.RLock()
+        self._stopped = threading.Event()
+
+    def open(self):
+        """
+        Set up the tunnel, and return as soon as it is open. Returns the
+        tunnel, which closes itself at the end of a with statement:
+
+            with Tunnel(...).open() as tunnel:
+                ...
+
+        If setting it up fails, whatever was done in the guest is undone
+        before the exception is raised. A tunnel can be opened again once
+        it has been closed.
+        """
+        with self._lock:
+            if self.is_open:
+                raise Exception('the tunnel is already open')
+            self.is_open = True
+        start_time = self._start_time = time.time()
+        self._stopped.clear()
+        self._cleanups = []
+        self.open_ports = []
+        self.relays = []
+        self._forward_ids = {}
+        self._forward_count = 0
+        self._relay_threads = {}
+        # Relays closed by a repair, whose ending doesn't stop the tunnel
+        self._replaced_relays = set()
+        self._relays_connected = 0
+        try:
+            # Steps 1 and 2.
+            self._bring_up()
+            deadline = time.time() + self.ready_timeout
+
+            # Step 4. Connect to the console
+            try:
+                self._timed('console', start_time,
+                            lambda: self._connect_console(deadline))
+            except DeadlineExceeded:
+                # The address may have been remembered from before the
+                # guest's network changed.
+                self.vmapi.address_cache.forget(self.vmapi.vmx)
+                raise
+
+            # Step 5. Add a client.
+            self._timed('client', start_time, lambda: self.console.add_client(
+                self.client_name, self.client_password))
+
+            # Steps 6 and 7. Connect the client and start forwarding.
+            self._timed('forwards', start_time, lambda: self.add_ports(
+                self.forward_ports, deadline))
+        except:
+            exc_info = sys.exc_info()
+            try:
+                self._close()
+            finally:
+                raise exc_info[0], exc_info[1], exc_info[2]
+
+        self.time_to_ready = time.time() - start_time
+        if trace.tracer is not None:
+            trace.tracer.add('ready', 'tunnel', start_time,
+                             self.time_to_ready, self.open_ports)
+        if self.verbose:
+            self._print_timings(self.time_to_ready)
+        if self.health_interval:
+            self.health = HealthMonitor(self, self.health_interval)
+            self.health.start()
+        return self
+
+    def wait(self, timeout=None):
+        """
+        Wait until stop() is called or the connection to the guest is
+        lost, or for at most timeout seconds. Returns whether the tunnel
+        stopped.
+        """
+        if timeout is not None:
+            self._stopped.wait(timeout)
+        else:
+            # With a timeout, so that ^C still works
+            while not self._stopped.is_set():
+                self._stopped.wait(1)
+        return self._stopped.is_set()
+
+    def close(self, detach=False):
+        """
+        Close the tunnel, if it is open, and clean up the guest. If detach
+        is true, close() returns as soon as the connections to the guest
+        are closed, and a child process cleans up the guest.
+        """
+        with self._lock:
+            if not self.is_open:
+                return
+        self._close(detach)
+
+    def _close(self, detach=False):
+        self._stopped.set()
+        if self.health is not None:
+            self.health.stop()
+            self.health = None
+        try:
+            self._timed('tear_down', self._start_time,
+                        self._detach if detach else self._tear_down)
+        finally:
+            self.is_open = False
+
+    def __enter__(self):
+        if not self.is_open:
+            self.open()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def start(self, started_event=None, done_event=None, detach=False):
+        """
+        Set up the tunnel. Does not return until the tunnel is closed,
+        with close(detach).
+
+        started_event.set() is called when the tunnel is ready. Then,
+        done_event.wait() is called, unless it is None, in which case the
+        code waits until stop() is called or the connection to the guest
+        is lost. open() is the same without the waiting.
+        """
+        self.open()
+        try:
+            if started_event:
+                started_event.set()
+            print 'The tunnel is now open on %s.' % (
+                format_ports(self.open_ports),),
+            print 'Press ^C to close it.'
+
+            # Wait until the calling code is done with the
+            # tunnel, or the connection is lost.
+            if done_event:
+                done_event.wait()
+            else:
+                self.wait()
+        finally:
+            self.close(detach)
+
+    def stop(self):
+        """Make start() close the tunnel and return, and wait() return."""
+        self._stopped.set()
+
+    def add_ports(self, ports, deadline=None):
+        """
+        Start forwarding ports, which must be in self.port_range, and
+        return the ones that weren't already open. Ports that have never
+        been forwarded are registered through a new client connection, so
+        that the connections already open aren't disturbed.
+
+        Gives up at deadline, by default ready_timeout seconds from now.
+        """
+        if deadline is None:
+            deadline = time.time() + self.ready_timeout
+        with self._lock:
+            ports = [p for p in ports if p not in self.open_ports]
+            for port in ports:
+                if not self.port_range[0] <= port <= self.port_range[1]:
+                    raise ValueError('port %d is not in the range %d-%d'
+                                     % ((port,) + self.port_range))
+            new_ports = [p for p in ports if p not in self._forward_ids]
+            if new_ports:
+                self._connect_relay(new_ports, deadline)
+            self._start_forwards([(self._forward_ids[p], p) for p in ports],
+                                 deadline)
+            self.open_ports.extend(ports)
+            return ports
+
+    def remove_ports(self, ports):
+        """Stop forwarding ports. Connections already open are kept."""
+        with self._lock:
+            for port in ports:
+                if port not in self.open_ports:
+                    raise ValueError('port %d is not forwarded' % port)
+            for port in ports:
+                self.console.stop(self._forward_ids[port])
+                self.open_ports.remove(port)
+
+    def _connect_relay(self, ports, deadline):
+        # Step 6. Connect the client. The server won't take a second
+        # connection from the same node, so later ones get their own id.
+        node_id = None
+        if self._relays_connected:
+            node_id = '%012X.%d' % (uuid.getnode(), self._relays_connected)
+        relay = Relay(
+            (self.server_ip, self.server_port),
+            self.client_name, self.client_password,
+            self._forwards(ports), node_id=node_id)
+        retry(relay.connect, deadline, (socket.error, EOFError),
+              self.backoff)
+        relay_thread = threading.Thread(target=self._run_relay,
+                                        args=(relay,))
+        relay_thread.daemon = True
+        relay_thread.start()
+        self._cleanups.append(lambda: self._close_relay(relay, relay_thread))
+        self.relays.append(relay)
+        self._relay_threads[relay] = relay_thread
+        self._relays_connected += 1
+
+        # The server numbers forwards in the order they are registered,
+        # and never reuses the numbers.
+        for port in ports:
+            self._forward_ids[port] = self._forward_count
+            self._forward_count += 1
+
+    def _start_forwards(self, pending, deadline):
+        # Step 7. Start forwarding. Until the server has read the forwards
+        # from the client, it doesn't know their ids, so retry those.
+        def attempt():
+            replies = self.console.start_many(pending)
+            again = []
+            for ((forward_id, port), reply) in zip(pending, replies):
+                listening = listening_port(reply)
+                if listening is None:
+                    again.append((forward_id, port))
+                    error = ' '.join(reply.lines)
+                elif listening != port:
+                    # tcpr falls back to any free port if the one asked
+                    # for is taken.
+                    self.console.stop(forward_id)
+                    raise Exception('port %d is already in use in the guest'
+                                    % port)
+            pending[:] = again
+            if pending:
+                raise NotReady('could not forward %s: %s'
+                               % (format_ports(p for (_, p) in pending),
+                                  error))
+        pending = list(pending)
+        print 'Waiting for tunnel to open.'
+        retry(attempt, deadline, backoff=self.backoff)
+
+    def _run_relay(self, relay):
+        try:
+            relay.run()
+        except Exception, e:
+            if relay in self._replaced_relays:
+                return
+            print >>sys.stderr, 'Connection to the guest lost: %s' % e
+            if self.health is not None:
+                # It reconnects the relay.
+                self.health.wake()
+                return
+        if relay not in self._replaced_relays:
+            self._stopped.set()
+
+    def _close_relay(self, relay, relay_thread):
+        relay.close()
+        relay_thread.join()
+
+    def _dead_relays(self):
+        return [r for r in self.relays
+                if not self._relay_threads[r].is_alive()]
+
+    def _connect_console(self, deadline):
+        console = Console((self.server_ip, self.console_port), 'manager',
+                          self.manager_password)
+        retry(console.connect, deadline, (socket.error, EOFError),
+              self.backoff)
+        self.console = console
+        self._cleanups.append(console.close)
+
+    def _repair(self):
+        """
+        Set up again whatever part of the open tunnel has broken, keeping
+        the rest, and return the names of the parts: 'server', 'console',
+        'relay' or 'forwards'.
+        """
+        with self._lock:
+            deadline = time.time() + self.ready_timeout
+            repaired = []
+            try:
+                self.console.list()
+            except (socket.error, EOFError, ConsoleError):
+                self.console.close()
+                try:
+                    # A running server answers the first attempt.
+                    self._connect_console(time.time())
+                except DeadlineExceeded, e:
+                    if self.vmapi.is_running(self.server_pid):
+                        raise Exception('the server in the guest is running'
+                                        ' but its console is unreachable: %s'
+                                        % e)
+                    self._restart_server(deadline)
+                    return ['server']
+                repaired.append('console')
+            if self._reconnect_relays(deadline):
+                repaired.append('relay')
+            if self._restart_forwards(deadline):
+                repaired.append('forwards')
+            return repaired
+
+    def _reconnect_relays(self, deadline):
+        """
+        Connect a new relay in place of each one that lost its connection
+        to the server, and forward its ports again. Returns whether there
+        were any.
+        """
+        dead = self._dead_relays()
+        ports = []
+        old_ids = []
+        for relay in dead:
+            self.relays.remove(relay)
+            for forward in relay.forwards:
+                old_ids.append(self._forward_ids.pop(forward.port))
+                if forward.port in self.open_ports:
+                    self.open_ports.remove(forward.port)
+                    ports.append(forward.port)
+        if old_ids:
+            # In case the server keeps them listening for the client to
+            # come back, which would stop the new ones taking the ports
+            self.console.run(['stop %d' % i for i in old_ids])
+        if ports:
+            self.add_ports(ports, deadline)
+        return bool(dead)
+
+    def _restart_forwards(self, deadline):
+        """
+        Start the forwards of open ports again that the server no longer
+        lists as listening. Returns whether there were any.
+        """
+        listening = set(forward.id for reflector in self.console.list()
+                        for forward in reflector.forwards
+                        if forward.port is not None)
+        stopped = [(self._forward_ids[port], port) for port in self.open_ports
+                   if self._forward_ids[port] not in listening]
+        if stopped:
+            self._start_forwards(stopped, deadline)
+        return bool(stopped)
+
+    def _restart_server(self, deadline):
+        # The server's clients and forwards went with it, but its files
+        # are still in the guest.
+        for relay in self.relays:
+            self._replaced_relays.add(relay)
+            self._close_relay(relay, self._relay_threads.pop(relay))
+        self.relays = []
+        self._forward_ids = {}
+        self._forward_count = 0
+        # Another process may have taken its ports while it was down.
+        self._check_server(self._run_server())
+        self._connect_console(deadline)
+        self.console.add_client(self.client_name, self.client_password)
+        (ports, self.open_ports) = (self.open_ports, [])
+        self.add_ports(ports, deadline)
+
+    def _bring_up(self):
+        """
+        Copy tcpr to the guest and start the server there. Steps that don't
+        depend on each other run at the same time, and each step that
+        leaves something behind adds a function to undo it to
+        self._cleanups.
+        """
+
+        self.host_temp_dir = path(tempfile.mkdtemp(prefix='vmreflect'))
+        self._cleanups.append(lambda: shutil.rmtree(self.host_temp_dir))
+        self._server_started = False
+        self._server_stopped = threading.Event()
+        self.server_pid = None
+        self._lease = None
+        self._port_lease = None
+
+        pipeline = Pipeline(max_workers=self.max_workers)
+        pipeline.add('extract', self._extract_tcpr)
+        pipeline.add('guest_temp', self._create_guest_temp_dir)
+        pipeline.add('guest_ip', self._find_guest_ip)
+        # Step 1. Create the .ini file.
+        pipeline.add('ini', self._create_ini_file, requires=['guest_temp'])
+        if self.guest_install_dir:
+            pipeline.add('install', self._install_tcpr, requires=['extract'])
+            pipeline.add('copy', self._copy_to_guest, requires=['ini'])
+            server_requires = ['copy', 'install']
+        else:
+            pipeline.add('copy', self._copy_to_guest,
+                         requires=['extract', 'ini'])
+            server_requires = ['copy']
+        # Step 2. Create a manager password and start the server.
+        pipeline.add('server', self._start_server, requires=server_requires)
+        try:
+            pipeline.run()
+        finally:
+            self.timings = pipeline.timings
+
+    def _tear_down(self):
+        """
+        Run the functions in self._cleanups, all at once, since each one
+        waits for anything it depends on itself. A cleanup that fails
+        doesn't stop the others. Once they have all finished, the lease on
+        the guest's files is released, so that vmreflect gc removes
+        whatever they failed to.
+        """
+        (cleanups, self._cleanups) = (self._cleanups, [])
+        pipeline = Pipeline(max_workers=max(1, len(cleanups)),
+                            keep_going=True)
+        for (i, cleanup) in enumerate(cleanups):
+            pipeline.add('cleanup%d' % i, cleanup)
+        try:
+            pipeline.run()
+        except KeyboardInterrupt:
+            print >>sys.stderr, ('Cleanup interrupted. vmreflect gc will'
+                                 ' remove what was left in the guest.')
+            raise
+        finally:
+            for lease in [self._lease, self._port_lease]:
+                if lease is not None:
+                    release_lease(lease)
+            self._lease = self._port_lease = None
+        for (name, exc_info) in pipeline.errors:
+            print >>sys.stderr, 'Cleanup failed: %s' % exc_info[1]
+
+    def _detach(self):
+        """
+        Close the connections to the guest, then leave the leases and the
+        rest of the cleanups to a background process.
+        """
+        for (relay, relay_thread) in self._relay_threads.items():
+            self._close_relay(relay, relay_thread)
+        if self.console is not None:
+            self.console.close()
+        (ready_r, ready_w) = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            # Forked again, so that nothing has to wait for the process
+            # that cleans up
+            try:
+                if os.fork() == 0:
+                    self._clean_up_detached(ready_r, ready_w)
+            finally:
+                os._exit(0)
+        os.close(ready_w)
+        os.waitpid(pid, 0)
+        # Until the background process holds the leases, vmreflect gc
+        # would take what they name for leftovers once this one exits.
+        os.read(ready_r, 1)
+        os.close(ready_r)
+        self._cleanups = []
+        self._lease = self._port_lease = None
+
+    def _clean_up_detached(self, ready_r, ready_w):
+        try:
+            # A second ^C in the terminal shouldn't interrupt it.
+            signal.signal(signal.SIGINT, signal.SIG_IGN)
+            os.close(ready_r)
+            for lease in [self._lease, self._port_lease]:
+                if lease is not None:
+                    take_over_lease(lease)
+            os.close(ready_w)
+            self._tear_down()
+        except Exception, e:
+            print >>sys.stderr, 'Cleanup failed: %s' % e
+        finally:
+            os._exit(0)
+
+    def _timed(self, name, start_time, func):
+        """Call func, adding how long it took to timings."""
+        stage_start = time.time()
+        try:
+            return func()
+        finally:
+            duration = time.time() - stage_start
+            self.timings.append(StageTiming(name, stage_start - start_time,
+                                            duration))
+            if trace.tracer is not None:
+                trace.tracer.add(name, 'tunnel', stage_start, duration)
+
+    def _print_timings(self, total):
+        for timing in sorted(self.timings, key=lambda t: t.start):
+            print '%-12s started at %6.3fs, took %6.3fs' % timing
+        print 'Tunnel opened in %.3fs' % total
+
+    def _extract_tcpr(self):
+        self.local_tcpr_exe = self.cache.extract(
+            resource_path('lib-win32/TcpProxyReflector-0.1.3-win32.zip'),
+            'TcpProxyReflector-0.1.3/tcpr.exe')
+        if not self.guest_install_dir:
+            link_or_copy(self.local_tcpr_exe,
+                         self.host_temp_dir.joinpath('tcpr.exe'))
+
+    def _install_tcpr(self):
+        """
+        Make sure tcpr.exe is in the guest install directory, under a name
+        containing its hash, copying it over only if it isn't there yet.
+        """
+        install_dir = self.guest_install_dir.rstrip('\\')
+        installed = '%s\\tcpr-%s.exe' % (
+            install_dir, file_sha1(self.local_tcpr_exe)[:16])
+        if not self.vmapi.file_exists(installed):
+            try:
+                self.vmapi.create_directory(install_dir)
+            except VmException:
+                # Already exists
+                pass
+            # Copy under a temporary name so that an interrupted copy is
+            # never mistaken for an installed tcpr.exe.
+            partial = '%s.%s' % (installed, get_random_string(length=8))
+            self.vmapi.copy_file_to_guest(self.local_tcpr_exe, partial)
+            try:
+                self.vmapi.rename_file(partial, installed)
+            except VmException:
+                self.vmapi.delete_file(partial)
+                # Another tunnel may have installed it in the meantime.
+                if not self.vmapi.file_exists(installed):
+                    raise
+        self.remote_tcpr_cmd = installed
+
+    def _create_guest_temp_dir(self):
+        guest_temp_file_base = self.vmapi._create_temp_file()
+        self._cleanups.append(
+            lambda: self.vmapi.delete_file(guest_temp_file_base))
+        self.guest_temp_dir = guest_temp_file_base + '.d'
+        self._lease = take_lease(self.vmapi.vmx,
+                                 [guest_temp_file_base, self.guest_temp_dir],
+                                 self.cache.directory)
+        if not self.guest_install_dir:
+            self.remote_tcpr_cmd = self.guest_temp_dir + '\\' + 'tcpr.exe'
+        self.remote_tcpr_ini = self.guest_temp_dir + '\\' + 'tcpr.ini'
+
+    def _find_guest_ip(self):
+        self.server_ip = self.vmapi.guest_ip_address()
+
+    def _copy_to_guest(self):
+        self.vmapi.copy_file_to_guest(self.host_temp_dir, self.guest_temp_dir)
+        self._cleanups.append(self._delete_guest_dir)
+
+    def _delete_guest_dir(self):
+        if self._server_started:
+            # The server has its .ini file open, and maybe tcpr.exe.
+            self._server_stopped.wait(self.ready_timeout)
+        self.vmapi.delete_directory(self.guest_temp_dir)
+
+    def _start_server(self):
+        results = self._run_server()
+        self._server_started = True
+        self._cleanups.append(self._kill_server)
+        self._check_server(results)
+
+    def _check_server(self, results):
+        """
+        Check the server that _run_server() started, with those results.
+        If something else was listening on its ports, kill it, choose new
+        ports and start it again, up to _PORT_ATTEMPTS times.
+        """
+        for attempt in range(_PORT_ATTEMPTS):
+            for result in results[1:]:
+                result.check()
+            self.server_pid = results[-1].pid
+            # What was listening just before the server started
+            listening = parse_netstat(results[0].stdout)
+            self.vmapi.listening_ports = listening
+            in_use = sorted(listening.intersection([self.server_port,
+                                                    self.console_port]))
+            if not in_use:
+                return
+            # Taken since netstat was last run in this VM
+            try:
+                self.vmapi.kill_process(self.server_pid)
+            except VmException:
+                # It couldn't listen, and has exited.
+                pass
+            if attempt == _PORT_ATTEMPTS - 1:
+                break
+            # Choose again, and start the server again with the new .ini
+            # file.
+            self._choose_ports(listening)
+            self._write_ini_file()
+            self.vmapi.copy_file_to_guest(self.local_tcpr_ini,
+                                          self.remote_tcpr_ini)
+            results = self._run_server()
+        # The last server has been killed already.
+        if self._kill_server in self._cleanups:
+            self._cleanups.remove(self._kill_server)
+        self.server_pid = None
+        self._server_stopped.set()
+        raise Exception('%s already in use in the guest'
+                        % ' and '.join('port %d' % port for port in in_use))
+
+    def _run_server(self):
+        # netstat's output is taken before the server starts listening.
+        return self.vmapi.run_batch([
+            NETSTAT_COMMAND,
+            '%s %s -m %s' % (self.remote_tcpr_cmd, self.remote_tcpr_ini,
+                             self.manager_password),
+            Spawn('%s %s -s' % (self.remote_tcpr_cmd, self.remote_tcpr_ini)),
+        ])
+
+    def _find_server_pid(self):
+        # With a guest install directory, other tunnels' servers run the
+        # same tcpr.exe, but each has its own .ini file.
+        for p in self.vmapi.find_processes(cmd_contains=self.remote_tcpr_ini):
+            self.server_pid = p.pid
+            break
+        else:
+            raise Exception('server pid not found')
+
+    def _kill_server(self):
+        try:
+            if self.server_pid is None:
+                self._find_server_pid()
+            self.vmapi.kill_process(self.server_pid)
+        finally:
+            self._server_stopped.set()
+
+    def _forwards(self, ports):
+        return [Forward('forward%d' % port, 'forward%d' % port,
+                        '127.0.0.1', port)
+                for port in ports]
+
+    def _create_ini_file(self):
+        self.client_name = 'tcprclient'
+        self.client_password = trace.secret(get_random_string())
+
+        self.local_tcpr_ini = self.host_temp_dir.joinpath('tcpr.ini')
+        self._choose_ports(self.vmapi.listening_ports or ())
+        self._write_ini_file()
+
+    def _choose_ports(self, exclude):
+        # Not the reflector's ports either
+        exclude = (set(exclude) | set(self.forward_ports)
+                   | set([self.port_range[0] - 1]))
+        (ports, lease) = allocate_ports(self.vmapi.vmx, 2, exclude,
+                                        self.server_port_range,
+                                        self.cache.directory)
+        if self._port_lease is not None:
+            release_lease(self._port_lease)
+        self._port_lease = lease
+        (self.server_port, self.console_port) = ports
+
+    def _write_ini_file(self):
+        with open(self.local_tcpr_ini, 'w') as out:
+            out.write(_TCPR_INI_TEMPLATE % {
+                'server_port': self.server_port,
+                'console_port': self.console_port,
+                'reflector_start': self.port_range[0] - 1,
+                'reflector_end': self.port_range[1],
+                'temp_dir': self.guest_temp_dir,
+            })
+
@@ -1,3 +1,4 @@
+import os
 import random
 import string
 
@@ -5,3 +6,42 @@ sysrandom = random.SystemRandom()
 
 def get_random_string(length=20, alphabet=string.letters + string.digits):
     return ''.join(sysrandom.choice(alphabet) for x in range(length))
+
+def parse_ports(spec):
+    """
+    Parse a comma-separated list of ports and ranges, such as
+    '3000,8000-8002', into a list of port numbers in the given order with
+    duplicates removed.
+    """
+    ports = []
+    seen = set()
+    for part in spec.split(','):
+        part = part.strip()
+        try:
+            if '-' in part:
+                (first, last) = [int(p) for p in part.split('-', 1)]
+            else:
+                first = last = int(part)
+        except ValueError:
+            raise ValueError('bad port %r' % part)
+        if not 0 < first <= last < 65536:
+            raise ValueError('bad port range %r' % part)
+        for port in range(first, last + 1):
+            if port not in seen:
+                seen.add(port)
+                ports.append(port)
+    return ports
+
+def format_ports(ports):
+    ports = list(ports)
+    if len(ports) == 1:
+        return 'port %d' % ports[0]
+    return 'ports %s' % ', '.join(str(p) for p in ports)
+
+def resource_path(name):
+    """
+    Return the filename of name, a /-separated path to a file installed
+    with the package. Unlike pkg_resources, this takes no time to import.
+    """
+    return os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                        *name.split('/'))
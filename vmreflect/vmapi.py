@@ -4,14 +4,20 @@
 Rough API for controlling virtual machines by calling vmrun.
 
 Methods that could be rewritten to use a smarter strategy are underscored.
-For example, instead of retrieving stdout and stderr files individually,
-they could be written to a single directory and then the directory could be
+For example, _run_command used to retrieve stdout and stderr files
+individually; by default it now writes them to a single directory that is
 copied over in one shot.
 
-It is too slow because for every single request it forks a new process,
-connects to the VM server, and authenticates the user.
+Calling vmrun directly is too slow because for every single request it
+forks a new process, connects to the VM server, and authenticates the user.
+So every operation goes through a backend object instead. VmrunBackend
+still forks vmrun each time. vmreflect.session provides a backend that
+keeps one connection open to a long-lived session daemon, but the daemon
+forks vmrun too, so that is only faster once the daemon has a backend of
+its own that isn't.
 
-It should be rewritten to use VIX, which is all in-process:
+The daemon should eventually be rewritten to use VIX, which is all
+in-process:
 <http://www.vmware.com/support/developer/vix-api/vix112_reference/>
 """
 
@@ -19,29 +25,47 @@ import argparse
 import glob
 import os
 import re
+import shutil
+import socket
 import subprocess
 import sys
 import tempfile
+import threading
 import time
 from collections import namedtuple
 
 from path import path
 
+from . import cab, trace
+from .addresses import AddressCache, default_addresses_path
+from .cache import file_sha1
+from .janitor import release_lease, take_lease
+from .library import default_library
+from .retry import NotReady, retry
+from .utils import get_random_string
+
 _VMRUN = os.getenv(
     'VMRUN', '/Applications/VMware Fusion.app/Contents/Library/vmrun')
 
 def _vmx_path(vm_name):
     """Return the path to the .vmx file corresponding to vm_name.
 
-    vm_name may be the name of a virtual machine, or the path to a virtual
-    machine folder or .vmx file.
+    vm_name may be the name of a virtual machine, as VMware shows it or as
+    its folder is named, or the path to a virtual machine folder or .vmx
+    file. Names are looked up in the VM library index.
+
+    The path is absolute, with symlinks resolved, so that however a VM is
+    named it gets the same path, which janitor's leases are kept under.
     """
+    return path(os.path.realpath(_find_vmx(vm_name)))
+
+def _find_vmx(vm_name):
     if vm_name.lower().endswith('.vmx') and os.path.isfile(vm_name):
         return path(vm_name)
-    likely = (path("~/Virtual Machines.localized/").expanduser()
-                .joinpath('%s.vmwarevm/%s.vmx' % (vm_name, vm_name)))
-    if likely.isfile():
-        return likely
+    if not os.path.isdir(vm_name):
+        vmx = default_library().find(vm_name)
+        if vmx is not None:
+            return vmx
     basename = path(vm_name).basename().namebase
     for suffix_glob in ['/%s.vmx' % basename,
                         '.vmwarevm/%s.vmx' % basename,
@@ -68,15 +92,259 @@ class VmException(Exception):
 
 GuestProcess = namedtuple('GuestProcess', 'pid owner cmd')
 
+class CommandResult(namedtuple('CommandResult',
+                               'command stdout stderr returncode')):
+    """The output and exit code of one command run by VM.run_batch."""
+
+    def check(self):
+        """Raise VmException if the command failed, else return self."""
+        if self.returncode:
+            raise VmException(self.returncode,
+                              'command %r exited with code %d\n'
+                              % (self.command, self.returncode)
+                              + 'stdout:\n' + self.stdout + '\n'
+                              + 'stderr:\n' + self.stderr)
+        return self
+
+    @property
+    def pid(self):
+        """The pid of the process a Spawn command started."""
+        return _spawned_pid(self.command, self.stdout)
+
+class NoOutput(str):
+    """
+    A command for VM.run_batch whose output is discarded, not collected.
+
+    Use it for commands like start that leave a program running in the
+    guest, which would otherwise inherit, and hold open, the files that
+    collect the output.
+    """
+
+class Spawn(str):
+    """
+    A command for VM.run_batch that starts program, a command line, in the
+    guest without waiting for it, in directory if given. The pid attribute
+    of its CommandResult is the new process's pid.
+
+    The program is started with WMI, so it isn't a child of the batch and
+    doesn't inherit the files that collect the batch's output. Unlike
+    start, that gives the pid straight away.
+    """
+
+    def __new__(cls, program, directory=None):
+        args = '"%s"' % program.replace('"', '\\"')
+        if directory is not None:
+            args += ',"%s"' % directory
+        # wmic waits for input that never comes unless stdin is nul.
+        command = str.__new__(cls, 'wmic process call create %s <nul' % args)
+        command.program = program
+        return command
+
+_re_spawned = re.compile(r'^\s*(ProcessId|ReturnValue) = (\d+);', re.M)
+
+def _spawned_pid(command, output):
+    # Redirected, wmic may write UTF-16.
+    if output.startswith('\xff\xfe') or '\0' in output:
+        output = output.decode('utf-16').encode('ascii', 'replace')
+    values = dict(_re_spawned.findall(output))
+    if values.get('ReturnValue') != '0' or 'ProcessId' not in values:
+        raise VmException(None, 'command %r did not start a process:\n%s'
+                          % (command, output))
+    return int(values['ProcessId'])
+
+class CommandStream(object):
+    """
+    The output of a command started by VM.stream_command, as the command
+    produces it.
+
+    Iterating over the stream yields (name, data) pairs, where name is
+    'stdout' or 'stderr' and data is the next piece of that output, no
+    longer than chunk_size bytes. lines() yields (name, line) pairs
+    instead. Once either is exhausted, returncode is the command's exit
+    code, and check() raises VmException if it failed.
+
+    The command's output is redirected to files in a guest directory,
+    which are copied back every interval seconds, and only the new part
+    is read. Memory use doesn't grow with the output, but every copy is
+    of all the output so far.
+
+    close() stops following the output. If the command is still running,
+    it is killed, and either way its guest directory is deleted.
+    """
+
+    def __init__(self, vm, command, interval=1.0, chunk_size=64 * 1024,
+                 sleep=time.sleep):
+        self.vm = vm
+        self.command = command
+        self.interval = interval
+        self.chunk_size = chunk_size
+        self.sleep = sleep
+        self.pid = None
+        self.returncode = None
+        (self.guest_dir, self._lease) = vm._new_guest_dir()
+        self._host_temp_dir = path(tempfile.mkdtemp(prefix='vmreflect'))
+        self._chunks = None
+        self._closed = False
+        try:
+            self._start()
+        except:
+            exc_info = sys.exc_info()
+            self.close()
+            raise exc_info[0], exc_info[1], exc_info[2]
+
+    def _start(self):
+        # The script and the guest directory go over in one copy. The
+        # exit code is written last, so once it is there, so is all of
+        # the output.
+        stage = self._host_temp_dir.joinpath('stage')
+        stage.mkdir()
+        stage.joinpath('run.bat').write_bytes('\r\n'.join([
+            '%s >>"%s\\out" 2>>"%s\\err"' % (self.command, self.guest_dir,
+                                             self.guest_dir),
+            'echo %%errorlevel%% >"%s\\rc"' % self.guest_dir,
+        ]) + '\r\n')
+        self.vm.copy_file_to_guest(stage, self.guest_dir)
+        self.vm._run_command_no_output('%s >"%s\\spawn.out"' % (
+            Spawn('cmd /c run.bat', self.guest_dir), self.guest_dir))
+
+    def __iter__(self):
+        if self._chunks is None:
+            self._chunks = self._follow()
+        return self._chunks
+
+    def _follow(self):
+        host_dir = self._host_temp_dir.joinpath('out')
+        offsets = {'stdout': 0, 'stderr': 0}
+        finished = False
+        try:
+            while True:
+                if host_dir.exists():
+                    shutil.rmtree(host_dir)
+                self.vm.copy_file_from_guest(self.guest_dir, host_dir)
+                if self.pid is None:
+                    self._read_pid(host_dir.joinpath('spawn.out'))
+                for (name, filename) in [('stdout', 'out'), ('stderr', 'err')]:
+                    filename = host_dir.joinpath(filename)
+                    if not filename.exists():
+                        continue
+                    with open(filename, 'rb') as f:
+                        f.seek(offsets[name])
+                        for data in iter(lambda: f.read(self.chunk_size),
+                                         ''):
+                            offsets[name] += len(data)
+                            yield (name, data)
+                if finished:
+                    break
+                rc_file = host_dir.joinpath('rc')
+                if rc_file.exists() and rc_file.bytes().strip():
+                    returncode = int(rc_file.bytes().strip())
+                    # This copy may have been made as the command finished,
+                    # so the output is read from one more.
+                    finished = True
+                    continue
+                self.sleep(self.interval)
+            self.returncode = returncode
+        finally:
+            self._cleanup(kill=not finished)
+
+    def _read_pid(self, filename):
+        self.pid = _spawned_pid('cmd /c run.bat', filename.bytes())
+
+    def lines(self):
+        """
+        Yield the output as (name, line) pairs, each line ending in its
+        newline, except for the last one of an output if it doesn't have
+        one. Lines longer than chunk_size are split.
+        """
+        partial = {'stdout': '', 'stderr': ''}
+        for (name, data) in self:
+            pieces = (partial[name] + data).split('\n')
+            for piece in pieces[:-1]:
+                yield (name, piece + '\n')
+            partial[name] = pieces[-1]
+            if len(partial[name]) >= self.chunk_size:
+                yield (name, partial[name])
+                partial[name] = ''
+        for name in ['stdout', 'stderr']:
+            if partial[name]:
+                yield (name, partial[name])
+
+    def check(self):
+        """
+        Raise VmException if the command failed, or hasn't finished yet.
+        """
+        if self.returncode is None:
+            raise VmException(None, 'command %r has not finished'
+                              % self.command)
+        if self.returncode:
+            raise VmException(self.returncode, 'command %r exited with code %d'
+                              % (self.command, self.returncode))
+        return self
+
+    def close(self):
+        if self._chunks is not None:
+            self._chunks.close()
+        self._cleanup(kill=self.returncode is None)
+
+    def _cleanup(self, kill):
+        if self._closed:
+            return
+        self._closed = True
+        try:
+            if kill and self.pid is None:
+                # Closed before the output was ever copied back
+                spawn_out = self._host_temp_dir.joinpath('spawn.out')
+                try:
+                    self.vm.copy_file_from_guest(
+                        self.guest_dir + '\\spawn.out', spawn_out)
+                    self._read_pid(spawn_out)
+                except VmException:
+                    pass
+            if kill and self.pid is not None:
+                try:
+                    self.vm.kill_process(self.pid)
+                except VmException:
+                    # It has just finished.
+                    pass
+            try:
+                self.vm.delete_directory(self.guest_dir)
+            except VmException:
+                # The killed command's programs may still have its output
+                # open. vmreflect gc will delete it later.
+                if not kill:
+                    raise
+        finally:
+            release_lease(self._lease)
+            shutil.rmtree(self._host_temp_dir, True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
 _re_processes = re.compile(r'^pid=(\d+), owner=(.*), cmd=(.*)$')
 
-class VM(object):
-    def __init__(self, vm_name, username, password):
-        self.vmx = _vmx_path(vm_name)
+# Where VM.copy_files_to_guest records what it has sent to a directory
+_MANIFEST = 'vmreflect-manifest.txt'
+
+class VmrunBackend(object):
+    """
+    Backend that runs every operation by forking a new vmrun process.
+
+    This is the slow path described in the module docstring, and the
+    fallback when no persistent session is available.
+
+    A backend has a run() method that takes vmrun-style arguments, e.g.
+    ['deleteFileInGuest', vmx, filename], and returns a
+    (returncode, stdout, stderr) tuple, and a close() method.
+    """
+
+    def __init__(self, username, password):
         self.username = username
         self.password = password
 
-    def vmrun(self, cmd_args, *args, **kwargs):
+    def popen(self, cmd_args, *args, **kwargs):
         vmrun_cmd = os.getenv(
             'VMRUN',
             '/Applications/VMware Fusion.app/Contents/Library/vmrun')
@@ -85,20 +353,140 @@ class VM(object):
                    + list(cmd_args))
         return subprocess.Popen(cmdlist, *args, **kwargs)
 
-    def vmrun_check_output(self, cmd_args):
-        proc = self.vmrun(cmd_args, stdout=subprocess.PIPE,
+    def run(self, cmd_args):
+        proc = self.popen(cmd_args, stdout=subprocess.PIPE,
                           stderr=subprocess.PIPE)
         (stdout, stderr) = proc.communicate()
+        return (proc.returncode, stdout, stderr)
+
+    def close(self):
+        pass
+
+def default_backend(username, password):
+    """Return the backend to use when VM isn’t given one explicitly.
+
+    If the VMREFLECT_SESSION environment variable contains the host:port
+    of a session daemon (see vmreflect.session), one persistent connection
+    to it is used for every operation. Otherwise, or if the daemon can’t be
+    reached, every operation forks vmrun.
+    """
+    address = os.getenv('VMREFLECT_SESSION')
+    if address:
+        from .session import SessionBackend, parse_address
+        try:
+            return SessionBackend(parse_address(address), username, password)
+        except (socket.error, VmException), e:
+            print >> sys.stderr, ('Session %s unavailable, falling back to'
+                                  ' vmrun: %s' % (address, e))
+    return VmrunBackend(username, password)
+
+class VM(object):
+    """
+    A virtual machine, controlled through a backend.
+
+    backend_calls counts the operations sent to the backend so far, and
+    last_command_cost is how many of them the most recent _run_command
+    took.
+
+    If batch_commands is true, _run_command collects stdout, stderr and
+    the exit code in one guest directory and fetches it in a single copy,
+    instead of copying and deleting each temporary file separately.
+
+    If limiter is set, to an asyncvm.Limiter, every backend operation
+    holds one of its slots.
+
+    The guest's IP address is remembered in address_cache, by default an
+    addresses.AddressCache in the cache directory.
+
+    The vmreflect-XXXXXXXX.d directories that commands and copies work in
+    are leased, as janitor describes, in lease_directory, by default the
+    cache directory, so that vmreflect gc leaves them alone while they
+    are in use.
+    """
+
+    def __init__(self, vm_name, username, password, backend=None,
+                 batch_commands=True, address_cache=None,
+                 lease_directory=None):
+        self.vmx = _vmx_path(vm_name)
+        self.username = username
+        self.password = password
+        if backend is None:
+            backend = default_backend(username, password)
+        self.backend = backend
+        self.batch_commands = batch_commands
+        if address_cache is None:
+            address_cache = AddressCache(default_addresses_path())
+        self.address_cache = address_cache
+        self.lease_directory = lease_directory
+        self.backend_calls = 0
+        self.last_command_cost = None
+        self.limiter = None
+        self._calls_lock = threading.Lock()
+        self._guest_temp_dir = None
+        # The TCP ports that netstat last showed listening in the guest,
+        # if it has been run
+        self.listening_ports = None
+
+    def close(self):
+        """Close the backend connection, if there is one."""
+        self.backend.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def vmrun(self, cmd_args, *args, **kwargs):
+        """Fork vmrun directly, bypassing the backend."""
+        return VmrunBackend(self.username, self.password).popen(
+            cmd_args, *args, **kwargs)
+
+    def _backend_run(self, cmd_args):
+        limiter = self.limiter
+        if limiter is None:
+            return self._traced_run(cmd_args)
+        with limiter.slot():
+            return self._traced_run(cmd_args)
+
+    def _traced_run(self, cmd_args):
+        with self._calls_lock:
+            self.backend_calls += 1
+        tracer = trace.tracer
+        if tracer is None:
+            return self.backend.run(cmd_args)
+        start = time.time()
+        try:
+            result = self.backend.run(cmd_args)
+        except Exception, e:
+            tracer.operation(cmd_args, start, error=str(e))
+            raise
+        tracer.operation(cmd_args, start, result)
+        return result
+
+    def vmrun_check_output(self, cmd_args):
+        (returncode, stdout, stderr) = self._backend_run(cmd_args)
         stdout = (stdout or '').strip()
         stderr = (stderr or '').strip()
-        if proc.returncode:
-            e = VmException(proc.returncode,
+        if returncode:
+            e = VmException(returncode,
                 'vmrun %s failed, returned %d\n\targs were: %s\n%s\n%s'
-                % (cmd_args[0], proc.returncode, cmd_args[1:],
+                % (cmd_args[0], returncode, cmd_args[1:],
                    stdout, stderr))
             raise e
         return (stdout, stderr)
 
+    def _new_guest_dir(self):
+        """
+        Return the name of a new vmreflect-XXXXXXXX.d directory in the
+        guest's temporary directory, and the filename of a lease on it, for
+        janitor.release_lease().
+        """
+        guest_dir = '%s\\vmreflect-%s.d' % (self._temp_dir(),
+                                            get_random_string(length=8))
+        return (guest_dir, take_lease(self.vmx, [guest_dir],
+                                      self.lease_directory))
+
     def _create_temp_file(self):
         """Create a temporary file in the guest and return the filename."""
         (stdout, stderr) = self.vmrun_check_output(
@@ -124,6 +512,31 @@ class VM(object):
         self.vmrun_check_output(['deleteDirectoryInGuest',
                                  self.vmx, directoryname])
 
+    def create_directory(self, directoryname):
+        """Create directory in guest."""
+        self.vmrun_check_output(['createDirectoryInGuest',
+                                 self.vmx, directoryname])
+
+    def rename_file(self, old_name, new_name):
+        """Rename file old_name to new_name in guest."""
+        self.vmrun_check_output(['renameFileInGuest',
+                                 self.vmx, old_name, new_name])
+
+    def file_exists(self, filename):
+        """Return whether filename exists in guest."""
+        # Depending on the version, vmrun reports a missing file with a
+        # non-zero exit code or only in its output.
+        (returncode, stdout, stderr) = self._backend_run(
+            ['fileExistsInGuest', self.vmx, filename])
+        return returncode == 0 and 'does not exist' not in (stdout or '')
+
+    def list_directory(self, directoryname):
+        """Return the names of the files and directories in directoryname."""
+        (stdout, stderr) = self.vmrun_check_output(
+            ['listDirectoryInGuest', self.vmx, directoryname])
+        return [line.strip() for line in stdout.splitlines()
+                if line.strip() and not line.startswith('Directory list:')]
+
     def copy_file_from_guest(self, guest_path, host_path):
         self.vmrun_check_output(['CopyFileFromGuestToHost',
                                  self.vmx,
@@ -134,15 +547,225 @@ class VM(object):
                                  self.vmx,
                                  host_path, guest_path])
 
+    def copy_files_to_guest(self, host_paths, guest_dir):
+        """
+        Copy host_paths, files on the host, into guest_dir, which is
+        created if need be, and return the names of the ones copied.
+
+        The files are packed into one compressed cabinet, which is copied
+        over in one operation and unpacked by expand.exe. A manifest in
+        guest_dir records the SHA-1 of every file sent there, and files
+        that haven't changed since are skipped: if none have, the whole
+        copy costs one backend call.
+        """
+        files = _unique_names((path(p).basename(), p) for p in host_paths)
+        host_temp_dir = path(tempfile.mkdtemp(prefix='vmreflect'))
+        try:
+            manifest = {}
+            host_manifest = host_temp_dir.joinpath(_MANIFEST)
+            try:
+                self.copy_file_from_guest('%s\\%s' % (guest_dir, _MANIFEST),
+                                          host_manifest)
+                manifest = _parse_manifest(host_manifest.bytes())
+            except VmException:
+                # Nothing has been sent there yet.
+                pass
+
+            changed = []
+            for (name, host_path) in files:
+                sha1 = file_sha1(host_path)
+                if manifest.get(name.lower(), (None,))[0] != sha1:
+                    changed.append((name, host_path))
+                    manifest[name.lower()] = (sha1, name)
+            if not changed:
+                return []
+
+            (guest_stage, lease) = self._new_guest_dir()
+            try:
+                stage = host_temp_dir.joinpath(
+                    guest_stage.rpartition('\\')[2])
+                stage.mkdir()
+                stage.joinpath('files.cab').write_bytes(cab.pack(
+                    [(name, path(host_path).bytes())
+                     for (name, host_path) in changed]
+                    + [(_MANIFEST, _format_manifest(manifest))]))
+                self.copy_file_to_guest(stage, guest_stage)
+                try:
+                    self._run_command_no_output('\r\n'.join([
+                        'mkdir "%s" 2>nul' % guest_dir,
+                        'expand "%s\\files.cab" -F:* "%s" >nul'
+                        ' && rmdir /s /q "%s"'
+                        % (guest_stage, guest_dir, guest_stage),
+                    ]))
+                except VmException:
+                    try:
+                        self.delete_directory(guest_stage)
+                    except VmException:
+                        pass
+                    raise
+            finally:
+                release_lease(lease)
+            return [name for (name, _) in changed]
+        finally:
+            shutil.rmtree(host_temp_dir)
+
+    def copy_files_from_guest(self, guest_paths, host_dir):
+        """
+        Copy guest_paths, files in the guest, into host_dir, and return
+        their paths on the host.
+
+        makecab.exe packs them into one compressed cabinet in the guest,
+        which is copied back in one operation. A stock guest has nothing
+        to hash files with, so every file is copied every time.
+        """
+        files = _unique_names((p.rstrip('\\').rpartition('\\')[2], p)
+                              for p in guest_paths)
+        (stage, lease) = self._new_guest_dir()
+        directives = [
+            '.OPTION EXPLICIT',
+            '.Set CabinetNameTemplate=files.cab',
+            '.Set DiskDirectoryTemplate="%s"' % stage,
+            '.Set MaxDiskSize=0',
+            '.Set CompressionType=MSZIP',
+            '.Set RptFileName=NUL',
+            '.Set InfFileName=NUL',
+        ] + ['"%s" "%s"' % (guest_path, name) for (name, guest_path) in files]
+        # With the redirection first, a digit at the end of a line isn't
+        # taken for a file handle.
+        lines = (['mkdir "%s"' % stage]
+                 + ['>>"%s\\files.ddf" echo %s' % (stage, directive)
+                    for directive in directives]
+                 + ['makecab /f "%s\\files.ddf" >"%s\\makecab.out"'
+                    % (stage, stage),
+                    'echo %%errorlevel%% >"%s\\makecab.rc"' % stage])
+
+        host_temp_dir = path(tempfile.mkdtemp(prefix='vmreflect'))
+        try:
+            host_stage = host_temp_dir.joinpath('out')
+            try:
+                self._run_command_no_output('\r\n'.join(lines))
+                self.copy_file_from_guest(stage, host_stage)
+            except:
+                exc_info = sys.exc_info()
+                try:
+                    self.delete_directory(stage)
+                except VmException:
+                    pass
+                raise exc_info[0], exc_info[1], exc_info[2]
+            self.delete_directory(stage)
+
+            returncode = int(host_stage.joinpath('makecab.rc').bytes().strip()
+                             or -1)
+            if returncode:
+                raise VmException(returncode, 'makecab failed:\n'
+                                  + host_stage.joinpath('makecab.out').bytes())
+            contents = dict(cab.unpack(
+                host_stage.joinpath('files.cab').bytes()))
+        finally:
+            release_lease(lease)
+            shutil.rmtree(host_temp_dir)
+
+        host_dir = path(host_dir)
+        if not host_dir.isdir():
+            host_dir.makedirs()
+        host_paths = []
+        for (name, _) in files:
+            host_path = host_dir.joinpath(name)
+            host_path.write_bytes(contents[name])
+            host_paths.append(host_path)
+        return host_paths
+
+    def _temp_dir(self):
+        """Return the guest’s temporary directory.
+
+        It is found once, by creating and deleting a temporary file, and
+        then remembered.
+        """
+        if self._guest_temp_dir is None:
+            temp_file = self._create_temp_file()
+            self.delete_file(temp_file)
+            self._guest_temp_dir = temp_file.rpartition('\\')[0]
+        return self._guest_temp_dir
+
     def _run_command(self, command):
-        """Run command in CMD and return the output of its last line.
+        """Run command in CMD and return its (stdout, stderr).
 
         To collect the output, the command is run at the command prompt
-        with output redirected to a temporary file, then the temporary
-        is copied over.
+        with output redirected to temporary files, then the temporary
+        files are copied over.
 
         As such, Windows CMD’s quoting rules apply.
         """
+        calls_before = self.backend_calls
+        if self.batch_commands:
+            ret = self._run_command_batched(command)
+        else:
+            ret = self._run_command_unbatched(command)
+        self.last_command_cost = self.backend_calls - calls_before
+        return ret
+
+    def _run_command_batched(self, command):
+        return self._run_batch([command])[0].check()[1:3]
+
+    def run_batch(self, commands):
+        """Run commands in CMD, one after another, in a single guest script.
+
+        Return a list with one CommandResult per command. Every command
+        runs even if an earlier one fails; call check() on a result to
+        raise VmException if it failed. Wrap a command in NoOutput to
+        discard its output instead of collecting it.
+
+        The whole batch costs the same three backend calls as one
+        _run_command.
+        """
+        calls_before = self.backend_calls
+        results = self._run_batch(commands)
+        self.last_command_cost = self.backend_calls - calls_before
+        return results
+
+    def _run_batch(self, commands):
+        (guest_dir, lease) = self._new_guest_dir()
+        lines = ['mkdir "%s"' % guest_dir]
+        for i, command in enumerate(commands):
+            if isinstance(command, NoOutput):
+                lines.append('%s >nul 2>nul' % command)
+            else:
+                lines.append('%s >"%s\\%d.out" 2>"%s\\%d.err"'
+                             % (command, guest_dir, i, guest_dir, i))
+            lines.append('echo %%errorlevel%% >"%s\\%d.rc"' % (guest_dir, i))
+        script = '\r\n'.join(lines)
+
+        host_temp_dir = path(tempfile.mkdtemp(prefix='vmreflect'))
+        try:
+            host_dir = host_temp_dir.joinpath('out')
+            try:
+                self.vmrun_check_output(
+                    ['runScriptInGuest', self.vmx, '', script])
+                self.copy_file_from_guest(guest_dir, host_dir)
+            except:
+                exc_info = sys.exc_info()
+                try:
+                    self.delete_directory(guest_dir)
+                except VmException:
+                    pass
+                raise exc_info[0], exc_info[1], exc_info[2]
+            self.delete_directory(guest_dir)
+
+            def read(name):
+                filename = host_dir.joinpath(name)
+                return filename.bytes() if filename.isfile() else ''
+
+            results = []
+            for i, command in enumerate(commands):
+                returncode = int(read('%d.rc' % i).strip() or -1)
+                results.append(CommandResult(str(command), read('%d.out' % i),
+                                             read('%d.err' % i), returncode))
+            return results
+        finally:
+            release_lease(lease)
+            shutil.rmtree(host_temp_dir)
+
+    def _run_command_unbatched(self, command):
         guest_stdout_filename = self._create_temp_file()
         guest_stderr_filename = self._create_temp_file()
         run_exception = None
@@ -180,6 +803,21 @@ class VM(object):
                               + 'stderr:\n' + stderr)
         return (stdout, stderr)
 
+    def stream_command(self, command, interval=1.0, chunk_size=64 * 1024):
+        """
+        Start command in CMD in the guest, without waiting for it, and
+        return a CommandStream that yields its output as it is produced,
+        polling every interval seconds.
+
+            with vm.stream_command('build.bat') as stream:
+                for (name, line) in stream.lines():
+                    print line,
+            stream.check()
+
+        Starting it costs two backend calls, and every poll one more.
+        """
+        return CommandStream(self, command, interval, chunk_size)
+
     def _run_command_no_output(self, command):
         """Run command in CMD, return None, but check the return code."""
         self.vmrun_check_output(['runScriptInGuest', self.vmx, '', command])
@@ -190,23 +828,155 @@ class VM(object):
         process_list = self._parse_process_list(stdout)
         return process_list
 
+    def find_processes(self, pid=None, cmd_contains=None):
+        """
+        Return an iterator over the guest processes with pid, whose command
+        lines contain cmd_contains, or both. The process list is fetched
+        right away, but only the lines that can match are parsed, as the
+        iterator is consumed.
+        """
+        stdout, stderr = self.vmrun_check_output(
+            ['listProcessesInGuest', self.vmx])
+        return _iter_processes(stdout, pid, cmd_contains)
+
+    def spawn(self, program, directory=None):
+        """Start program in the guest, without waiting, and return its pid.
+
+        This costs the same backend calls as one _run_command. To start a
+        program along with other commands, put a Spawn in a run_batch.
+        """
+        [result] = self.run_batch([Spawn(program, directory)])
+        return result.check().pid
+
+    def is_running(self, pid):
+        """Return whether process pid is running in the guest."""
+        return any(True for p in self.find_processes(pid=pid))
+
+    def wait(self, pid, timeout=None, backoff=None):
+        """Wait until process pid has exited.
+
+        The process list is polled with backoff, a retry.Backoff, and
+        retry.DeadlineExceeded is raised if the process is still running
+        after timeout seconds.
+        """
+        def exited():
+            if self.is_running(pid):
+                raise NotReady('process %d is still running' % pid)
+        deadline = float('inf') if timeout is None else time.time() + timeout
+        retry(exited, deadline, backoff=backoff)
+
+    def guest_ip_address(self, refresh=False):
+        """Return the guest's IP address.
+
+        Unless refresh is set, an address remembered in address_cache is
+        returned without asking the guest. Otherwise vmrun
+        getGuestIPAddress is asked, in one backend call, and if it can't
+        tell, the first address that ipconfig shows for any adapter is
+        used.
+        """
+        address = None if refresh else self.address_cache.get(self.vmx)
+        if address is None:
+            address = self._query_guest_ip_address()
+            self.address_cache.set(self.vmx, address)
+        return address
+
+    def _query_guest_ip_address(self):
+        (returncode, stdout, stderr) = self._backend_run(
+            ['getGuestIPAddress', self.vmx])
+        address = (stdout or '').strip()
+        if returncode == 0 and _is_ipv4(address):
+            return address
+        (stdout, stderr) = self._run_command('ipconfig')
+        addresses = _parse_ipconfig(stdout)
+        if not addresses:
+            raise VmException(None, 'no IP address found in ipconfig'
+                              ' output:\n%s' % stdout)
+        return addresses[0]
+
     def kill_process(self, pid):
         self.vmrun_check_output(
             ['killProcessInGuest', self.vmx, str(pid)])
 
     def _parse_process_list(self, text):
-        ret = []
-        for line in text.strip().split('\n'):
-            if line.startswith('Process list:'):
-                continue
-
-            match = _re_processes.match(line)
-            if not match:
-                raise Exception('no match for', repr(line))
-            groups = list(match.groups())
-            groups[0] = int(groups[0])
-            ret.append(GuestProcess(*groups))
-        return ret
+        return list(_iter_processes(text))
+
+_re_ipv4 = re.compile(r'(?<![\d.])(\d{1,3}(?:\.\d{1,3}){3})(?![\d.])')
+
+def _unique_names(files):
+    """
+    Return files, (name, path) pairs, as a list, raising ValueError if two
+    have the same name, ignoring case as Windows does.
+    """
+    files = list(files)
+    seen = set()
+    for (name, _) in files:
+        if name.lower() in seen:
+            raise ValueError('more than one file is named %s' % name)
+        seen.add(name.lower())
+    return files
+
+def _parse_manifest(text):
+    """
+    Return the SHA-1s in a manifest written by _format_manifest, as a dict
+    of (sha1, name) by lowercase name.
+    """
+    manifest = {}
+    for line in text.splitlines():
+        (sha1, _, name) = line.partition('  ')
+        if name:
+            manifest[name.lower()] = (sha1, name)
+    return manifest
+
+def _format_manifest(manifest):
+    return ''.join('%s  %s\r\n' % manifest[key] for key in sorted(manifest))
+
+def _is_ipv4(address):
+    match = _re_ipv4.match(address)
+    return match is not None and match.group(1) == address
+
+def _parse_ipconfig(text):
+    """
+    Return the IPv4 address of each adapter in ipconfig's output, in
+    order, leaving out loopback and link-local ones, and adapters with
+    no address, whose first IPv4 address is their subnet mask.
+
+    The labels depend on the version and language of Windows, so each
+    adapter's address is taken to be the first IPv4 address in its
+    section, which ipconfig shows before the subnet mask and gateway.
+    """
+    addresses = []
+    found = True
+    for line in text.splitlines():
+        if line.strip() and not line[0].isspace():
+            # A heading, such as Ethernet adapter Local Area Connection:
+            found = False
+            continue
+        match = _re_ipv4.search(line)
+        if match and not found:
+            found = True
+            if not match.group(1).startswith(('0.', '127.', '169.254.',
+                                              '255.')):
+                addresses.append(match.group(1))
+    return addresses
+
+def _iter_processes(text, pid=None, cmd_contains=None):
+    prefix = 'pid=%d,' % pid if pid is not None else ''
+    for line in text.strip().split('\n'):
+        if line.startswith('Process list:'):
+            continue
+        # Cheap tests first, so that most lines are never parsed
+        if not line.startswith(prefix):
+            continue
+        if cmd_contains is not None and cmd_contains not in line:
+            continue
+
+        match = _re_processes.match(line)
+        if not match:
+            raise Exception('no match for', repr(line))
+        process = GuestProcess(int(match.group(1)), *match.groups()[1:])
+        if cmd_contains is not None and cmd_contains not in process.cmd:
+            continue
+        yield process
 
 def _vmrun(*args, **kwargs):
     cmd = [_VMRUN] + list(args)